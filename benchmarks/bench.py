@@ -0,0 +1,348 @@
+"""Collector, store and metadata benchmarks against local fake servers.
+
+Every scenario runs in a separate process, so CPU time and peak RSS belong
+to the agent code only, while fake ns_server and seriesly/cbmonitor sink run
+in their own processes. Remote stats and client library collectors run
+against in-process fakes (see benchmarks.fakes). Results are printed as JSON
+and can be saved as a baseline or compared against one:
+
+    python -m benchmarks.bench --save benchmarks/baseline.json
+    python -m benchmarks.bench --compare benchmarks/baseline.json
+
+Every scenario also times a fixed CPU-bound workload (calibration). Timings
+and throughput are compared relative to it, so a baseline recorded on a
+faster or slower machine doesn't produce false regressions.
+"""
+import json
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+
+import requests
+
+from benchmarks.fakes import (FakeNSServer, FakeSink, FakeSyncGateway,
+                              install_client, install_ssh, load_fixture)
+
+SIZES = "1x1,4x4,16x10"  # nodes x buckets
+
+REST_COLLECTORS = ("ns_server", "active_tasks", "sync_gateway")
+
+SSH_COLLECTORS = ("iostat", "net", "ps", "typeperf")
+
+CLIENT_COLLECTORS = ("latency", "observe", "xdcr_lag")
+
+COLLECTORS = REST_COLLECTORS + SSH_COLLECTORS + CLIENT_COLLECTORS
+
+SCENARIOS = COLLECTORS + ("store", "metadata")
+
+# Metrics checked by --compare: name -> (True if higher is better, True if
+# the metric depends on machine speed and is scaled by calibration)
+CHECKED = {
+    "sample_wall_mean": (False, True),
+    "cpu_per_sample": (False, True),
+    "requests_per_sample": (False, False),
+    "peak_rss": (False, False),
+    "points_per_sec": (True, True),
+    "cpu_per_point": (False, True),
+    "metadata_requests": (False, False),
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB
+
+
+def calibrate(rounds=300):
+    """Wall time (ms) of a fixed CPU-bound workload: decoding and walking a
+    bucket stats payload, roughly what collectors do. The best of many short
+    rounds is taken, so scheduling noise doesn't skew it."""
+    from cbagent.clock import monotonic
+
+    payload = json.dumps(load_fixture("_pools_default_buckets_default_stats"))
+    best = None
+    for _ in range(rounds):
+        t0 = monotonic()
+        samples = json.loads(payload)["op"]["samples"]
+        dict((metric, values[-1]) for metric, values in samples.items())
+        elapsed = monotonic() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return 1000 * best
+
+
+def get_stats(port):
+    return requests.get("http://127.0.0.1:{}/_bench/stats".format(port)).json()
+
+
+def get_settings(sink_port, spool_path, nodes):
+    from cbagent.settings import Settings
+    return Settings({
+        "master_node": "127.0.0.1",
+        "seriesly_host": "127.0.0.1",
+        "seriesly_port": sink_port,
+        "cbmonitor_host_port": "127.0.0.1:{}".format(sink_port),
+        "interval": 1,
+        "spool_path": spool_path,
+        "agent_report_interval": 3600,
+        "nodes": ["127.0.0.{}".format(i + 1) for i in range(nodes)],
+        "partitions": {"data": "/data"},
+    })
+
+
+def bench_collector(name, settings, sink_port, samples):
+    from cbagent.clock import monotonic
+    from cbagent.__main__ import COLLECTORS as KNOWN
+
+    t0 = monotonic()
+    collector = dict(KNOWN)[name](settings)
+    collector.update_metadata()
+    collector.sample()  # warm-up: topology discovery, metadata
+    collector.mc.flush()
+    init_time = monotonic() - t0
+
+    requests0 = get_stats(8091).get("requests", 0)
+    sink0 = get_stats(sink_port)
+    cpu0 = cpu_time()
+    walls = []
+    for _ in range(samples):
+        t0 = monotonic()
+        collector.sample()
+        walls.append(monotonic() - t0)
+    cpu = cpu_time() - cpu0
+    requests_count = get_stats(8091).get("requests", 0) - requests0
+
+    t0 = monotonic()
+    collector.store.flush(timeout=60)
+    flush_time = monotonic() - t0
+    sink = get_stats(sink_port)
+
+    return {
+        "init_time": init_time,
+        "samples_per_sec": samples / sum(walls),
+        "sample_wall_mean": 1000 * sum(walls) / samples,  # ms
+        "sample_wall_p50": 1000 * percentile(walls, 50),
+        "sample_wall_max": 1000 * max(walls),
+        "cpu_per_sample": 1000 * cpu / samples,  # ms
+        "requests_per_sample": float(requests_count) / samples,
+        "points_per_sample":
+            float(sink.get("points", 0) - sink0.get("points", 0)) / samples,
+        "store_flush_time": 1000 * flush_time,
+        "peak_rss": peak_rss(),
+    }
+
+
+def bench_store(settings, sink_port, points):
+    from cbagent.clock import monotonic
+    from cbagent.runtime import Context
+
+    context = Context(settings)
+    data = dict(("metric_{}".format(i), i * 1.5) for i in range(166))
+
+    cpu0 = cpu_time()
+    t0 = monotonic()
+    for i in range(points):
+        context.store.append(data, cluster="default", bucket="bucket-0",
+                             server="127.0.0.{}".format(i % 16),
+                             collector="ns_server")
+    append_time = monotonic() - t0
+    context.store.flush(timeout=300)
+    total_time = monotonic() - t0
+    cpu = cpu_time() - cpu0
+    sink = get_stats(sink_port)
+
+    return {
+        "appends_per_sec": points / append_time,
+        "points_per_sec": points / total_time,
+        "cpu_per_point": 1000 * cpu / points,  # ms
+        "bytes_per_point": float(sink.get("bytes", 0)) / points,
+        "dropped": context.store.dropped,
+        "peak_rss": peak_rss(),
+    }
+
+
+def bench_metadata(settings, sink_port, metrics):
+    from cbagent.clock import monotonic
+    from cbagent.metadata_client import MetadataClient
+
+    mc = MetadataClient(settings)
+    t0 = monotonic()
+    for i in range(metrics):
+        mc.add_metric("metric_{}".format(i % 166), bucket="bucket-0",
+                      server="127.0.0.{}".format(i // 166),
+                      collector="ns_server")
+    mc.flush()
+    sink = get_stats(sink_port)
+    return {
+        "metrics_per_sec": metrics / (monotonic() - t0),
+        "metadata_requests": sink.get("metadata_requests", 0),
+        "peak_rss": peak_rss(),
+    }
+
+
+def run_scenario(results, scenario, sink_port, nodes, buckets, samples):
+    spool_path = tempfile.mkdtemp(prefix="cbagent_bench_")
+    try:
+        if scenario in SSH_COLLECTORS:
+            install_ssh()
+        elif scenario in CLIENT_COLLECTORS:
+            install_client()
+        calibration = calibrate()
+        settings = get_settings(sink_port, spool_path, nodes)
+        if scenario == "store":
+            result = bench_store(settings, sink_port, 200 * samples)
+        elif scenario == "metadata":
+            result = bench_metadata(settings, sink_port,
+                                    166 * nodes * buckets)
+        else:
+            result = bench_collector(scenario, settings, sink_port, samples)
+        result["calibration"] = calibration
+        results.put(result)
+    except Exception as e:
+        results.put({"error": repr(e)})
+    finally:
+        shutil.rmtree(spool_path, ignore_errors=True)
+
+
+def serve(server_class, ports, *args):
+    server = server_class(*args)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(server_class, *args):
+    ports = Queue()
+    process = Process(target=serve, args=(server_class, ports) + args)
+    process.daemon = True
+    process.start()
+    return process, ports.get(timeout=10)
+
+
+def run(scenarios, sizes, samples):
+    results = []
+    for nodes, buckets in sizes:
+        ns_server, _ = start_server(FakeNSServer, nodes, buckets)
+        sync_gateway = None
+        if "sync_gateway" in scenarios:
+            sync_gateway, _ = start_server(FakeSyncGateway)
+        try:
+            for scenario in scenarios:
+                # every scenario gets a clean sink
+                sink, sink_port = start_server(FakeSink)
+                queue = Queue()
+                process = Process(target=run_scenario,
+                                  args=(queue, scenario, sink_port, nodes,
+                                        buckets, samples))
+                process.start()
+                result = queue.get()
+                process.join(10)
+                if process.is_alive():  # agent threads are daemons
+                    process.terminate()
+                sink.terminate()
+
+                result.update(scenario=scenario, nodes=nodes, buckets=buckets)
+                results.append(result)
+                sys.stderr.write("{scenario} {nodes}x{buckets}: {0}\n".format(
+                    json.dumps(result, sort_keys=True), **result))
+        finally:
+            ns_server.terminate()
+            if sync_gateway is not None:
+                sync_gateway.terminate()
+            time.sleep(0.5)  # release the port
+    return results
+
+
+def get_calibration(results):
+    """Median calibration time of a run, None for old baselines."""
+    values = [result["calibration"] for result in results
+              if result.get("calibration")]
+    return values and percentile(values, 50) or None
+
+
+def compare(results, baseline, tolerance):
+    """Return list of regressions against baseline results. Machine speed
+    dependent metrics are compared after scaling by the ratio of median
+    calibration times, i.e. relative to the speed of the machine."""
+    speedup = 1.0
+    if get_calibration(results) and get_calibration(baseline):
+        speedup = get_calibration(baseline) / get_calibration(results)
+
+    key = lambda r: (r["scenario"], r["nodes"], r["buckets"])
+    baseline = dict((key(result), result) for result in baseline)
+
+    regressions = []
+    for result in results:
+        base = baseline.get(key(result))
+        if base is None:
+            continue
+        for metric, (higher_is_better, scaled) in sorted(CHECKED.items()):
+            if metric not in result or not base.get(metric):
+                continue
+            ratio = float(result[metric]) / base[metric]
+            if scaled:
+                ratio = ratio / speedup if higher_is_better \
+                    else ratio * speedup
+            if (higher_is_better and ratio < 1 - tolerance) or \
+                    (not higher_is_better and ratio > 1 + tolerance):
+                regressions.append(
+                    "{} {}x{} {}: {:.3f} -> {:.3f}".format(
+                        result["scenario"], result["nodes"],
+                        result["buckets"], metric, base[metric],
+                        result[metric]))
+    return regressions
+
+
+def main():
+    parser = OptionParser(prog="bench")
+
+    parser.add_option("--scenarios", dest="scenarios",
+                      default=",".join(SCENARIOS),
+                      help="Comma-separated list of scenarios")
+    parser.add_option("--sizes", dest="sizes", default=SIZES,
+                      help="Comma-separated cluster sizes, NODESxBUCKETS")
+    parser.add_option("--samples", dest="samples", type="int", default=20,
+                      help="Samples per collector scenario")
+    parser.add_option("--save", dest="save",
+                      help="Save results as a baseline")
+    parser.add_option("--compare", dest="compare",
+                      help="Compare results with a baseline")
+    parser.add_option("--tolerance", dest="tolerance", type="float",
+                      default=0.25,
+                      help="Allowed relative regression (default 0.25)")
+
+    options, args = parser.parse_args()
+
+    scenarios = options.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            sys.exit("Unknown scenario: {}".format(scenario))
+    sizes = [tuple(int(n) for n in size.split("x"))
+             for size in options.sizes.split(",")]
+
+    results = run(scenarios, sizes, options.samples)
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+    if options.save:
+        with open(options.save, "w") as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as fh:
+            regressions = compare(results, json.load(fh), options.tolerance)
+        if regressions:
+            sys.exit("Performance regressions:\n" + "\n".join(regressions))
+
+if __name__ == "__main__":
+    main()
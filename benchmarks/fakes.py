@@ -0,0 +1,449 @@
+"""Local stand-ins for ns_server, seriesly and cbmonitor.
+
+FakeNSServer serves payloads from fixtures/ scaled synthetically to a given
+number of nodes and buckets. Nodes are 127.0.0.1, 127.0.0.2, ... (the whole
+127.0.0.0/8 network is routed to loopback on Linux), so the server listens
+on all interfaces on the regular REST port.
+
+FakeSink accepts seriesly writes and cbmonitor metadata calls and only
+counts them. FakeSyncGateway serves expvar stats on the sync_gateway admin
+port. All servers count requests, counters are available at /_bench/stats.
+
+Remote stats and client libraries can't be served by a local process
+without sshd or memcached, so FakeTransport (synthetic /proc and typeperf
+output) and FakeBucket (in-memory couchbase client) replace them inside
+the benchmark process, see install_ssh() and install_client().
+"""
+import json
+import os
+import re
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+from time import time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "fixtures")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name + ".json")) as fh:
+        return json.load(fh)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    wbufsize = -1  # whole response in one write, no Nagle stalls
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, status=200):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _handle(self, method):
+        path = urllib.unquote(self.path.split("?")[0])
+        body = method in ("POST", "PUT") and self._read_body() or ""
+        if path == "/_bench/stats":
+            return self._reply(self.server.get_stats())
+        self.server.count("requests")
+        response = self.server.route(method, path, body)
+        if response is None:
+            return self._reply({"error": "not found"}, status=404)
+        self._reply(response)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        HTTPServer.__init__(self, address, Handler)
+        self.stats = {}
+        self._lock = Lock()
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def route(self, method, path, body):
+        raise NotImplementedError
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class FakeNSServer(FakeServer):
+
+    def __init__(self, nodes, buckets, port=8091):
+        FakeServer.__init__(self, ("", port))
+        self.hosts = ["127.0.0.{}".format(i + 1) for i in range(nodes)]
+        self.buckets = ["bucket-{}".format(i) for i in range(buckets)]
+
+        pool = load_fixture("_pools_default")
+        template = pool["nodes"][0]
+        pool["nodes"] = [dict(template, hostname="{}:8091".format(host))
+                         for host in self.hosts]
+        self.pool = json.dumps(pool)
+
+        template = load_fixture("_pools_default_buckets")[0]
+        self.bucket_list = json.dumps([
+            dict(template, name=bucket, stats={
+                "uri": "/pools/default/buckets/{}/stats".format(bucket),
+                "directoryURI":
+                    "/pools/default/buckets/{}/statsDirectory".format(bucket),
+                "nodeStatsListURI":
+                    "/pools/default/buckets/{}/nodes".format(bucket),
+            }) for bucket in self.buckets
+        ])
+
+        # Stats payloads are the same for every bucket and node, serialize
+        # them once.
+        self.bucket_stats = json.dumps(
+            load_fixture("_pools_default_buckets_default_stats"))
+        self.node_stats = json.dumps(load_fixture(
+            "_pools_default_buckets_default_nodes_127.0.0.1_stats"))
+
+        self.tasks = json.dumps(
+            [{"type": "rebalance", "progress": 50}] +
+            [{"type": "bucket_compaction", "bucket": bucket, "progress": 10}
+             for bucket in self.buckets[::2]]
+        )
+
+    def _get_servers(self, bucket):
+        return {"servers": [{
+            "hostname": "{}:8091".format(host),
+            "stats": {"uri": "/pools/default/buckets/{}/nodes/{}:8091/stats"
+                      .format(bucket, host)},
+        } for host in self.hosts]}
+
+    def route(self, method, path, body):
+        if path == "/pools":
+            return {"pools": [{"name": "default", "uri": "/pools/default"}]}
+        if path == "/pools/default":
+            return self.pool
+        if path == "/pools/default/buckets":
+            return self.bucket_list
+        if path == "/pools/default/tasks":
+            return self.tasks
+
+        parts = path.strip("/").split("/")
+        if len(parts) < 5 or parts[3] not in self.buckets:
+            return
+        if parts[4:] == ["stats"]:
+            return self.bucket_stats
+        if parts[4:] == ["nodes"]:
+            return self._get_servers(parts[3])
+        if parts[4] == "nodes" and parts[-1] == "stats":
+            return self.node_stats
+
+
+class FakeSink(FakeServer):
+
+    """seriesly and cbmonitor on a single port."""
+
+    def __init__(self, port=0):
+        FakeServer.__init__(self, ("127.0.0.1", port))
+        self.dbs = set()
+
+    def route(self, method, path, body):
+        if path.startswith("/cbmonitor/"):
+            self.count("metadata_requests")
+            if path.startswith("/cbmonitor/get_"):
+                return []
+            if path == "/cbmonitor/add_metrics/":
+                self.count("metadata_items",
+                           len(json.loads(urllib.unquote_plus(
+                               body.partition("=")[2]))))
+            else:
+                self.count("metadata_items")
+            return {}
+
+        db = path.strip("/")
+        if db == "_all_dbs":
+            return sorted(self.dbs)
+        if method == "PUT":
+            self.dbs.add(db)
+            return {}
+        if method == "POST":
+            self.count("points")
+            self.count("bytes", len(body))
+            return {}
+
+
+class FakeSyncGateway(FakeServer):
+
+    """Expvar stats of sync_gateway, PauseTotalNs grows with time."""
+
+    def __init__(self, port=4985):
+        FakeServer.__init__(self, ("", port))
+        self.started = time()
+
+    def _get_stats(self):
+        uptime = time() - self.started
+        return {
+            "memstats": {
+                "Alloc": 52428800, "TotalAlloc": int(10 ** 6 * uptime),
+                "Sys": 104857600, "Mallocs": int(10 ** 4 * uptime),
+                "Frees": int(9000 * uptime), "HeapAlloc": 52428800,
+                "HeapObjects": 250000, "NumGC": int(uptime),
+                "PauseTotalNs": int(10 ** 7 * uptime),
+                "PauseNs": [10 ** 5 + i for i in range(100)] + [0] * 156,
+                "BySize": [{"Size": 8 * i, "Mallocs": i, "Frees": i}
+                           for i in range(61)],
+                "EnableGC": True,
+            },
+            "syncGateway_changeCache": {
+                "maxPending": 10, "lag-queue-0000ms": 1000,
+                "lag-total-0000ms": 1000, "outOfOrder": 0,
+            },
+            "syncGateway_db": {
+                "channelChangesFeeds": 10,
+                "document_gets": int(100 * uptime),
+                "revs_added": int(50 * uptime),
+            },
+            "syncGateway_rest": {
+                "requests_total": int(200 * uptime),
+                "requests_active": 5,
+            },
+        }
+
+    def route(self, method, path, body):
+        if path == "/_stats":
+            return self._get_stats()
+
+
+class FakeTransport(object):
+
+    """In-process replacement of SSHTransport. Commands of remote stats
+    collectors are answered with synthetic /proc, mount and typeperf output,
+    counters grow at constant rates."""
+
+    PROCESS = re.compile(r'echo "#(\S+) \$pid"')
+
+    _transports = {}
+
+    def __init__(self, host):
+        self.host = host
+        self.started = time()
+        self.tcp = "\n".join(
+            ["  sl  local_address rem_address   st tx_queue rx_queue"] +
+            ["{:4}: 0100007F:{:04X} 0100007F:2B97 {} 00000000:00000000"
+             .format(i, 40000 + i, "01" if i % 3 else "06")
+             for i in range(300)])
+
+    @classmethod
+    def get(cls, host, *args):
+        if host not in cls._transports:
+            cls._transports[host] = cls(host)
+        return cls._transports[host]
+
+    def _get_uptime(self):
+        return 1000 + time() - self.started
+
+    def _get_ps(self, processes):
+        uptime = self._get_uptime()
+        lines = ["{:.2f} 4000.00".format(uptime), "100"]
+        for pid, process in enumerate(processes, start=1000):
+            ticks = int(50 * uptime)
+            lines += [
+                "#{} {}".format(process, pid),
+                "{} ({}) S 1 {} {} 0 -1 4202752 1000 0 0 0 {} {} 0 0 20 0 "
+                "24 0 1000 1073741824 25600".format(pid, process, pid, pid,
+                                                    ticks, ticks // 4),
+                "Name:\t{}".format(process),
+                "VmSize:\t 1048576 kB",
+                "VmRSS:\t  102400 kB",
+                "Threads:\t24",
+                "voluntary_ctxt_switches:\t{}".format(int(300 * uptime)),
+                "nonvoluntary_ctxt_switches:\t{}".format(int(20 * uptime)),
+                "rchar: {}".format(int(10 ** 6 * uptime)),
+                "read_bytes: {}".format(int(4096 * uptime)),
+                "write_bytes: {}".format(int(8192 * uptime)),
+            ]
+        return "\n".join(lines)
+
+    def _get_diskstats(self):
+        uptime = self._get_uptime()
+        lines = ["{:.2f} 4000.00".format(uptime)]
+        for minor, device in enumerate(("sda", "sda1", "sdb", "sdb1")):
+            values = [int(rate * uptime) for rate in
+                      (100, 1, 800, 50, 200, 2, 1600, 90, 0, 400, 140)]
+            lines.append("   8 {:7} {} {}".format(
+                minor, device, " ".join(str(v) for v in values)))
+        return "\n".join(lines)
+
+    def _get_net(self):
+        uptime = self._get_uptime()
+        values = [int(rate * uptime) for rate in
+                  (10 ** 7, 10 ** 4, 0, 0, 0, 0, 0, 0,
+                   2 * 10 ** 7, 2 * 10 ** 4, 0, 0, 0, 0, 0, 0)]
+        return "{:.2f} 4000.00\n  eth0: {}".format(
+            uptime, " ".join(str(v) for v in values))
+
+    def _get_output(self, command):
+        if "getconf CLK_TCK" in command:
+            return self._get_ps(self.PROCESS.findall(command))
+        if "/proc/diskstats" in command:
+            return self._get_diskstats()
+        if command.startswith("mount"):
+            return "/dev/sdb1 on /data type ext4 (rw)"
+        if command.startswith("basename"):
+            return "sdb1"
+        if "/proc/net/dev" in command:
+            if command.startswith("grep"):
+                return None if "eth0" not in command else "eth0:"
+            return self._get_net()
+        if command == "cat /proc/net/tcp":
+            return self.tcp
+        if command.startswith("typeperf"):
+            return '"04/01/2014 10:00:00.000","{0}","{0}","{0}","{0}"'.format(
+                104857600)
+
+    def run_many(self, commands):
+        from cbagent.collectors.libstats.transport import RemoteResult
+        results = []
+        for command in commands:
+            output = self._get_output(command)
+            results.append(RemoteResult(output or "", int(output is None)))
+        return results
+
+    def run(self, command):
+        return self.run_many([command])[0]
+
+
+def install_ssh():
+    """Route commands of all remote stats to FakeTransport."""
+    from cbagent.collectors.libstats.remotestats import RemoteStats
+    RemoteStats.get_transport = lambda self, host: FakeTransport.get(host)
+
+
+class Result(object):
+
+    def __init__(self, value=None, success=True, cas=0, key=None):
+        self.value = value
+        self.success = success
+        self.cas = cas
+        self.key = key
+
+
+class ObserveInfo(object):
+
+    def __init__(self, flags):
+        self.flags = flags
+
+
+class FakeBucket(object):
+
+    """In-memory couchbase client. Buckets of the same name share data on
+    all hosts, so writes are persisted, replicated and indexed (or arrive at
+    XDCR destination) instantly."""
+
+    _buckets = {}
+
+    _lock = Lock()
+
+    def __init__(self, bucket, **kwargs):
+        self.bucket = bucket
+        with self._lock:
+            self.data = self._buckets.setdefault(bucket, {})
+
+    def set(self, key, value, cas=0):
+        self.data[key] = value
+        return Result(cas=1)
+
+    def get(self, key, quiet=False):
+        if key in self.data:
+            return Result(self.data[key], cas=1)
+        if not quiet:
+            raise KeyError(key)
+        return Result(success=False)
+
+    def delete(self, key, quiet=False):
+        if self.data.pop(key, None) is None and not quiet:
+            raise KeyError(key)
+        return Result()
+
+    def set_multi(self, items):
+        return dict((key, self.set(key, value))
+                    for key, value in items.items())
+
+    def get_multi(self, keys, quiet=False):
+        return dict((key, self.get(key, quiet)) for key in keys)
+
+    def delete_multi(self, keys, quiet=False):
+        return dict((key, self.delete(key, quiet)) for key in keys)
+
+    def observe_multi(self, keys):
+        from couchbase.user_constants import OBS_NOTFOUND, OBS_PERSISTED
+        flags = lambda key: key in self.data and OBS_PERSISTED or \
+            OBS_NOTFOUND
+        return dict((key, Result([ObserveInfo(flags(key)),
+                                  ObserveInfo(flags(key))]))
+                    for key in keys)
+
+    def query(self, design, view, mapkey_multi=()):
+        return [Result(key=key) for key in mapkey_multi if key in self.data]
+
+
+def install_client():
+    """Replace couchbase connections of latency collectors with FakeBucket.
+    Pool connections get bookkeeping methods of the real wrapper."""
+    from cbagent.collectors import latency
+    from cbagent.collectors.libstats import pool
+    from cbagent.clock import monotonic
+
+    class Couchbase(object):
+
+        @staticmethod
+        def connect(**kwargs):
+            return FakeBucket(**kwargs)
+
+    class FakeConnection(FakeBucket):
+
+        HEALTH_CHECK_KEY = pool.ConnectionWrapper.HEALTH_CHECK_KEY
+
+        def __init__(self, **kwargs):
+            FakeBucket.__init__(self, **kwargs)
+            self.use_count = 0
+            self.use_time = 0
+            self.last_use_time = 0
+            self.idle_since = monotonic()
+
+    for name in ("start_using", "stop_using", "is_healthy"):
+        setattr(FakeConnection, name, pool.ConnectionWrapper.__dict__[name])
+    FakeConnection.close = lambda self: None
+
+    latency.Couchbase = Couchbase
+    pool.ConnectionWrapper = FakeConnection
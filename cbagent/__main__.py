@@ -11,8 +11,45 @@ from cbagent.collectors.ps import PS
 from cbagent.collectors.typeperf import TypePerf
 from cbagent.collectors.sync_gateway import SyncGateway
 from cbagent.collectors.xdcr_lag import XdcrLag
+from cbagent.runtime import Runtime
 from cbagent.settings import Settings
 
+COLLECTORS = (
+    ("active_tasks", ActiveTasks),
+    ("iostat", IO),
+    ("latency", Latency),
+    ("observe", ObserveLatency),
+    ("net", Net),
+    ("ns_server", NSServer),
+    ("ps", PS),
+    ("typeperf", TypePerf),
+    ("sync_gateway", SyncGateway),
+    ("xdcr_lag", XdcrLag),
+)
+
+
+def get_collectors(options, settings):
+    """Collectors selected by CLI flags take precedence over "collectors"
+    list from configuration file. List items are either collector names or
+    objects like {"name": "ns_server", "interval": 5}."""
+    known = dict(COLLECTORS)
+
+    selected = [(name, None) for name, _ in COLLECTORS
+                if getattr(options, name)]
+    if not selected:
+        for item in getattr(settings, "collectors", None) or []:
+            if isinstance(item, dict):
+                selected.append((item["name"], item.get("interval")))
+            else:
+                selected.append((item, None))
+
+    collectors = []
+    for name, interval in selected:
+        if name not in known:
+            sys.exit("Unknown collector: {}".format(name))
+        collectors.append((known[name], interval))
+    return collectors
+
 
 def main():
     parser = OptionParser(prog="cbagent")
@@ -31,6 +68,8 @@ def main():
                       help="ns_server")
     parser.add_option("--ps", action="store_true", dest="ps",
                       help="ps CPU, RSS and VSIZE")
+    parser.add_option("--tp", action="store_true", dest="typeperf",
+                      help="typeperf RSS (Windows)")
     parser.add_option("--sg", action="store_true", dest="sync_gateway",
                       help="Sync Gateway")
     parser.add_option("--x", action="store_true", dest="xdcr_lag",
@@ -41,35 +80,15 @@ def main():
     if not args:
         sys.exit("No configuration provided")
 
-    if options.active_tasks:
-        collector = ActiveTasks
-    elif options.iostat:
-        collector = IO
-    elif options.latency:
-        collector = Latency
-    elif options.observe:
-        collector = ObserveLatency
-    elif options.net:
-        collector = Net
-    elif options.ns_server:
-        collector = NSServer
-    elif options.ps:
-        collector = PS
-    elif options.typeperf:
-        collector = TypePerf
-    elif options.sync_gateway:
-        collector = SyncGateway
-    elif options.xdcr_lag:
-        collector = XdcrLag
-    else:
-        sys.exit("No collector selected")
-
     settings = Settings()
     settings.read_cfg(args[0])
 
-    collector = collector(settings)
-    collector.update_metadata()
-    collector.collect()
+    collectors = get_collectors(options, settings)
+    if not collectors:
+        sys.exit("No collector selected")
+
+    runtime = Runtime(settings, collectors)
+    runtime.run()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,47 @@
+import ctypes
+import ctypes.util
+
+CLOCK_MONOTONIC = 1  # Linux
+
+CLOCK_THREAD_CPUTIME_ID = 3
+
+
+class _Timespec(ctypes.Structure):
+
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or
+                                 "librt.so.1").clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError):  # not Linux
+    _clock_gettime = None
+
+
+def _get_clock(clock_id):
+    def clock():
+        ts = _Timespec()
+        if _clock_gettime(clock_id, ctypes.byref(ts)):
+            raise OSError(ctypes.get_errno())
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return clock
+
+
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    if _clock_gettime is not None:
+        monotonic = _get_clock(CLOCK_MONOTONIC)
+        monotonic.__doc__ = "Monotonic high-resolution clock, in seconds."
+    else:  # fall back to wall clock
+        from time import time as monotonic
+
+try:
+    from time import thread_time
+except ImportError:  # Python < 3.7
+    if _clock_gettime is not None:
+        thread_time = _get_clock(CLOCK_THREAD_CPUTIME_ID)
+        thread_time.__doc__ = "CPU time of the current thread, in seconds."
+    else:  # fall back to process CPU time
+        from time import clock as thread_time
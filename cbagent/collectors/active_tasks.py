@@ -13,13 +13,14 @@ class ActiveTasks(Collector):
     def _get_tasks(self):
         bucket_compaction_tasks = {}
 
+        buckets = self.get_buckets_async()  # fetched in parallel with tasks
         for task in self.get_http(path="/pools/default/tasks"):
             if task["type"] == "bucket_compaction":
                 bucket_compaction_tasks[task["bucket"]] = task["progress"]
             elif task["type"] == "rebalance":
                 yield "rebalance_progress", task.get("progress", 0), None
 
-        for bucket in self.get_buckets():
+        for bucket in buckets.get():
             progress = bucket_compaction_tasks.get(bucket, 0)
             yield "bucket_compaction_progress", progress, bucket
 
@@ -28,4 +29,5 @@ class ActiveTasks(Collector):
             self.update_metric_metadata(metrics=(task, ), bucket=bucket)
             self.store.append(data={task: progress},
                               cluster=self.cluster, bucket=bucket,
-                              collector=self.COLLECTOR)
+                              collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
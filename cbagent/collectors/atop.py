@@ -13,9 +13,10 @@ class Atop(Collector):
         super(Atop, self).__init__(settings)
         self.ssh_username = settings.ssh_username
         self.ssh_password = settings.ssh_password
-        self.atop = AtopStats(hosts=tuple(self.get_nodes()),
+        self.atop = AtopStats(hosts=tuple(self.nodes),
                               user=settings.ssh_username,
                               password=settings.ssh_password)
+        self.atop.instrumentation = self.instrumentation
 
     def restart(self):
         self.atop.restart_atop()
@@ -25,7 +26,7 @@ class Atop(Collector):
 
     def update_metadata(self):
         self.mc.add_cluster()
-        for node in self.get_nodes():
+        for node in self.nodes:
             self.mc.add_server(node)
             for metric in self.METRICS:
                 self.mc.add_metric(metric, server=node,
@@ -43,30 +44,11 @@ class Atop(Collector):
         else:
             return float(value)
 
-    def _format_data(self, data):
-        sample = dict()
-        for node, (title, value) in data.iteritems():
-            sample[node] = sample.get(node, dict())
-            sample[node][title] = self._remove_value_units(value)
-        return sample
-
-    def _extend_samples(self, data):
-        data = self._format_data(data)
-        if not self._samples:
-            self._samples = data
-        else:
-            for node in self._samples:
-                self._samples[node].update(data[node])
-
     def sample(self):
-        self._samples = {}
-        self._extend_samples(self.atop.get_process_rss("beam.smp"))
-        self._extend_samples(self.atop.get_process_vsize("beam.smp"))
-        self._extend_samples(self.atop.get_process_rss("memcached"))
-        self._extend_samples(self.atop.get_process_vsize("memcached"))
-        self._extend_samples(self.atop.get_process_cpu("beam.smp"))
-        self._extend_samples(self.atop.get_process_cpu("memcached"))
-
-        for node, samples in self._samples.iteritems():
+        processes = ("beam.smp", "memcached")
+        for node, samples in self.atop.get_samples(processes).iteritems():
+            samples = dict((title, self._remove_value_units(value))
+                           for title, value in samples.iteritems())
             self.store.append(samples, cluster=self.cluster, server=node,
-                              collector=self.COLLECTOR)
+                              collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
@@ -1,13 +1,14 @@
-import socket
 import sys
 import time
-from threading import Thread
+from multiprocessing.pool import ThreadPool
 
 import requests
 from logger import logger
 
-from cbagent.stores import SerieslyStore
-from cbagent.metadata_client import MetadataClient
+from cbagent.clock import monotonic, thread_time
+from cbagent.rates import Rates
+from cbagent.runtime import Context
+from cbagent.scheduler import Scheduler
 
 
 class Collector(object):
@@ -15,11 +16,8 @@ class Collector(object):
     COLLECTOR = None
 
     def __init__(self, settings):
-        self.session = requests.Session()
+        self._init_context(settings)
 
-        self.interval = settings.interval
-
-        self.cluster = settings.cluster
         self.master_node = settings.master_node
         self.auth = (settings.rest_username, settings.rest_password)
 
@@ -27,96 +25,287 @@ class Collector(object):
         self.hostnames = settings.hostnames
         self.nodes = list(self.get_nodes())
 
-        self.store = SerieslyStore(settings.seriesly_host)
-        self.mc = MetadataClient(settings)
+    def _init_context(self, settings):
+        """Shared resources and per-collector state which don't depend on
+        Couchbase REST API, also used by collectors of other services."""
+        self.context = getattr(settings, "context", None) or Context(settings)
+        self.http = self.context.http
+        self.session = self.context.session
+        self.instrumentation = self.context.instrumentation
+
+        self.interval = settings.interval
+        self.cluster = settings.cluster
 
-        self.metrics = set()
-        self.updater = None
+        self.topology = self.context.topology
+        self.store = self.context.store
+        self.history = self.context.history
+        self.mc = self.context.mc
+        self.registry = self.context.registry
+        self.rates = Rates()
 
-    def get_http(self, path, server=None, port=8091):
-        server = server or self.master_node
+        # timestamp of the current tick, shared by all points of a sample
+        self.timestamp = None
+
+    def _get(self, path, server, port, decode=None):
+        """Single request (with HTTP client retries), raises
+        RequestException on failure. decode is an optional function which
+        is given the raw response body instead of using r.json()."""
         url = "http://{}:{}{}".format(server, port, path)
+        endpoint = self._get_endpoint(path)
+        with self.instrumentation.timer(endpoint):
+            r = self.http.get(url, auth=self.auth)
+        if r.status_code not in (200, 201, 202):
+            raise requests.HTTPError("Bad response: {}".format(url))
+        self.instrumentation.incr(endpoint + "_bytes", len(r.content))
+        with self.instrumentation.timer(endpoint + "_parse"):
+            if decode is not None:
+                return decode(r.content)
+            return r.json()
+
+    def get_http(self, path, server=None, port=8091, decode=None):
+        """GET path from the master node (or from given server). When the
+        master node fails, the request is repeated once after failover.
+        Requests to specific nodes fail immediately, so a dead node doesn't
+        delay the rest of the sample."""
+        master_node = self.master_node
         try:
-            r = self.session.get(url=url, auth=self.auth)
-            if r.status_code in (200, 201, 202):
-                return r.json()
-            else:
-                logger.warn("Bad response: {}".format(url))
-                return self.retry(path, server, port)
-        except requests.ConnectionError:
-            logger.warn("Connection error: {}".format(url))
-            return self.retry(path, server, port)
-
-    def retry(self, path, server=None, port=8091):
-        time.sleep(self.interval)
-        for node in self.nodes:
-            if self._check_node(node):
-                self.master_node = node
-                self.nodes = list(self.get_nodes())
-                break
-        else:
-            logger.interrupt("Failed to find at least one node")
-        if server not in self.nodes:
-            raise RuntimeError("Bad node {}".format(server or ""))
-        else:
-            return self.get_http(path, server, port)
-
-    def _check_node(self, node):
+            return self._get(path, server or master_node, port, decode)
+        except requests.RequestException as e:
+            logger.warn("Request failed: {}".format(e))
+            self.topology.invalidate()
+            if server is not None or not self._failover(master_node):
+                raise
+            return self._get(path, self.master_node, port, decode)
+
+    @staticmethod
+    def _get_endpoint(path):
+        """Name of REST endpoint for agent's own metrics, with bucket and
+        node names left out: /pools/default/buckets/X/stats -> rest_stats.
+        """
+        segments = path.split("?")[0].strip("/").split("/")
+        return "rest_" + (segments[-1] if len(segments) > 2 else
+                          "_".join(segments))
+
+    def _probe(self, node):
+        """Return /pools latency of a node or None if it's not available."""
+        t0 = monotonic()
+        try:
+            r = self.http.get("http://{}:8091/pools".format(node),
+                              auth=self.auth, retries=0)
+            if r.status_code == 200 and r.json().get("pools"):
+                return monotonic() - t0
+        except (requests.RequestException, ValueError):
+            pass
+
+    def _failover(self, failed):
+        """Probe all nodes in parallel and make the one which answers the
+        fastest the master node, unless the failed master is still
+        available. Nodes are probed outside of the topology lock, so other
+        collectors aren't blocked by a slow probe. Return True if the master
+        node has changed."""
+        with self.topology.lock:
+            if self.master_node != failed:
+                return True  # another thread has already failed over
+        nodes = list(set(getattr(self, "nodes", ())) | {failed})
+        pool = ThreadPool(len(nodes))
         try:
-            s = socket.socket()
-            s.connect((node, 8091))
-        except socket.error:
+            latencies = dict(zip(nodes, pool.map(self._probe, nodes)))
+        finally:
+            pool.close()
+        if latencies[failed] is not None:
             return False
-        else:
-            if not self.get_http(path="/pools", server=node).get("pools"):
-                return False
+        available = sorted((latency, node) for node, latency
+                           in latencies.items() if latency is not None)
+        if not available:
+            raise requests.ConnectionError("Failed to find at least one node")
+
+        with self.topology.lock:
+            if self.master_node != failed:
+                return True  # another thread has failed over meanwhile
+            self.master_node = available[0][1]
+        logger.info("Master node failover: {} -> {}".format(
+            failed, self.master_node))
+        self.instrumentation.incr(self.COLLECTOR + "_failovers")
+        self.nodes = list(self.get_nodes())
         return True
 
+    def _check_topology(self):
+        """Drop cached topology if cluster revision has changed since the
+        last check. Returns /pools/default if it was fetched."""
+        with self.topology.lock:
+            if time.time() - self.topology.checked_at < self.topology.ttl:
+                return
+            self.topology.checked_at = time.time()  # one check per ttl
+        pool = self.get_http(path="/pools/default")
+        signature = self.topology.get_signature(pool)
+        with self.topology.lock:
+            if signature != self.topology.signature:
+                if self.topology.signature is not None:
+                    logger.info("Cluster topology has changed")
+                self.topology.invalidate()
+                self.topology.signature = signature
+                self.topology.checked_at = time.time()
+        return pool
+
+    def _get_all_nodes(self):
+        pool = self._check_topology()
+        with self.topology.lock:
+            generation, nodes = self.topology.generation, self.topology.nodes
+        if nodes is None:
+            pool = pool or self.get_http(path="/pools/default")
+            nodes = [node["hostname"].split(":")[0] for node in pool["nodes"]]
+            self.topology.update(generation, nodes=nodes)
+        return nodes
+
+    def _get_all_buckets(self):
+        self._check_topology()
+        with self.topology.lock:
+            generation = self.topology.generation
+            buckets = self.topology.buckets
+        if buckets is None:
+            buckets = [(bucket["name"], bucket["stats"]) for bucket
+                       in self.get_http(path="/pools/default/buckets")]
+            self.topology.update(generation, buckets=buckets)
+        return buckets
+
     def get_buckets(self, with_stats=False):
-        buckets = self.get_http(path="/pools/default/buckets")
-        if not buckets:
-            buckets = self.retry(path="/pools/default/buckets")
-        for bucket in buckets:
-            if self.buckets is not None and bucket["name"] not in self.buckets:
+        for bucket, stats in self._get_all_buckets():
+            if self.buckets is not None and bucket not in self.buckets:
                 continue
             if with_stats:
-                yield bucket["name"], bucket["stats"]
+                yield bucket, stats
             else:
-                yield bucket["name"]
+                yield bucket
 
     def get_nodes(self):
-        pool = self.get_http(path="/pools/default")
-        for node in pool["nodes"]:
-            hostname = node["hostname"].split(":")[0]
+        for hostname in self._get_all_nodes():
             if self.hostnames is not None and hostname not in self.hostnames:
                 continue
             yield hostname
 
-    def _update_metric_metadata(self, metrics, bucket=None, server=None):
-        for metric in metrics:
-            metric = metric.replace('/', '_')
-            metric_hash = hash((metric, bucket, server))
-            if metric_hash not in self.metrics:
-                self.metrics.add(metric_hash)
-                self.mc.add_metric(metric, bucket, server, self.COLLECTOR)
-
-    def update_metric_metadata(self, *args, **kwargs):
-        if self.updater is None or not self.updater.is_alive():
-            self.updater = Thread(
-                target=self._update_metric_metadata, args=args, kwargs=kwargs
-            )
-            self.updater.daemon = True
-            self.updater.start()
+    def get_stats_uris(self):
+        """Yield (uri, bucket, host) tuples for cluster-wide (host is None)
+        and per-node stats of every bucket. Per-node URIs are cached in
+        topology, missing ones are fetched concurrently."""
+        with self.topology.lock:
+            generation = self.topology.generation
+        buckets = list(self.get_buckets(with_stats=True))
+        with self.topology.lock:
+            node_stats = dict(self.topology.node_stats)
+        missing = [(bucket, stats) for bucket, stats in buckets
+                   if bucket not in node_stats]
+        stats_lists = self.get_http_all(
+            [stats["nodeStatsListURI"] for _, stats in missing]
+        )
+        fetched = {}
+        for (bucket, _), stats_list in zip(missing, stats_lists):
+            fetched[bucket] = node_stats[bucket] = [
+                (server["hostname"].split(":")[0], server["stats"]["uri"])
+                for server in stats_list["servers"]
+            ]
+        if fetched:
+            self.topology.update(generation, node_stats=fetched)
+
+        for bucket, stats in buckets:
+            yield stats["uri"], bucket, None  # cluster wide
+            for host, uri in node_stats.get(bucket, ()):
+                yield uri, bucket, host  # server specific
+
+    def _get_http_limited(self, path, server=None, port=8091, decode=None):
+        with self.context.semaphore(server or self.master_node):
+            return self.get_http(path, server, port, decode)
+
+    def get_http_async(self, path, server=None, port=8091, decode=None):
+        """Schedule get_http in the shared worker pool. Number of concurrent
+        requests per host is limited by settings.rest_concurrency. Returns
+        AsyncResult, get() re-raises request errors."""
+        return self.context.pool.apply_async(self._get_http_limited,
+                                             (path, server, port, decode))
+
+    def get_http_all(self, paths, server=None, port=8091,
+                     ignore_errors=False, decode=None):
+        """Fetch several paths concurrently. Results keep order of paths, so
+        total wall time is bounded by the slowest request rather than by the
+        sum of all round trips. With ignore_errors failed requests yield
+        None instead of raising."""
+        results = [self.get_http_async(path, server, port, decode)
+                   for path in paths]
+        responses = []
+        for result in results:
+            try:
+                responses.append(result.get())
+            except requests.RequestException:
+                if not ignore_errors:
+                    raise
+                responses.append(None)
+        return responses
+
+    def get_buckets_async(self, with_stats=False):
+        return self.context.pool.apply_async(
+            lambda: list(self.get_buckets(with_stats)))
+
+    def get_nodes_async(self):
+        return self.context.pool.apply_async(lambda: list(self.get_nodes()))
+
+    def update_metric_metadata(self, metrics, bucket=None, server=None):
+        series = self.registry.get_series(self.cluster, server, bucket,
+                                          self.COLLECTOR)
+        metrics = [metric for metric in metrics
+                   if metric not in series.registered]
+        for metric, name in zip(metrics, self.registry.normalize(metrics)):
+            series.registered.add(metric)
+            self.mc.add_metric(name, bucket, server, self.COLLECTOR)
+
+    def get_rates(self, counters, server=None, bucket=None, timestamp=None,
+                  wrapping=()):
+        """Per-second rates of raw counters since the previous sample of the
+        same series. Timestamp defaults to the monotonic clock of the agent;
+        counters read over SSH are better paired with uptime of the host, so
+        network latency doesn't distort the rates. wrapping lists 32-bit
+        counters which may wrap around, decreases of other counters are
+        treated as resets."""
+        if timestamp is None:
+            timestamp = monotonic()
+        return self.rates.update((server, bucket), counters, timestamp,
+                                 wrapping)
 
     def sample(self):
         raise NotImplementedError
 
+    def _sample(self, timestamp=None):
+        """sample() with wall and CPU time accounting."""
+        self.timestamp = timestamp
+        t0, cpu0 = monotonic(), thread_time()
+        try:
+            self.sample()
+        except Exception:
+            self.instrumentation.incr(self.COLLECTOR + "_errors")
+            raise
+        finally:
+            wall = monotonic() - t0
+            self.instrumentation.timing(self.COLLECTOR + "_sample_wall", wall)
+            self.instrumentation.timing(self.COLLECTOR + "_sample_cpu",
+                                        thread_time() - cpu0)
+            if wall > self.interval:
+                self.instrumentation.incr(self.COLLECTOR + "_overruns")
+
+    def _wait(self, scheduler):
+        """Sleep until the next tick of the schedule, return its timestamp."""
+        timestamp, lateness, skipped = scheduler.wait()
+        self.instrumentation.timing(self.COLLECTOR + "_lateness", lateness)
+        if skipped:
+            self.instrumentation.incr(self.COLLECTOR + "_skipped", skipped)
+        return timestamp
+
     def collect(self):
+        scheduler = Scheduler(self.interval,
+                              splay=self.context.splay,
+                              overrun=self.context.overrun)
         while True:
             try:
-                self.sample()
-                time.sleep(self.interval)
+                self._sample(self._wait(scheduler))
             except KeyboardInterrupt:
+                self.store.flush(timeout=self.interval)
                 sys.exit()
             except Exception as e:
                 logger.warn(e)
@@ -10,10 +10,11 @@ class IO(Collector):
         super(IO, self).__init__(settings)
         self.ssh_username = settings.ssh_username
         self.ssh_password = settings.ssh_password
-        self.nodes = settings.hostnames or list(self.get_nodes())
+        self.nodes = settings.hostnames or self.nodes
         self.io = IOstat(hosts=self.nodes,
                          user=settings.ssh_username,
                          password=settings.ssh_password)
+        self.io.instrumentation = self.instrumentation
         self.partitions = settings.partitions
 
     def update_metadata(self):
@@ -22,9 +23,15 @@ class IO(Collector):
             self.mc.add_server(node)
 
     def sample(self):
-        for node, stats in self.io.get_samples(self.partitions).items():
+        samples = self.io.get_samples(self.partitions)
+        for node, (uptime, counters) in samples.items():
+            # diskstats fields are unsigned long, 32 bits on 32-bit kernels
+            rates = self.get_rates(counters, server=node, timestamp=uptime,
+                                   wrapping=counters)
+            stats = self.io.get_metrics(rates, self.partitions)
             if stats:
                 self.update_metric_metadata(stats.keys(), server=node)
                 self.store.append(stats,
                                   cluster=self.cluster, server=node,
-                                  collector=self.COLLECTOR)
+                                  collector=self.COLLECTOR,
+                                  timestamp=self.timestamp)
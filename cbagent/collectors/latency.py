@@ -1,9 +1,11 @@
-from time import time
 from uuid import uuid4
 
 from couchbase import Couchbase
 
+from cbagent.clock import monotonic
 from cbagent.collectors import Collector
+from cbagent.collectors.libstats.histogram import Histogram
+from cbagent.collectors.libstats.probe import OpenLoopProbe
 
 uhex = lambda: uuid4().hex
 
@@ -14,6 +16,12 @@ class Latency(Collector):
 
     METRICS = ("latency_set", "latency_get", "latency_delete")
 
+    OPS = ("set", "get", "delete", "cas")  # supported by execute()
+
+    DEFAULT_VALUE_SIZE = 32
+
+    PROBE_KEYSPACE = 1000
+
     def __init__(self, settings):
         super(Latency, self).__init__(settings)
         self.clients = []
@@ -22,32 +30,128 @@ class Latency(Collector):
                 bucket=bucket, host=settings.master_node,
                 username=bucket, password=settings.bucket_password
             ))
+        self.init_probes(settings)
+
+    def init_probes(self, settings):
+        # Number of set/get/delete sequences per bucket and interval. With
+        # more than one probe latency distribution is reported.
+        self.probes = getattr(settings, "latency_probes", 1)
+
+        # Open-loop mode: target ops/sec per bucket, operation mix and a
+        # sweep of value sizes.
+        self.rate = getattr(settings, "latency_rate", 0)
+        self.mix = getattr(settings, "latency_mix", None) or dict(
+            (metric.replace("latency_", ""), 1) for metric in self.METRICS
+        )
+        unsupported = sorted(set(self.mix) - set(self.OPS))
+        if self.rate and unsupported:
+            raise ValueError("Unsupported latency_mix operations: {}".format(
+                ", ".join(unsupported)))
+        self.sizes = getattr(settings, "latency_sizes", None) or \
+            [self.DEFAULT_VALUE_SIZE]
+        self.open_loop_probes = []
+
+    def get_clients(self):
+        return [(client.bucket, client) for client in self.clients]
+
+    def _get_prefix(self, op, size):
+        prefix = "latency_{}".format(op)
+        if len(self.sizes) > 1:
+            prefix += "_{}".format(size)
+        return prefix
+
+    def get_metrics(self):
+        if self.rate:
+            return tuple(name for op in self.mix for size in self.sizes
+                         for name in Histogram.metrics(
+                             self._get_prefix(op, size))) + \
+                ("latency_errors", )
+        if self.probes > 1:
+            return tuple(name for metric in self.METRICS
+                         for name in Histogram.metrics(metric))
+        return self.METRICS
 
     def update_metadata(self):
         self.mc.add_cluster()
         for bucket in self.get_buckets():
             self.mc.add_bucket(bucket)
-            for metric in self.METRICS:
+            for metric in self.get_metrics():
                 self.mc.add_metric(metric, bucket=bucket,
                                    collector=self.COLLECTOR)
 
     @staticmethod
     def _measure_latency(client, metric, key):
-        t0 = time()
+        t0 = monotonic()
         if metric == "latency_set":
             client.set(key, key)
         elif metric == "latency_get":
             client.get(key)
         elif metric == "latency_delete":
             client.delete(key)
-        return 1000 * (time() - t0)  # Latency in ms
+        return 1000 * (monotonic() - t0)  # Latency in ms
 
-    def sample(self):
-        for client in self.clients:
+    def _probe(self, client):
+        histograms = dict((metric, Histogram()) for metric in self.METRICS)
+        for _ in range(self.probes):
             key = uhex()
-            samples = {}
             for metric in self.METRICS:
                 latency = self._measure_latency(client, metric, key)
-                samples[metric] = latency
+                histograms[metric].record(1000 * latency)  # ms -> us
+        samples = {}
+        for metric, histogram in histograms.items():
+            samples.update(histogram.summary(metric, scale=0.001))  # us -> ms
+        return samples
+
+    def execute(self, client, op, size, n):
+        """Single open-loop operation against a rotating set of keys."""
+        key = "latency_{}_{}".format(size, n % self.PROBE_KEYSPACE)
+        value = "x" * size
+        if op == "set":
+            client.set(key, value)
+        elif op == "get":
+            client.get(key, quiet=True)
+        elif op == "delete":
+            client.delete(key, quiet=True)
+        elif op == "cas":
+            cas = client.get(key, quiet=True).cas
+            client.set(key, value, cas=cas)
+        else:
+            raise ValueError("Unsupported operation: {}".format(op))
+
+    def _start_open_loop_probes(self):
+        for bucket, client in self.get_clients():
+            execute = lambda op, size, n, client=client: \
+                self.execute(client, op, size, n)
+            probe = OpenLoopProbe(execute, self.rate, self.mix, self.sizes)
+            probe.start()
+            self.open_loop_probes.append((bucket, probe))
+
+    def _sample_open_loop(self):
+        if not self.open_loop_probes:
+            self._start_open_loop_probes()
+            return  # first interval is not complete yet
+        for bucket, probe in self.open_loop_probes:
+            histograms, errors = probe.snapshot()
+            samples = {"latency_errors": errors}
+            for (op, size), histogram in histograms.items():
+                samples.update(histogram.summary(self._get_prefix(op, size),
+                                                 scale=0.001))  # us -> ms
+            self.store.append(samples, cluster=self.cluster,
+                              bucket=bucket, collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
+
+    def sample(self):
+        if self.rate:
+            return self._sample_open_loop()
+        for client in self.clients:
+            if self.probes > 1:
+                samples = self._probe(client)
+            else:
+                key = uhex()
+                samples = {}
+                for metric in self.METRICS:
+                    latency = self._measure_latency(client, metric, key)
+                    samples[metric] = latency
             self.store.append(samples, cluster=self.cluster,
-                              bucket=client.bucket, collector=self.COLLECTOR)
+                              bucket=client.bucket, collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
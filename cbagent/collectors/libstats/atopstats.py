@@ -1,9 +1,7 @@
 from uuid import uuid4
 
-from fabric.api import run
-
 from cbagent.collectors.libstats.remotestats import (
-    RemoteStats, multi_node_task, single_node_task)
+    RemoteStats, multi_node_task, run, run_many, single_node_task)
 
 
 class AtopStats(RemoteStats):
@@ -22,8 +20,7 @@ class AtopStats(RemoteStats):
 
     @multi_node_task
     def start_atop(self):
-        run("nohup atop -a -w {} 5 > /dev/null 2>&1 &".format(self.logfile),
-            pty=False)
+        run("nohup atop -a -w {} 5 > /dev/null 2>&1 &".format(self.logfile))
 
     @single_node_task
     def update_columns(self):
@@ -51,27 +48,27 @@ class AtopStats(RemoteStats):
         return output.split().index("CPU")
 
     @staticmethod
-    def _get_metric(cmd, column):
-        result = run(cmd)
+    def _parse_column(result, column):
         if not result.return_code:
             return result.split()[column]
-        else:
-            return None
-
-    @multi_node_task
-    def get_process_cpu(self, process):
-        title = process + "_cpu"
-        cmd = "{} | grep {}".format(self._base_cmd, process)
-        return title, self._get_metric(cmd, self._cpu_column)
-
-    @multi_node_task
-    def get_process_vsize(self, process):
-        title = process + "_vsize"
-        cmd = "{} -m | grep {}".format(self._base_cmd, process)
-        return title, self._get_metric(cmd, self._vsize_column)
 
     @multi_node_task
-    def get_process_rss(self, process):
-        title = process + "_rss"
-        cmd = "{} -m | grep {}".format(self._base_cmd, process)
-        return title, self._get_metric(cmd, self._rss_column)
+    def get_samples(self, processes):
+        """CPU, RSS and VSIZE of all processes, atop commands run
+        concurrently on the host."""
+        commands = []
+        for process in processes:
+            commands.append("{} | grep {}".format(self._base_cmd, process))
+            commands.append("{} -m | grep {}".format(self._base_cmd, process))
+        results = run_many(commands)
+
+        samples = {}
+        for i, process in enumerate(processes):
+            cpu, mem = results[2 * i], results[2 * i + 1]
+            samples[process + "_cpu"] = self._parse_column(cpu,
+                                                           self._cpu_column)
+            samples[process + "_rss"] = self._parse_column(mem,
+                                                           self._rss_column)
+            samples[process + "_vsize"] = self._parse_column(
+                mem, self._vsize_column)
+        return samples
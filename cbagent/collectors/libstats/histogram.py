@@ -0,0 +1,112 @@
+from threading import Lock
+
+
+class Histogram(object):
+
+    """HDR-style histogram of non-negative integer values (e.g., latency in
+    microseconds).
+
+    Values below 2 ** precision are counted exactly, larger values go to
+    log-linear buckets: every power of two is split into 2 ** (precision - 1)
+    equal sub-buckets, so relative error doesn't exceed 2 ** (1 - precision)
+    (< 1.6% by default). Memory is fixed by precision and max_value, values
+    above max_value are clamped. Exact min, max and sum are tracked
+    separately. Histograms with identical parameters can be merged.
+    """
+
+    PERCENTILES = ((50, "p50"), (90, "p90"), (99, "p99"), (99.9, "p999"))
+
+    def __init__(self, precision=7, max_value=2 ** 36):
+        self.precision = precision
+        self.max_value = max_value
+        self.sub_buckets = 2 ** precision
+        self.half = self.sub_buckets // 2
+        self.counts = [0] * (self._index(max_value) + 1)
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.precision
+        return self.sub_buckets + (shift - 1) * self.half + \
+            (value >> shift) - self.half
+
+    def _value(self, index):
+        """Middle of the value range of given bucket."""
+        if index < self.sub_buckets:
+            return index
+        shift, sub_bucket = divmod(index - self.sub_buckets, self.half)
+        shift += 1
+        low = (sub_bucket + self.half) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            value = 0
+        with self._lock:
+            self.counts[self._index(min(value, self.max_value))] += count
+            self.count += count
+            self.total += value * count
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        with self._lock:
+            for i, count in enumerate(other.counts):
+                if count:
+                    self.counts[i] += count
+            self.count += other.count
+            self.total += other.total
+            for attr, func in (("min", min), ("max", max)):
+                values = [v for v in (getattr(self, attr),
+                                      getattr(other, attr)) if v is not None]
+                if values:
+                    setattr(self, attr, func(values))
+
+    def percentile(self, percentile):
+        if not self.count:
+            return None
+        rank = max(1, int(round(percentile / 100.0 * self.count)))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(max(self._value(i), self.min), self.max)
+
+    def mean(self):
+        if self.count:
+            return float(self.total) / self.count
+
+    def summary(self, prefix, scale=1.0):
+        """Percentiles, min, max, mean and count as a flat dictionary. Values
+        (except count) are multiplied by scale, e.g. 0.001 for us -> ms."""
+        if not self.count:
+            return {}
+        summary = {prefix: self.mean() * scale,
+                   prefix + "_min": self.min * scale,
+                   prefix + "_max": self.max * scale,
+                   prefix + "_count": self.count}
+        for percentile, suffix in self.PERCENTILES:
+            summary["{}_{}".format(prefix, suffix)] = \
+                self.percentile(percentile) * scale
+        return summary
+
+    @classmethod
+    def metrics(cls, prefix):
+        """Names of metrics produced by summary()."""
+        return (prefix, prefix + "_min", prefix + "_max",
+                prefix + "_count") + tuple(
+            "{}_{}".format(prefix, suffix) for _, suffix in cls.PERCENTILES
+        )
@@ -1,48 +1,91 @@
-from fabric.api import run
-
-
 from cbagent.collectors.libstats.remotestats import (
-    RemoteStats, multi_node_task)
+    RemoteStats, current_host, multi_node_task, run)
 
 
 class IOstat(RemoteStats):
 
-    METRICS = (
-        ("rps", "r/s", 1),
-        ("wps", "w/s", 1),
-        ("rbps", "rkB/s", 1024),  # kB -> B
-        ("wbps", "wkB/s", 1024),  # kB -> B
-        ("avgqusz", "avgqu-sz", 1),
-        ("await", "await", 1),
-        ("util", "%util", 1),
+    # /proc/diskstats fields, not counting major, minor and device name
+    COUNTERS = (
+        ("reads", 0),
+        ("sectors_read", 2),
+        ("read_ms", 3),
+        ("writes", 4),
+        ("sectors_written", 6),
+        ("write_ms", 7),
+        ("io_ms", 9),
+        ("weighted_io_ms", 10),
     )
 
+    SECTOR_SIZE = 512  # diskstats sectors are always 512 bytes
+
+    def __init__(self, *args, **kwargs):
+        super(IOstat, self).__init__(*args, **kwargs)
+        self.devices = {}  # (host, partition) -> kernel device name
+
     def get_device_name(self, partition):
-        for path in (partition, '/'):
-            stdout = run("mount | grep '{} '".format(path),
-                         warn_only=True, quiet=True)
-            if not stdout.return_code:
-                return stdout.split()[0]
-
-    def get_iostat(self, device):
-        stdout = run(
-            "iostat -xk 1 2 {} | grep -v '^$' | tail -n 2".format(device)
-        )
-        stdout = stdout.split()
-        header = stdout[:len(stdout)/2]
-        data = dict()
-        for i, value in enumerate(stdout[len(stdout)/2:]):
-            data[header[i]] = value
-        return data
+        """Kernel name (e.g., sda1 or dm-0) of the device mounted at the
+        partition, or at the root if the partition isn't a mount point."""
+        key = (current_host(), partition)
+        if key not in self.devices:
+            for path in (partition, '/'):
+                stdout = run("mount | grep '{} '".format(path),
+                             warn_only=True, quiet=True)
+                if not stdout.return_code:
+                    device = stdout.split()[0]
+                    self.devices[key] = str(
+                        run("basename $(readlink -f {})".format(device)))
+                    break
+        return self.devices.get(key)
+
+    def get_diskstats(self):
+        """Return host uptime and raw counters of every device."""
+        stdout = run("cat /proc/uptime /proc/diskstats")
+        lines = stdout.split("\n")
+        diskstats = {}
+        for line in lines[1:]:
+            fields = line.split()
+            values = fields[3:]
+            diskstats[fields[2]] = dict(
+                (counter, int(values[field]))
+                for counter, field in self.COUNTERS
+            )
+        return float(lines[0].split()[0]), diskstats
 
     @multi_node_task
     def get_samples(self, partitions):
-        samples = {}
+        """Return (uptime, counters of every partition) of every host,
+        IOstat.get_metrics() turns rates of counters into iostat metrics."""
+        devices = dict((purpose, self.get_device_name(partition))
+                       for purpose, partition in partitions.items())
+        uptime, diskstats = self.get_diskstats()
+        counters = {}
+        for purpose, device in devices.items():
+            for counter, value in diskstats[device].items():
+                counters["{}_{}".format(purpose, counter)] = value
+        return uptime, counters
 
-        for purpose, partition in partitions.items():
-            device = self.get_device_name(partition)
-            data = self.get_iostat(device)
-            for shorthand, metric, multiplier in self.METRICS:
-                key = "{}_{}".format(purpose, shorthand)
-                samples[key] = float(data[metric]) * multiplier
+    @classmethod
+    def get_metrics(cls, rates, partitions):
+        """"iostat -x" metrics of every partition. Partitions with missing
+        rates (the first sample, reset counters) are skipped."""
+        samples = {}
+        for purpose in partitions:
+            try:
+                rate = dict((counter, rates["{}_{}".format(purpose, counter)])
+                            for counter, _ in cls.COUNTERS)
+            except KeyError:
+                continue
+            ios = rate["reads"] + rate["writes"]
+            metrics = {
+                "rps": rate["reads"],
+                "wps": rate["writes"],
+                "rbps": rate["sectors_read"] * cls.SECTOR_SIZE,
+                "wbps": rate["sectors_written"] * cls.SECTOR_SIZE,
+                "avgqusz": rate["weighted_io_ms"] / 1000,
+                "await": (rate["read_ms"] + rate["write_ms"]) / ios
+                if ios else 0.0,
+                "util": rate["io_ms"] / 10,  # ms per second -> %
+            }
+            for shorthand, value in metrics.items():
+                samples["{}_{}".format(purpose, shorthand)] = value
         return samples
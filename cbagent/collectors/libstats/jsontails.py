@@ -0,0 +1,60 @@
+"""Selective decoding of ns_server stats responses.
+
+A stats response holds a minute of samples for every metric, while collectors
+need only the last one. Instead of decoding the whole document, the samples
+object is cut out of the raw body and split into per-metric arrays with string
+methods, which run in C; only the tail of each array is converted to a number,
+so neither the object tree nor the lists of samples are built. Anything that
+doesn't look like a stats response makes the decoder give up, callers then
+fall back to the json module.
+"""
+import re
+
+WHITESPACE = " \t\r\n"
+SAMPLES = re.compile(r'"samples"\s*:\s*\{')
+LAST_TSTAMP = re.compile(r'"lastTStamp"\s*:\s*(-?\d+)')
+
+
+def enabled(settings):
+    """Whether selective decoding of stats responses is requested."""
+    return getattr(settings, "json_tails", False)
+
+
+def _number(token):
+    if "." in token or "e" in token or "E" in token:
+        return float(token)
+    return int(token)
+
+
+def decode_samples(body):
+    """Extract lastTStamp and the last sample of every metric from the raw
+    stats response. Return (last_tstamp, {metric: value}) or None if the body
+    can't be decoded that way."""
+    # str.find() is much faster than searching with regular expressions
+    tstamp = LAST_TSTAMP.match(body, max(body.find('"lastTStamp"'), 0))
+    samples = SAMPLES.match(body, max(body.find('"samples"'), 0))
+    if tstamp is None or samples is None:
+        return None
+
+    # The samples object maps names to flat arrays of numbers, so it ends
+    # with the first closing brace and every array ends with a bracket. If
+    # it doesn't, some piece won't have the form of name and array.
+    start = samples.end()
+    arrays = body[start:body.find("}", start)].split("]")
+    if arrays.pop().strip():
+        return None
+
+    tails = {}
+    try:
+        for array in arrays:
+            bracket = array.index("[")
+            name = array[:bracket].strip(WHITESPACE + ",:")
+            if len(name) < 2 or name[0] != '"' or name[-1] != '"' or \
+                    '"' in name[1:-1]:
+                return None
+            tail = array[max(array.rfind(","), bracket) + 1:].strip()
+            if tail:
+                tails[name[1:-1]] = _number(tail)
+    except ValueError:
+        return None  # e.g., null or nested arrays
+    return int(tstamp.group(1)), tails
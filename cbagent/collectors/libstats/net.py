@@ -1,9 +1,7 @@
 from collections import defaultdict
 
-from fabric.api import run
-
 from cbagent.collectors.libstats.remotestats import (RemoteStats,
-                                                     multi_node_task,
+                                                     multi_node_task, run,
                                                      single_node_task)
 
 
@@ -21,18 +19,24 @@ class NetStat(RemoteStats):
             if not result.return_code:
                 return iface
 
+    # /proc/net/dev fields -> names of their rates
+    COUNTERS = (
+        ("in_bytes_per_sec", 0),
+        ("in_packets_per_sec", 1),
+        ("out_bytes_per_sec", 8),
+        ("out_packets_per_sec", 9),
+    )
+
     def get_dev_stats(self):
-        cmd = "grep {} /proc/net/dev".format(self.iface)
-        stdout = run("{0}; sleep 1; {0}".format(cmd))
-        s1, s2 = stdout.split('\n')
-        s1 = [int(v.split(":")[-1]) for v in s1.split() if v.split(":")[-1]]
-        s2 = [int(v.split(":")[-1]) for v in s2.split() if v.split(":")[-1]]
-        return {
-            "in_bytes_per_sec": s2[0] - s1[0],
-            "out_bytes_per_sec": s2[8] - s1[8],
-            "in_packets_per_sec": s2[1] - s1[1],
-            "out_packets_per_sec": s2[9] - s1[9],
-        }
+        """Return host uptime and raw interface counters, the collector
+        turns them into rates."""
+        stdout = run("cat /proc/uptime; grep {} /proc/net/dev".format(
+            self.iface))
+        uptime, dev = stdout.split("\n")
+        values = dev.split(":", 1)[1].split()
+        return float(uptime.split()[0]), dict(
+            (metric, int(values[field])) for metric, field in self.COUNTERS
+        )
 
     @staticmethod
     def get_tcp_stats():
@@ -48,6 +52,6 @@ class NetStat(RemoteStats):
 
     @multi_node_task
     def get_samples(self):
-        dev_stats = self.get_dev_stats()
-        tcp_stats = self.get_tcp_stats()
-        return dict(dev_stats, **tcp_stats)
+        """Return (uptime, interface counters, TCP stats) of every host."""
+        uptime, dev_stats = self.get_dev_stats()
+        return uptime, dev_stats, self.get_tcp_stats()
@@ -0,0 +1,35 @@
+from time import sleep
+
+from cbagent.clock import monotonic
+
+
+def poll_keys(check, keys, t0, timeout, initial_interval=0.01,
+              max_interval=2, sampling_error=0.05):
+    """Poll a batch of probe keys until all of them are ready.
+
+    check(keys) is called with all outstanding keys at once and returns
+    those that became ready. Interval between polls grows with elapsed time
+    (sampling_error of it), so relative measurement error stays roughly the
+    same for short and long waits. Polling stops after timeout seconds.
+
+    Return dictionary of key -> time when the key was found ready (as
+    returned by monotonic()).
+    """
+    arrivals = {}
+    outstanding = list(keys)
+    interval = initial_interval
+    while outstanding:
+        ready = set(check(outstanding))
+        now = monotonic()
+        for key in outstanding:
+            if key in ready:
+                arrivals[key] = now
+        outstanding = [key for key in outstanding if key not in arrivals]
+
+        elapsed = now - t0
+        if not outstanding or elapsed > timeout:
+            break
+        sleep(interval)
+        interval = min(max(elapsed * sampling_error, initial_interval),
+                       max_interval)
+    return arrivals
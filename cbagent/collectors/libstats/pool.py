@@ -1,8 +1,9 @@
-from threading import Lock
-from time import time
-from Queue import Queue, Empty
+from threading import Condition, Thread
 
 from couchbase.connection import Connection
+from logger import logger
+
+from cbagent.clock import monotonic
 
 
 class ClientUnavailableError(Exception):
@@ -11,59 +12,203 @@ class ClientUnavailableError(Exception):
 
 class ConnectionWrapper(Connection):
 
+    HEALTH_CHECK_KEY = "cbagent_pool_health_check"
+
     def __init__(self, **kwargs):
         super(ConnectionWrapper, self).__init__(**kwargs)
         self.use_count = 0
         self.use_time = 0
         self.last_use_time = 0
+        self.idle_since = monotonic()
 
     def start_using(self):
-        self.last_use_time = time()
+        self.last_use_time = monotonic()
 
     def stop_using(self):
-        self.use_time += time() - self.last_use_time
+        self.idle_since = monotonic()
+        self.use_time += self.idle_since - self.last_use_time
         self.use_count += 1
 
+    def close(self):
+        """Release sockets right away rather than on garbage collection,
+        _close() isn't available in every client version."""
+        close = getattr(self, "_close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.warn("Failed to close connection: {}".format(e))
+
+    def is_healthy(self):
+        try:
+            self.get(self.HEALTH_CHECK_KEY, quiet=True)
+            return True
+        except Exception as e:
+            logger.warn("Evicting broken connection: {}".format(e))
+            return False
+
 
 class Pool(object):
 
-    def __init__(self, initial=10, max_clients=20, **connargs):
-        self._q = Queue()
-        self._l = []
+    """Pool of client connections.
+
+    Initial connections are opened in parallel by background threads, more
+    connections are opened on demand up to max_clients. Idle connections are
+    kept in a stack, so checkout returns the most recently used one. The
+    lock only protects bookkeeping: connections are opened and checked
+    outside of it and waiting callers don't block each other.
+
+    Connections idle longer than max_idle seconds are closed, connections
+    idle longer than check_interval seconds are checked before checkout and
+    closed if they are broken.
+    """
+
+    def __init__(self, initial=10, max_clients=20, max_idle=300,
+                 check_interval=30, **connargs):
+        self._idle = []  # stack of idle connections
+        self._l = []  # all open connections
         self._connargs = connargs
-        self._cur_clients = 0
+        self._cur_clients = 0  # open or being opened
         self._max_clients = max_clients
-        self._lock = Lock()
+        self._max_idle = max_idle
+        self._check_interval = check_interval
+        self._cond = Condition()
 
-        for x in range(initial):
-            self._q.put(self._make_client())
+        self._retired_use_count = 0
+        self._retired_use_time = 0
+        self._evicted = 0
+        self._waits = 0
+        self._wait_time = 0
+        self._max_wait_time = 0
+
+        for _ in range(min(initial, max_clients)):
             self._cur_clients += 1
+            warm_up = Thread(target=self._warm_up)
+            warm_up.daemon = True
+            warm_up.start()
 
     def _make_client(self):
-        ret = ConnectionWrapper(**self._connargs)
-        self._l.append(ret)
+        try:
+            ret = ConnectionWrapper(**self._connargs)
+        except Exception:
+            with self._cond:
+                self._cur_clients -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._l.append(ret)
         return ret
 
-    def get_client(self, initial_timeout=0.05, next_timeout=200):
+    def _warm_up(self):
         try:
-            return self._q.get(True, initial_timeout)
-        except Empty:
-            try:
-                self._lock.acquire()
-                if self._cur_clients == self._max_clients:
-                    raise ClientUnavailableError("Too many clients in use")
+            cb = self._make_client()
+        except Exception as e:
+            logger.warn("Failed to open connection: {}".format(e))
+            return
+        with self._cond:
+            self._idle.append(cb)
+            self._cond.notify()
+
+    def _retire(self, cb):
+        """Must be called with the lock held."""
+        self._l.remove(cb)
+        self._cur_clients -= 1
+        self._evicted += 1
+        self._retired_use_count += cb.use_count
+        self._retired_use_time += cb.use_time
+
+    def _discard(self, cb):
+        with self._cond:
+            self._retire(cb)
+            self._cond.notify()
+        cb.close()
+
+    def _evict_idle(self):
+        """Drop stale connections from the bottom of the stack and return
+        them, they should be closed once the lock is released. Must be
+        called with the lock held."""
+        now = monotonic()
+        evicted = []
+        while self._idle and now - self._idle[0].idle_since > self._max_idle:
+            cb = self._idle.pop(0)
+            self._retire(cb)
+            evicted.append(cb)
+        return evicted
+
+    def _checkout(self, initial_timeout, next_timeout):
+        """Return an idle connection or None if a new one should be opened.
+        The lock is released while waiting."""
+        t0 = monotonic()
+        initial_deadline = t0 + initial_timeout
+        deadline = t0 + next_timeout
+        waited = False
+        evicted = []
+        try:
+            with self._cond:
+                while True:
+                    evicted += self._evict_idle()
+                    if self._idle:
+                        return self._idle.pop()
+
+                    now = monotonic()
+                    can_grow = self._cur_clients < self._max_clients
+                    if can_grow and (not self._cur_clients or
+                                     now >= initial_deadline):
+                        self._cur_clients += 1
+                        return None
+
+                    timeout = (initial_deadline if can_grow else deadline) \
+                        - now
+                    if timeout <= 0:
+                        raise ClientUnavailableError("Too many clients in use")
+                    waited = True
+                    self._cond.wait(timeout)
+        finally:
+            for cb in evicted:
+                cb.close()
+            if waited:
+                wait_time = monotonic() - t0
+                with self._cond:
+                    self._waits += 1
+                    self._wait_time += wait_time
+                    self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def get_client(self, initial_timeout=0.05, next_timeout=200):
+        """Check out a connection. Wait up to initial_timeout seconds for an
+        idle connection before opening a new one and up to next_timeout
+        seconds if the pool is exhausted."""
+        while True:
+            cb = self._checkout(initial_timeout, next_timeout)
+            if cb is None:
                 cb = self._make_client()
-                self._cur_clients += 1
-                cb.start_using()
-                return cb
-            except ClientUnavailableError as ex:
-                try:
-                    return self._q.get(True, next_timeout)
-                except Empty:
-                    raise ex
-            finally:
-                self._lock.release()
-
-    def release_client(self, cb):
+            elif monotonic() - cb.idle_since > self._check_interval and \
+                    not cb.is_healthy():
+                self._discard(cb)
+                continue
+            cb.start_using()
+            return cb
+
+    def release_client(self, cb, healthy=True):
+        """Return connection to the pool. Connections that failed in a way
+        that made them unusable should be released with healthy=False."""
         cb.stop_using()
-        self._q.put(cb, True)
+        if not healthy:
+            return self._discard(cb)
+        with self._cond:
+            self._idle.append(cb)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pool_clients": len(self._l),
+                "pool_idle": len(self._idle),
+                "pool_evicted": self._evicted,
+                "pool_use_count": self._retired_use_count +
+                sum(cb.use_count for cb in self._l),
+                "pool_use_time": self._retired_use_time +
+                sum(cb.use_time for cb in self._l),
+                "pool_waits": self._waits,
+                "pool_wait_time": self._wait_time,
+                "pool_max_wait_time": self._max_wait_time,
+            }
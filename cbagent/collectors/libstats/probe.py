@@ -0,0 +1,73 @@
+from threading import Lock, Thread
+from time import sleep
+
+from logger import logger
+
+from cbagent.clock import monotonic
+from cbagent.collectors.libstats.histogram import Histogram
+
+
+class OpenLoopProbe(Thread):
+
+    """Open-loop load generator for latency measurements.
+
+    Operations are issued at a fixed target rate following a schedule of
+    intended start times (start + i / rate). Latency is measured from the
+    intended start time rather than from the actual one, so a server stall
+    is accounted for every request that would have queued behind it instead
+    of showing up as a single slow sample (coordinated omission).
+
+    mix maps operation names to integer weights, sizes is a list of value
+    sizes; the schedule interleaves all operations with all sizes. execute
+    is called as execute(op, size, n) where n is a sequence number.
+    """
+
+    def __init__(self, execute, rate, mix, sizes):
+        super(OpenLoopProbe, self).__init__()
+        self.daemon = True
+
+        self.execute = execute
+        self.rate = float(rate)
+        self.schedule = [(op, size) for size in sizes
+                         for op, weight in sorted(mix.items())
+                         for _ in range(weight)]
+
+        self.errors = 0
+        self._lock = Lock()
+        self.histograms = self._new_histograms()
+
+    def _new_histograms(self):
+        return dict((key, Histogram()) for key in set(self.schedule))
+
+    def run(self):
+        start = monotonic()
+        i = 0
+        while True:
+            intended = start + i / self.rate
+            delay = intended - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            op, size = self.schedule[i % len(self.schedule)]
+            i += 1
+            try:
+                self.execute(op, size, i - 1)
+            except Exception as e:
+                # failed operations are counted, but their latency isn't
+                with self._lock:
+                    self.errors += 1
+                logger.warn("Probe {} ({} bytes) failed: {}".format(op, size,
+                                                                    e))
+                continue
+            latency = monotonic() - intended
+            with self._lock:
+                self.histograms[(op, size)].record(latency * 10 ** 6)  # us
+
+    def snapshot(self):
+        """Return histograms and error count accumulated since the previous
+        snapshot and start new ones."""
+        with self._lock:
+            histograms, self.histograms = \
+                self.histograms, self._new_histograms()
+            errors, self.errors = self.errors, 0
+        return histograms, errors
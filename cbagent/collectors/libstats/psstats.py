@@ -1,36 +1,119 @@
-from fabric.api import run
-
 from cbagent.collectors.libstats.remotestats import (
-    RemoteStats, multi_node_task)
+    RemoteStats, current_host, multi_node_task, run)
 
 
 class PSStats(RemoteStats):
 
-    METRICS = (
-        ("rss", 1024),    # kB -> B
-        ("vsize", 1024),
+    """Per-process stats read from /proc in a single command per node.
+
+    PIDs are cached and resolved again only when the cached one disappears or
+    belongs to another process. Raw counters are keyed by (process, PID,
+    counter), so the collector computes CPU utilization and other rates from
+    two consecutive samples of the same PID (see Collector.get_rates) and
+    nothing sleeps on the remote side.
+    """
+
+    PS_CMD = "ps -eo pid,rss,comm | grep {0} | grep -v grep | " \
+             "sort -n -k 2 | tail -n 1 | awk '{{print $1}}'"
+
+    PROC_CMD = \
+        "pid={1}; " \
+        "grep -qsF '({0})' /proc/$pid/stat || pid=$({2}); " \
+        "echo \"#{0} $pid\"; " \
+        "[ -n \"$pid\" ] && " \
+        "cat /proc/$pid/stat /proc/$pid/status /proc/$pid/io 2>/dev/null"
+
+    GAUGES = (
+        ("rss", "VmRSS", 1024),  # kB -> B
+        ("vsize", "VmSize", 1024),
+        ("threads", "Threads", 1),
+    )
+
+    COUNTERS = (
+        ("ctxt_switches_per_sec",
+         ("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")),
+        ("read_bytes_per_sec", ("read_bytes", )),
+        ("write_bytes_per_sec", ("write_bytes", )),
     )
 
     def __init__(self, hosts, user, password):
         super(PSStats, self).__init__(hosts, user, password)
-        self.ps_cmd = "ps -eo pid,rss,vsize,comm | " \
-                      "grep {} | grep -v grep | sort -n -k 2 | tail -n 1"
-        self.top_cmd = "top -bn2d1 -p {} | grep {}"
+        self.pids = {}  # (host, process) -> pid
+
+    def _get_cmd(self, host, processes):
+        cmds = ["cat /proc/uptime", "getconf CLK_TCK"]
+        for process in processes:
+            pid = self.pids.get((host, process), "")
+            cmds.append(self.PROC_CMD.format(process, pid,
+                                             self.PS_CMD.format(process)))
+        return "; ".join(cmds)
+
+    @staticmethod
+    def _parse(stdout):
+        lines = stdout.splitlines()
+        uptime = float(lines[0].split()[0])
+        clk_tck = float(lines[1])
+
+        sections, section = {}, None
+        for line in lines[2:]:
+            if line.startswith("#"):
+                process, _, pid = line[1:].partition(" ")
+                section = sections[process] = {"pid": pid.strip()}
+            elif section is None:
+                continue  # e.g., shell noise before the first header
+            elif line.startswith(section["pid"] + " ("):
+                # fields after the command name, utime is the 14th field
+                fields = line.rsplit(")", 1)[1].split()
+                section["cpu_ticks"] = int(fields[11]) + int(fields[12])
+            elif ":" in line:
+                key, _, value = line.partition(":")
+                value = value.split()
+                if value and value[0].isdigit():
+                    section[key] = int(value[0])
+        return uptime, clk_tck, sections
 
     @multi_node_task
-    def get_samples(self, process):
+    def get_samples(self, processes):
+        """Return (uptime, clock ticks per second, counters, gauges) of every
+        host, PSStats.get_metrics() turns rates of counters into metrics."""
+        host = current_host()
+        uptime, clk_tck, sections = self._parse(
+            run(self._get_cmd(host, processes))
+        )
+
+        counters, gauges = {}, {}
+        for process, section in sections.items():
+            pid = section["pid"]
+            if not pid or "cpu_ticks" not in section:
+                self.pids.pop((host, process), None)
+                continue
+            self.pids[(host, process)] = pid
+
+            for title, key, multiplier in self.GAUGES:
+                if key in section:
+                    title = "{}_{}".format(process, title)
+                    gauges[title] = float(section[key]) * multiplier
+            for key in ["cpu_ticks"] + [k for _, keys in self.COUNTERS
+                                        for k in keys]:
+                if key in section:
+                    counters[(process, pid, key)] = section[key]
+        return uptime, clk_tck, counters, gauges
+
+    @classmethod
+    def get_metrics(cls, rates, clk_tck):
+        """CPU utilization and per-second rates of every process. Processes
+        with missing rates (the first sample, new PID) are skipped."""
+        processes = {}
+        for (process, _, key), rate in rates.items():
+            processes.setdefault(process, {})[key] = rate
+
         samples = {}
-        stdout = run(self.ps_cmd.format(process))
-        if stdout:
-            for i, value in enumerate(stdout.split()[1:1+len(self.METRICS)]):
-                metric, multiplier = self.METRICS[i]
-                title = "{}_{}".format(process, metric)
-                samples[title] = float(value) * multiplier
-            pid = stdout.split()[0]
-        else:
-            return samples
-        stdout = run(self.top_cmd.format(pid, process))
-        if stdout:
-            title = "{}_cpu".format(process)
-            samples[title] = float(stdout.split()[8])
+        for process, rate in processes.items():
+            if "cpu_ticks" in rate:
+                cpu = 100.0 * rate["cpu_ticks"] / clk_tck
+                samples["{}_cpu".format(process)] = cpu
+            for title, keys in cls.COUNTERS:
+                if all(k in rate for k in keys):
+                    samples["{}_{}".format(process, title)] = \
+                        sum(rate[key] for key in keys)
         return samples
@@ -1,29 +1,84 @@
+from multiprocessing.pool import ThreadPool
+from threading import local
+
 from decorator import decorator
+from logger import logger
+
+from cbagent.collectors.libstats.transport import SSHTransport
+from cbagent.instrumentation import NullInstrumentation
+
+_context = local()
+
+
+def run(command, warn_only=False, quiet=False):
+    """Run command on the host of the current task. warn_only and quiet of
+    fabric.api.run are accepted for compatibility, but non-zero exit status
+    never raises - check result.return_code - and output is never echoed.
+    Commands don't get a pseudo-terminal."""
+    return _context.transport.run(command)
+
+
+def current_host():
+    """Host of the current task."""
+    return _context.transport.host
 
-from fabric.api import hide, settings, parallel
-from fabric.tasks import execute
+
+def run_many(commands):
+    """Run several commands concurrently on the host of the current task,
+    results are returned in order."""
+    return _context.transport.run_many(commands)
+
+
+def _run_task(task, transport, *args, **kargs):
+    previous = getattr(_context, "transport", None)
+    _context.transport = transport
+    try:
+        return task(*args, **kargs)
+    finally:
+        _context.transport = previous
 
 
 @decorator
 def multi_node_task(task, *args, **kargs):
     self = args[0]
-    with settings(user=self.user, password=self.password, warn_only=True):
-        with hide("running", "output"):
-            return execute(parallel(task), *args, hosts=self.hosts, **kargs)
+
+    def run_on_host(host):
+        try:
+            with self.instrumentation.timer("ssh_" + task.__name__):
+                return host, _run_task(task, self.get_transport(host),
+                                       *args, **kargs)
+        except Exception as e:
+            logger.warn("Task {} failed on {}: {}".format(task.__name__,
+                                                          host, e))
+            return host, None
+
+    results = self.pool.map(run_on_host, self.hosts)
+    return dict((host, result) for host, result in results
+                if result is not None)
 
 
 @decorator
 def single_node_task(task, *args, **kargs):
     self = args[0]
-    with settings(user=self.user, password=self.password, warn_only=True,
-                  host_string=self.hosts[0]):
-        with hide("running", "output"):
-            return task(*args, **kargs)
+    with self.instrumentation.timer("ssh_" + task.__name__):
+        return _run_task(task, self.get_transport(self.hosts[0]),
+                         *args, **kargs)
 
 
 class RemoteStats(object):
 
+    """Base class for stats gathered over SSH. Tasks run on all hosts in
+    parallel threads, every host is served by a persistent SSHTransport
+    shared with other RemoteStats instances in the process. Duration of
+    tasks is recorded by instrumentation (set by the collector).
+    """
+
     def __init__(self, hosts, user, password):
         self.hosts = hosts
         self.user = user
         self.password = password
+        self.pool = ThreadPool(max(len(hosts), 1))
+        self.instrumentation = NullInstrumentation()
+
+    def get_transport(self, host):
+        return SSHTransport.get(host, self.user, self.password)
@@ -0,0 +1,157 @@
+import socket
+from threading import Lock
+
+import paramiko
+from logger import logger
+
+
+class RemoteResult(str):
+
+    """Command output with exit status, compatible with fabric results."""
+
+    def __new__(cls, output, return_code):
+        result = super(RemoteResult, cls).__new__(cls, output)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
+class SSHTransport(object):
+
+    """Long-lived authenticated SSH connection to a single host. Every
+    command runs in its own channel multiplexed over the same connection, so
+    concurrent commands don't pay for handshakes. The connection is
+    re-established automatically when it's broken.
+
+    Connections are shared by all users in the process, use get() instead of
+    the constructor.
+    """
+
+    KEEPALIVE_INTERVAL = 30
+
+    CONNECT_TIMEOUT = 10
+
+    COMMAND_TIMEOUT = 60
+
+    _transports = {}
+
+    _registry_lock = Lock()
+
+    def __init__(self, host, user, password, port=22):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.client = None
+        self._lock = Lock()
+
+    @classmethod
+    def get(cls, host, user, password, port=22):
+        key = (host, port, user)
+        with cls._registry_lock:
+            if key not in cls._transports:
+                cls._transports[key] = cls(host, user, password, port)
+            return cls._transports[key]
+
+    def _connect(self):
+        with self._lock:
+            transport = self.client and self.client.get_transport()
+            if transport is not None and transport.is_active():
+                return transport
+            if self.client is not None:
+                self.client.close()
+            logger.info("Establishing SSH connection to {}".format(self.host))
+            self.client = paramiko.SSHClient()
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            self.client.connect(hostname=self.host, port=self.port,
+                                username=self.user, password=self.password,
+                                timeout=self.CONNECT_TIMEOUT)
+            transport = self.client.get_transport()
+            transport.set_keepalive(self.KEEPALIVE_INTERVAL)
+            return transport
+
+    def close(self):
+        with self._lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+    def _open(self, command):
+        channel = self._connect().open_session()
+        channel.settimeout(self.COMMAND_TIMEOUT)
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        return channel
+
+    def _open_all(self, commands):
+        """Open a channel per command, the ones already opened are closed if
+        any of them fails."""
+        channels = []
+        try:
+            for command in commands:
+                channels.append(self._open(command))
+        except Exception:
+            self._close_all(channels)
+            raise
+        return channels
+
+    @staticmethod
+    def _close_all(channels):
+        for channel in channels:
+            channel.close()
+
+    def _collect(self, channel):
+        """Result of the command, a command which times out fails alone
+        without affecting the connection."""
+        try:
+            output = channel.makefile("rb").read()
+            return RemoteResult(output.rstrip("\r\n"),
+                                channel.recv_exit_status())
+        except socket.timeout:
+            logger.warn("Command timed out on {}".format(self.host))
+            return RemoteResult("", -1)
+        finally:
+            channel.close()
+
+    def is_active(self):
+        transport = self.client and self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def run_many(self, commands):
+        """Run commands concurrently and return their results in order.
+        Channels are opened one after another (opening a channel and starting
+        a command wait for the server), but all commands are started before
+        any output is read, so their execution times overlap.
+
+        The batch is repeated once over a new connection if a channel can't
+        be opened or the connection breaks while output is read. Any other
+        error is raised as is."""
+        for attempt in range(2):
+            try:
+                channels = self._open_all(commands)
+            except (paramiko.SSHException, socket.error) as e:
+                broken = isinstance(e, paramiko.SSHException) or \
+                    not self.is_active()
+                if attempt or not broken:
+                    raise
+                logger.warn("Failed to open SSH channel to {} ({}), "
+                            "reconnecting".format(self.host, e))
+                self.close()
+                continue
+
+            results = []
+            try:
+                for channel in channels:
+                    results.append(self._collect(channel))
+                return results
+            except (paramiko.SSHException, socket.error) as e:
+                self._close_all(channels[len(results):])
+                if attempt or self.is_active():
+                    raise
+                logger.warn("SSH connection to {} broke ({}), "
+                            "reconnecting".format(self.host, e))
+                self.close()
+
+    def run(self, command):
+        return self.run_many([command])[0]
@@ -1,7 +1,5 @@
-from fabric.api import run
-
 from cbagent.collectors.libstats.remotestats import (
-    RemoteStats, multi_node_task)
+    RemoteStats, multi_node_task, run)
 
 
 class TPStats(RemoteStats):
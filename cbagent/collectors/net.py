@@ -10,10 +10,11 @@ class Net(Collector):
         super(Net, self).__init__(settings)
         self.ssh_username = settings.ssh_username
         self.ssh_password = settings.ssh_password
-        self.nodes = settings.hostnames or list(self.get_nodes())
+        self.nodes = settings.hostnames or self.nodes
         self.net = NetStat(hosts=self.nodes,
                            user=settings.ssh_username,
                            password=settings.ssh_password)
+        self.net.instrumentation = self.instrumentation
 
     def update_metadata(self):
         self.mc.add_cluster()
@@ -21,8 +22,12 @@ class Net(Collector):
             self.mc.add_server(node)
 
     def sample(self):
-        for node, stats in self.net.get_samples().items():
+        for node, (uptime, counters, stats) in self.net.get_samples().items():
+            # interface counters are 32 bits wide on 32-bit kernels
+            stats.update(self.get_rates(counters, server=node,
+                                        timestamp=uptime, wrapping=counters))
             self.update_metric_metadata(stats.keys(), server=node)
             self.store.append(stats,
                               cluster=self.cluster, server=node,
-                              collector=self.COLLECTOR)
+                              collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
@@ -1,41 +1,97 @@
+import json
+
 from cbagent.collectors import Collector
+from cbagent.collectors.libstats import jsontails
 
 
 class NSServer(Collector):
 
     COLLECTOR = "ns_server"
 
-    def _get_stats_uri(self):
-        for bucket, stats in self.get_buckets(with_stats=True):
-            uri = stats["uri"]
-            yield uri, bucket, None  # cluster wide
+    def __init__(self, settings):
+        super(NSServer, self).__init__(settings)
+        # In incremental mode every sample ns_server collected since the
+        # previous poll is stored with its original timestamp.
+        self.incremental = getattr(settings, "ns_server_incremental", False)
+        self.last_tstamps = {}
+        # Otherwise only the last value of every metric is needed, it can be
+        # extracted without decoding the whole response.
+        self.selective = jsontails.enabled(settings) and not self.incremental
 
-            stats_list = self.get_http(path=stats["nodeStatsListURI"])
-            for server in stats_list["servers"]:
-                host = server["hostname"].split(":")[0]
-                uri = server["stats"]["uri"]
-                yield uri, bucket, host  # server specific
+    def _get_path(self, uri):
+        if not self.incremental or uri not in self.last_tstamps:
+            return uri  # last minute samples
+        return "{}?zoom=minute&haveTStamp={}".format(uri,
+                                                      self.last_tstamps[uri])
 
-    def _get_stats(self, uri):
-        samples = self.get_http(path=uri)  # get last minute samples
-        stats = dict()
+    def _decode_stats(self, body):
+        """Selective counterpart of json.loads and _get_stats."""
+        decoded = jsontails.decode_samples(body)
+        if decoded is None:
+            return self._get_stats(json.loads(body))
+        last_tstamp, tails = decoded
+        if last_tstamp == 0:
+            return None
+        return dict(zip(self.registry.normalize(tails.iterkeys()),
+                        tails.itervalues()))
 
+    def _get_stats(self, samples):
         if samples["op"]["lastTStamp"] == 0:
             # Index and N1QL nodes don't have stats in ns_server
             return None
 
-        for metric, values in samples['op']['samples'].iteritems():
-            metric = metric.replace('/', '_')
-            stats[metric] = values[-1]  # only the most recent sample
-        return stats
+        samples = samples['op']['samples']
+        return dict(zip(self.registry.normalize(samples.iterkeys()),
+                        [values[-1] for values in samples.itervalues()]))
 
-    def sample(self):
-        for uri, bucket, host in self._get_stats_uri():
-            stats = self._get_stats(uri)
-            if not stats:
+    def _get_new_stats(self, uri, samples):
+        """Yield (timestamp, stats) for every sample newer than the last one
+        seen for given URI."""
+        last_tstamp = samples["op"]["lastTStamp"]
+        if last_tstamp == 0:
+            return
+        have_tstamp = self.last_tstamps.get(uri, 0)
+        self.last_tstamps[uri] = last_tstamp
+
+        samples = samples["op"]["samples"]
+        metrics = [metric for metric in samples if metric != "timestamp"]
+        metrics = zip(self.registry.normalize(metrics),
+                      [samples[metric] for metric in metrics])
+        for i, tstamp in enumerate(samples["timestamp"]):
+            if tstamp <= have_tstamp:
                 continue
-            self.update_metric_metadata(stats.keys(), bucket, host)
-            self.store.append(stats, self.cluster, host, bucket, self.COLLECTOR)
+            stats = dict((metric, values[i]) for metric, values in metrics
+                         if i < len(values))
+            yield tstamp / 1000.0, stats  # ms -> s
+
+    def _append(self, uri, samples, bucket, host):
+        if not self.incremental:
+            if self.selective:
+                stats = samples  # already decoded by _decode_stats
+            else:
+                stats = self._get_stats(samples)
+            if stats:
+                self.update_metric_metadata(stats.keys(), bucket, host)
+                self.store.append(stats, self.cluster, host, bucket,
+                                  self.COLLECTOR, timestamp=self.timestamp)
+            return
+
+        for i, (tstamp, stats) in enumerate(self._get_new_stats(uri, samples)):
+            if not i:
+                self.update_metric_metadata(stats.keys(), bucket, host)
+            self.store.append(stats, self.cluster, host, bucket,
+                              self.COLLECTOR, timestamp=tstamp)
+
+    def sample(self):
+        uris = list(self.get_stats_uris())
+        # get samples from all buckets and nodes concurrently
+        decode = self.selective and self._decode_stats or None
+        responses = self.get_http_all([self._get_path(uri)
+                                       for uri, _, _ in uris],
+                                      ignore_errors=True, decode=decode)
+        for (uri, bucket, host), samples in zip(uris, responses):
+            if samples is not None:  # the rest of nodes is still sampled
+                self._append(uri, samples, bucket, host)
 
     def update_metadata(self):
         self.mc.add_cluster()
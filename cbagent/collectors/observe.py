@@ -1,38 +1,42 @@
-from time import time, sleep
 from threading import Thread
 from uuid import uuid4
 
 from couchbase.user_constants import OBS_PERSISTED, OBS_NOTFOUND
-from decorator import decorator
 from logger import logger
 
+from cbagent.clock import monotonic
 from cbagent.collectors import Latency
+from cbagent.collectors.libstats.histogram import Histogram
+from cbagent.collectors.libstats.poll import poll_keys
 from cbagent.collectors.libstats.pool import Pool
 
 uhex = lambda: uuid4().hex
 
 
-@decorator
-def timeit(method, *args, **kargs):
-    t0 = time()
-    method(*args, **kargs)
-    t1 = time()
-    return t0, t1
+class ObserveLatency(Latency):
 
+    """Persistence, replication or indexing latency of new documents.
 
-class ObserveLatency(Latency):
+    Every interval a batch of probe documents is written to each bucket with
+    a single multi-set. All documents are then tracked together: one
+    multi-key observe (or one view query with multiple keys in index mode)
+    per poll, on a schedule shared by the whole batch. Latency distribution
+    is reported per bucket and interval.
+    """
 
     COLLECTOR = "observe"
 
     METRICS = ("latency_observe", )
 
-    NUM_THREADS = 10
+    NUM_PROBES = 100
+
+    TIMEOUT = 60
 
-    MAX_POLLING_INTERVAL = 1
+    INITIAL_REQUEST_INTERVAL = 0.002
 
-    INITIAL_REQUEST_INTERVAL = 0.01
+    SAMPLING_ERROR = 0.05  # 5%
 
-    MAX_REQUEST_INTERVAL = 2
+    MAX_REQUEST_INTERVAL = 1
 
     def __init__(self, settings):
         super(Latency, self).__init__(settings)
@@ -40,6 +44,7 @@ class ObserveLatency(Latency):
         self.pools = []
         for bucket in self.get_buckets():
             pool = Pool(
+                initial=1,
                 bucket=bucket,
                 host=settings.master_node,
                 username=bucket,
@@ -47,64 +52,84 @@ class ObserveLatency(Latency):
                 quiet=True,
             )
             self.pools.append((bucket, pool))
+        self.instrumentation.add_source(self._get_pool_stats)
 
         self.mode = getattr(settings, "observe", "persist")  # replicate | index
-
-    @timeit
-    def _wait_until_persisted(self, client, key):
-        req_interval = self.INITIAL_REQUEST_INTERVAL
-        while not [v for v in client.observe(key).value
-                   if v.flags == OBS_PERSISTED]:
-            sleep(req_interval)
-            req_interval = min(req_interval * 1.5, self.MAX_REQUEST_INTERVAL)
-
-    @timeit
-    def _wait_until_replicated(self, client, key):
-        found = lambda client: [
-            v for v in client.observe(key).value if v.flags != OBS_NOTFOUND
-        ]
-        while len(found(client)) != 2:
-            sleep(0.002)
-
-    @timeit
-    def _wait_until_indexed(self, client, key):
-        rows = None
-        while not rows:
-            rows = tuple(client.query("A", "id_by_city", key=key))
+        self.probes = getattr(settings, "observe_probes", self.NUM_PROBES)
+        self.timeout = getattr(settings, "observe_timeout", self.TIMEOUT)
+
+    def _get_pool_stats(self):
+        stats = {}
+        for bucket, pool in self.pools:
+            for key, value in pool.stats().items():
+                stats["{}_{}_{}".format(self.COLLECTOR, bucket, key)] = value
+        return stats
+
+    def get_metrics(self):
+        return Histogram.metrics("latency_observe") + \
+            ("latency_observe_timeouts", )
+
+    @staticmethod
+    def _get_persisted(client, keys):
+        return [key for key, rv in client.observe_multi(keys).items()
+                if [v for v in rv.value if v.flags == OBS_PERSISTED]]
+
+    @staticmethod
+    def _get_replicated(client, keys):
+        return [key for key, rv in client.observe_multi(keys).items()
+                if len([v for v in rv.value if v.flags != OBS_NOTFOUND]) > 1]
+
+    @staticmethod
+    def _get_indexed(client, keys):
+        return [row.key for row in
+                client.query("A", "id_by_city", mapkey_multi=keys)]
 
     def _measure_lags(self, pool):
-        client = pool.get_client()
-
-        key = uhex()
-        client.set(key, {"city": key})
-
         if self.mode == "persist":
-            t0, t1 = self._wait_until_persisted(client, key)
+            check = self._get_persisted
         elif self.mode == "replicate":
-            t0, t1 = self._wait_until_replicated(client, key)
+            check = self._get_replicated
         else:
-            t0, t1 = self._wait_until_indexed(client, key)
-        latency = (t1 - t0) * 1000  # s -> ms
-        sleep_time = max(0, self.MAX_POLLING_INTERVAL - (t1 - t0))
+            check = self._get_indexed
+
+        client = pool.get_client()
+        try:
+            keys = [uhex() for _ in range(self.probes)]
+            client.set_multi(dict((key, {"city": key}) for key in keys))
+            t0 = monotonic()
+
+            arrivals = poll_keys(
+                lambda batch: check(client, batch),
+                keys, t0, self.timeout,
+                initial_interval=self.INITIAL_REQUEST_INTERVAL,
+                max_interval=self.MAX_REQUEST_INTERVAL,
+                sampling_error=self.SAMPLING_ERROR,
+            )
 
-        client.delete(key)
-        pool.release_client(client)
-        return {"latency_observe": latency}, sleep_time
+            client.delete_multi(keys, quiet=True)
+        finally:
+            pool.release_client(client)
+
+        histogram = Histogram()
+        for t1 in arrivals.values():
+            histogram.record((t1 - t0) * 10 ** 6)  # s -> us
+        stats = histogram.summary("latency_observe", scale=0.001)  # us -> ms
+        stats["latency_observe_timeouts"] = len(keys) - len(arrivals)
+        return stats
+
+    def _sample_bucket(self, bucket, pool):
+        try:
+            stats = self._measure_lags(pool)
+            self.store.append(stats,
+                              cluster=self.cluster,
+                              bucket=bucket,
+                              collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
+        except Exception as e:
+            logger.warn(e)
 
     def sample(self):
-        while True:
-            try:
-                for bucket, pool in self.pools:
-                    stats, sleep_time = self._measure_lags(pool)
-                    self.store.append(stats,
-                                      cluster=self.cluster,
-                                      bucket=bucket,
-                                      collector=self.COLLECTOR)
-                    sleep(sleep_time)
-            except Exception as e:
-                logger.warn(e)
-
-    def collect(self):
-        threads = [Thread(target=self.sample) for _ in range(self.NUM_THREADS)]
+        threads = [Thread(target=self._sample_bucket, args=pool)
+                   for pool in self.pools]
         map(lambda t: t.start(), threads)
         map(lambda t: t.join(), threads)
@@ -12,12 +12,13 @@ class PS(Collector):
         super(PS, self).__init__(settings)
         self.ssh_username = settings.ssh_username
         self.ssh_password = settings.ssh_password
-        self.nodes = settings.hostnames or list(self.get_nodes())
+        self.nodes = list(settings.hostnames or self.nodes)
         if hasattr(settings, "sync_gateway_nodes") and settings.sync_gateway_nodes:
             self.nodes += settings.sync_gateway_nodes
         self.ps = PSStats(hosts=self.nodes,
                           user=settings.ssh_username,
                           password=settings.ssh_password)
+        self.ps.instrumentation = self.instrumentation
 
     def update_metadata(self):
         self.mc.add_cluster()
@@ -25,10 +26,13 @@ class PS(Collector):
             self.mc.add_server(node)
 
     def sample(self):
-        for process in self.KNOWN_PROCESSES:
-            for node, stats in self.ps.get_samples(process).items():
-                if stats:
-                    self.update_metric_metadata(stats.keys(), server=node)
-                    self.store.append(stats,
-                                      cluster=self.cluster, server=node,
-                                      collector=self.COLLECTOR)
+        samples = self.ps.get_samples(self.KNOWN_PROCESSES)
+        for node, (uptime, clk_tck, counters, stats) in samples.items():
+            rates = self.get_rates(counters, server=node, timestamp=uptime)
+            stats.update(self.ps.get_metrics(rates, clk_tck))
+            if stats:
+                self.update_metric_metadata(stats.keys(), server=node)
+                self.store.append(stats,
+                                  cluster=self.cluster, server=node,
+                                  collector=self.COLLECTOR,
+                                  timestamp=self.timestamp)
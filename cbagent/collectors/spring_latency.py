@@ -1,9 +1,8 @@
-from time import time
-
 from spring.docgen import ExistingKey, NewDocument, NewNestedDocument
 from spring.querygen import ViewQueryGen, ViewQueryGenByType, OldN1QLQuery
 from spring.cbgen import CBGen, OldN1QLGen
 
+from cbagent.clock import monotonic
 from cbagent.collectors import Latency
 
 
@@ -13,6 +12,8 @@ class SpringLatency(Latency):
 
     METRICS = ("latency_set", "latency_get")
 
+    OPS = ("set", "get", "cas")
+
     def __init__(self, settings, workload, prefix=None):
         super(Latency, self).__init__(settings)
         self.clients = []
@@ -25,31 +26,56 @@ class SpringLatency(Latency):
                                          workload.working_set_access,
                                          prefix=prefix)
         if not hasattr(workload, 'doc_gen') or workload.doc_gen == 'old':
-            self.new_docs = NewDocument(workload.size)
+            doc_gen = NewDocument
         else:
-            self.new_docs = NewNestedDocument(workload.size)
+            doc_gen = NewNestedDocument
+        self.new_docs = doc_gen(workload.size)
         self.items = workload.items
 
+        self.init_probes(settings)
+        self.sizes = getattr(settings, "latency_sizes", None) or \
+            [workload.size]
+        self.sized_docs = dict((size, doc_gen(size)) for size in self.sizes)
+
+    def get_clients(self):
+        return self.clients
+
     def measure(self, client, metric):
         key = self.existing_keys.next(curr_items=self.items, curr_deletes=0)
         doc = self.new_docs.next(key)
 
-        t0 = time()
+        t0 = monotonic()
         if metric == "latency_set":
             client.create(key, doc)
         elif metric == "latency_get":
             client.read(key)
         elif metric == "latency_cas":
             client.cas(key, doc)
-        return 1000 * (time() - t0)  # Latency in ms
+        return 1000 * (monotonic() - t0)  # Latency in ms
+
+    def execute(self, client, op, size, n):
+        key = self.existing_keys.next(curr_items=self.items, curr_deletes=0)
+        if op == "get":
+            client.read(key)
+        elif op in ("set", "cas"):
+            doc = self.sized_docs[size].next(key)
+            if op == "set":
+                client.create(key, doc)
+            else:
+                client.cas(key, doc)
+        else:
+            raise ValueError("Unsupported operation: {}".format(op))
 
     def sample(self):
+        if self.rate:
+            return self._sample_open_loop()
         for bucket, client in self.clients:
             samples = {}
             for metric in self.METRICS:
                 samples[metric] = self.measure(client, metric)
             self.store.append(samples, cluster=self.cluster,
-                              bucket=bucket, collector=self.COLLECTOR)
+                              bucket=bucket, collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
 
 
 class SpringCasLatency(SpringLatency):
@@ -63,6 +89,8 @@ class SpringQueryLatency(SpringLatency):
 
     METRICS = ("latency_query", )
 
+    OPS = SpringLatency.OPS + ("query", )
+
     def __init__(self, settings, workload, ddocs, params, index_type,
                  prefix=None):
         super(SpringQueryLatency, self).__init__(settings, workload, prefix)
@@ -79,6 +107,14 @@ class SpringQueryLatency(SpringLatency):
         _, latency = client.query(ddoc_name, view_name, query=query)
         return 1000 * latency  # s -> ms
 
+    def execute(self, client, op, size, n):
+        if op != "query":
+            return super(SpringQueryLatency, self).execute(client, op, size, n)
+        key = self.existing_keys.next(curr_items=self.items, curr_deletes=0)
+        doc = self.new_docs.next(key)
+        ddoc_name, view_name, query = self.new_queries.next(doc)
+        client.query(ddoc_name, view_name, query=query)
+
 
 class SpringN1QLQueryLatency(SpringQueryLatency):
 
@@ -12,12 +12,13 @@ class TypePerf(Collector):
         super(TypePerf, self).__init__(settings)
         self.ssh_username = settings.ssh_username
         self.ssh_password = settings.ssh_password
-        self.nodes = settings.hostnames or list(self.get_nodes())
+        self.nodes = list(settings.hostnames or self.nodes)
         if hasattr(settings, "sync_gateway_nodes") and settings.sync_gateway_nodes:
             self.nodes += settings.sync_gateway_nodes
         self.tp = TPStats(hosts=self.nodes,
                           user=settings.ssh_username,
                           password=settings.ssh_password)
+        self.tp.instrumentation = self.instrumentation
 
     def update_metadata(self):
         self.mc.add_cluster()
@@ -31,4 +32,5 @@ class TypePerf(Collector):
                     self.update_metric_metadata(stats.keys(), server=node)
                     self.store.append(stats,
                                       cluster=self.cluster, server=node,
-                                      collector=self.COLLECTOR)
+                                      collector=self.COLLECTOR,
+                                      timestamp=self.timestamp)
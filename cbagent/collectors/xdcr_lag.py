@@ -1,10 +1,13 @@
-from time import time, sleep
 from threading import Thread
+from time import time
 from uuid import uuid4
 
 from logger import logger
 
+from cbagent.clock import monotonic
 from cbagent.collectors import Latency
+from cbagent.collectors.libstats.histogram import Histogram
+from cbagent.collectors.libstats.poll import poll_keys
 from cbagent.collectors.libstats.pool import Pool
 
 uhex = lambda: uuid4().hex
@@ -12,11 +15,22 @@ uhex = lambda: uuid4().hex
 
 class XdcrLag(Latency):
 
+    """Replication lag measured with batches of probe keys.
+
+    Every interval a batch of timestamped keys is written to the source
+    bucket with a single multi-set. One watcher polls the destination bucket
+    with multi-gets for all keys that haven't arrived yet and records arrival
+    time of every key. Lag distribution is reported per bucket, after that
+    probe keys are deleted on both sides.
+    """
+
     COLLECTOR = "xdcr_lag"
 
     METRICS = ("xdcr_lag", )
 
-    NUM_THREADS = 10
+    NUM_PROBES = 100
+
+    TIMEOUT = 60
 
     INITIAL_REQUEST_INTERVAL = 0.01
 
@@ -27,9 +41,13 @@ class XdcrLag(Latency):
     def __init__(self, settings):
         super(Latency, self).__init__(settings)
 
+        self.probes = getattr(settings, "xdcr_lag_probes", self.NUM_PROBES)
+        self.timeout = getattr(settings, "xdcr_lag_timeout", self.TIMEOUT)
+
         self.pools = []
         for bucket in self.get_buckets():
             src_pool = Pool(
+                initial=1,
                 bucket=bucket,
                 host=settings.master_node,
                 username=bucket,
@@ -37,6 +55,7 @@ class XdcrLag(Latency):
                 quiet=True,
             )
             dst_pool = Pool(
+                initial=1,
                 bucket=bucket,
                 host=settings.dest_master_node,
                 username=bucket,
@@ -45,48 +64,65 @@ class XdcrLag(Latency):
                 unlock_gil=False,
             )
             self.pools.append((bucket, src_pool, dst_pool))
+        self.instrumentation.add_source(self._get_pool_stats)
+
+    def _get_pool_stats(self):
+        stats = {}
+        for bucket, src_pool, dst_pool in self.pools:
+            for side, pool in (("src", src_pool), ("dst", dst_pool)):
+                for key, value in pool.stats().items():
+                    stats["{}_{}_{}_{}".format(self.COLLECTOR, bucket, side,
+                                               key)] = value
+        return stats
+
+    def get_metrics(self):
+        return Histogram.metrics("xdcr_lag") + ("xdcr_lag_timeouts", )
 
     def _measure_lags(self, src_pool, dst_pool):
         src_client = src_pool.get_client()
         dst_client = dst_pool.get_client()
+        try:
+            ts = time()
+            keys = ["xdcr_{}".format(uhex()) for _ in range(self.probes)]
+            src_client.set_multi(dict((key, {"ts": ts}) for key in keys))
+            t0 = monotonic()
+
+            arrivals = poll_keys(
+                lambda batch: [key for key, rv in
+                               dst_client.get_multi(batch, quiet=True).items()
+                               if rv.success],
+                keys, t0, self.timeout,
+                initial_interval=self.INITIAL_REQUEST_INTERVAL,
+                max_interval=self.MAX_REQUEST_INTERVAL,
+                sampling_error=self.SAMPLING_ERROR,
+            )
 
-        key = "xdcr_{}".format(uhex())
-
-        req_interval = self.INITIAL_REQUEST_INTERVAL
-        src_client.set(key, key)
-        t0 = time()
-        while True:
-            r = dst_client.get(key)
-            if r.value:
-                break
-            else:
-                sleep(req_interval)
-                req_interval = min(
-                    (time() - t0) * self.SAMPLING_ERROR,
-                    self.MAX_REQUEST_INTERVAL
-                )
-        t1 = time()
-
-        src_client.delete(key)
-
-        src_pool.release_client(src_client)
-        dst_pool.release_client(dst_client)
-
-        return {"xdcr_lag": (t1 - t0) * 1000}  # s -> ms
+            src_client.delete_multi(keys, quiet=True)
+            dst_client.delete_multi(keys, quiet=True)
+        finally:
+            src_pool.release_client(src_client)
+            dst_pool.release_client(dst_client)
+
+        histogram = Histogram()
+        for t1 in arrivals.values():
+            histogram.record((t1 - t0) * 10 ** 6)  # s -> us
+        lags = histogram.summary("xdcr_lag", scale=0.001)  # us -> ms
+        lags["xdcr_lag_timeouts"] = len(keys) - len(arrivals)
+        return lags
+
+    def _sample_bucket(self, bucket, src_pool, dst_pool):
+        try:
+            lags = self._measure_lags(src_pool, dst_pool)
+            self.store.append(lags,
+                              cluster=self.cluster,
+                              bucket=bucket,
+                              collector=self.COLLECTOR,
+                              timestamp=self.timestamp)
+        except Exception as e:
+            logger.warn(e)
 
     def sample(self):
-        while True:
-            try:
-                for bucket, src_pool, dst_pool in self.pools:
-                    lags = self._measure_lags(src_pool, dst_pool)
-                    self.store.append(lags,
-                                      cluster=self.cluster,
-                                      bucket=bucket,
-                                      collector=self.COLLECTOR)
-            except Exception as e:
-                logger.warn(e)
-
-    def collect(self):
-        threads = [Thread(target=self.sample) for _ in range(self.NUM_THREADS)]
+        threads = [Thread(target=self._sample_bucket, args=pools)
+                   for pools in self.pools]
         map(lambda t: t.start(), threads)
         map(lambda t: t.join(), threads)
@@ -0,0 +1,330 @@
+import json
+import math
+import mmap
+import os
+import struct
+import zlib
+
+FLOAT = struct.Struct(">d")
+
+UINT64 = struct.Struct(">Q")
+
+NAN = float("nan")
+
+
+class BitWriter(object):
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, nbits):
+        self.acc = (self.acc << nbits) | value
+        self.nbits += nbits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.buf.append((self.acc >> self.nbits) & 0xff)
+        self.acc &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        buf = bytearray(self.buf)
+        if self.nbits:
+            buf.append((self.acc << (8 - self.nbits)) & 0xff)
+        return bytes(buf)
+
+
+class BitReader(object):
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def read(self, nbits):
+        value = 0
+        while nbits:
+            byte = self.data[self.pos >> 3]
+            offset = self.pos & 7
+            take = min(8 - offset, nbits)
+            value = (value << take) | \
+                ((byte >> (8 - offset - take)) & ((1 << take) - 1))
+            self.pos += take
+            nbits -= take
+        return value
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+# Delta-of-delta buckets: (control bits, control length, value length)
+TS_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 64))
+
+
+def encode_timestamps(timestamps):
+    """Integer timestamps (ms) as delta-of-delta, Gorilla-style. Regular
+    intervals take one bit per timestamp."""
+    writer = BitWriter()
+    prev, prev_delta = timestamps[0], 0
+    writer.write(_zigzag(prev) & 0xffffffffffffffff, 64)
+    for ts in timestamps[1:]:
+        delta = ts - prev
+        dod = _zigzag(delta - prev_delta) & 0xffffffffffffffff
+        prev, prev_delta = ts, delta
+        if not dod:
+            writer.write(0, 1)
+            continue
+        for control, control_bits, value_bits in TS_BUCKETS:
+            if dod < 1 << value_bits:
+                writer.write(control, control_bits)
+                writer.write(dod, value_bits)
+                break
+    return writer.getvalue()
+
+
+def decode_timestamps(data, count):
+    reader = BitReader(data)
+    prev = _unzigzag(reader.read(64))
+    timestamps = [prev]
+    delta = 0
+    for _ in range(count - 1):
+        if reader.read(1):
+            value_bits = 64
+            for _, control_bits, bits in TS_BUCKETS[:-1]:
+                if not reader.read(1):
+                    value_bits = bits
+                    break
+            delta += _unzigzag(reader.read(value_bits))
+        prev += delta
+        timestamps.append(prev)
+    return timestamps
+
+
+def _to_bits(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = NAN
+    return UINT64.unpack(FLOAT.pack(value))[0]
+
+
+def _leading_zeros(value):
+    return 64 - value.bit_length()
+
+
+def _trailing_zeros(value):
+    return (value & -value).bit_length() - 1
+
+
+def encode_values(values):
+    """Float values XOR-ed with the previous one, Gorilla-style: unchanged
+    values take one bit, slowly changing ones take only their meaningful
+    bits. Non-numeric values are stored as NaN."""
+    writer = BitWriter()
+    prev = _to_bits(values[0])
+    writer.write(prev, 64)
+    prev_leading, prev_trailing = 65, 65
+    for value in values[1:]:
+        bits = _to_bits(value)
+        xor = bits ^ prev
+        prev = bits
+        if not xor:
+            writer.write(0, 1)
+            continue
+        leading = min(_leading_zeros(xor), 31)
+        trailing = _trailing_zeros(xor)
+        if leading >= prev_leading and trailing >= prev_trailing:
+            writer.write(0b10, 2)
+            writer.write(xor >> prev_trailing,
+                         64 - prev_leading - prev_trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(meaningful & 63, 6)  # 64 is stored as 0
+            writer.write(xor >> trailing, meaningful)
+            prev_leading, prev_trailing = leading, trailing
+    return writer.getvalue()
+
+
+def decode_values(data, count):
+    reader = BitReader(data)
+    prev = reader.read(64)
+    values = [prev]
+    leading, trailing = 0, 0
+    for _ in range(count - 1):
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            prev ^= reader.read(64 - leading - trailing) << trailing
+        values.append(prev)
+    return [FLOAT.unpack(UINT64.pack(value))[0] for value in values]
+
+
+class Block(object):
+
+    """Immutable columnar block: one timestamp column and one value column
+    per metric, all of the same length. Metrics missing in a point are
+    stored as NaN.
+
+    Layout: fixed header (magic, number of points, first and last timestamp,
+    lengths of metadata and columns), zlib-compressed JSON metadata (metric
+    names and column sizes) and concatenated column data.
+    """
+
+    MAGIC = b"CBTB"
+
+    HEADER = struct.Struct(">4sIqqII")
+
+    @classmethod
+    def encode(cls, points):
+        """points is a list of (timestamp in seconds, {metric: value})."""
+        timestamps = [int(ts * 1000) for ts, _ in points]  # s -> ms
+        metrics = sorted(set(m for _, data in points for m in data))
+        columns = [encode_timestamps(timestamps)]
+        for metric in metrics:
+            columns.append(encode_values([data.get(metric)
+                                          for _, data in points]))
+        meta = zlib.compress(json.dumps({
+            "metrics": metrics,
+            "columns": [len(column) for column in columns],
+        }).encode("utf-8"))
+        body = b"".join(columns)
+        header = cls.HEADER.pack(cls.MAGIC, len(points), timestamps[0],
+                                 timestamps[-1], len(meta), len(body))
+        return header + meta + body
+
+    @classmethod
+    def valid_size(cls, buf):
+        """Size of the buffer prefix made of complete blocks."""
+        offset = 0
+        while offset + cls.HEADER.size <= len(buf):
+            magic, _, _, _, meta_size, body_size = \
+                cls.HEADER.unpack_from(buf, offset)
+            end = offset + cls.HEADER.size + meta_size + body_size
+            if magic != cls.MAGIC or end > len(buf):
+                break
+            offset = end
+        return offset
+
+    @classmethod
+    def scan(cls, buf, start=None, end=None):
+        """Yield (timestamp, {metric: value}) from all complete blocks in a
+        buffer. Blocks outside of [start, end] (ms) are skipped without
+        decoding. A truncated trailing block is ignored."""
+        offset = 0
+        while offset + cls.HEADER.size <= len(buf):
+            magic, count, first, last, meta_size, body_size = \
+                cls.HEADER.unpack_from(buf, offset)
+            meta_offset = offset + cls.HEADER.size
+            body_offset = meta_offset + meta_size
+            if magic != cls.MAGIC or body_offset + body_size > len(buf):
+                break
+            offset = body_offset + body_size
+            if (start is not None and last < start) or \
+                    (end is not None and first > end):
+                continue
+
+            meta = json.loads(zlib.decompress(
+                buf[meta_offset:body_offset]).decode("utf-8"))
+            columns = []
+            column_offset = body_offset
+            for size in meta["columns"]:
+                columns.append(buf[column_offset:column_offset + size])
+                column_offset += size
+
+            timestamps = decode_timestamps(columns[0], count)
+            values = [decode_values(column, count) for column in columns[1:]]
+            for i, ts in enumerate(timestamps):
+                if (start is not None and ts < start) or \
+                        (end is not None and ts > end):
+                    continue
+                yield ts / 1000.0, dict(
+                    (metric, column[i])
+                    for metric, column in zip(meta["metrics"], values)
+                    if not math.isnan(column[i])
+                )
+
+
+class ColumnarSeries(object):
+
+    """Append-only series of blocks, stored in numbered segment files of
+    a series directory. A new segment is started once the current one
+    exceeds segment_size bytes."""
+
+    SUFFIX = ".seg"
+
+    def __init__(self, path, segment_size=64 * 2 ** 20):
+        self.path = path
+        self.segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._fh = None
+
+    def segments(self):
+        return sorted(os.path.join(self.path, fname)
+                      for fname in os.listdir(self.path)
+                      if fname.endswith(self.SUFFIX))
+
+    def _open(self):
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < self.segment_size:
+            fname = segments[-1]
+            self._truncate(fname)
+        else:
+            fname = os.path.join(self.path, "{:08d}{}".format(
+                len(segments), self.SUFFIX))
+        return open(fname, "ab")
+
+    @staticmethod
+    def _truncate(fname):
+        """Drop a partially written block left by an interrupted write."""
+        with open(fname, "rb") as fh:
+            size = Block.valid_size(fh.read())
+        if size < os.path.getsize(fname):
+            with open(fname, "r+b") as fh:
+                fh.truncate(size)
+
+    def append(self, points):
+        if not points:
+            return 0
+        if self._fh is None or self._fh.tell() >= self.segment_size:
+            self.close()
+            self._fh = self._open()
+        block = Block.encode(points)
+        self._fh.write(block)
+        self._fh.flush()
+        return len(block)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def scan(self, start=None, end=None):
+        """Yield (timestamp, {metric: value}) in time range (seconds)."""
+        if start is not None:
+            start = int(start * 1000)  # s -> ms
+        if end is not None:
+            end = int(end * 1000)
+        for fname in self.segments():
+            if not os.path.getsize(fname):
+                continue
+            with open(fname, "rb") as fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for point in Block.scan(mm, start, end):
+                        yield point
+                finally:
+                    mm.close()
+
+
+def list_series(path):
+    return sorted(name for name in os.listdir(path)
+                  if os.path.isdir(os.path.join(path, name)))
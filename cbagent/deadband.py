@@ -0,0 +1,66 @@
+from threading import Lock
+
+from cbagent.registry import LRUCache
+
+
+class Deadband(object):
+
+    """Change-only encoding of samples.
+
+    Every series remembers the last written value of each metric. A new
+    value is suppressed when it equals the last written one or differs from
+    it by no more than the absolute (abs_band) or relative (rel_band, as a
+    fraction of the last value) deadband. Every keyframe-th point of a series
+    is written in full, so a reader can always reconstruct the series by
+    carrying the last value forward from the most recent keyframe.
+
+    At most max_series series are remembered, the least recently written
+    ones are evicted and start over with a keyframe.
+    """
+
+    def __init__(self, abs_band=0, rel_band=0, keyframe=30, max_series=20000):
+        self.abs_band = abs_band
+        self.rel_band = rel_band
+        self.keyframe = keyframe
+        # series ID -> [points since keyframe, last values]
+        self.series = LRUCache(max_series)
+        self.written = 0
+        self.suppressed = 0
+        self._lock = Lock()
+
+    def _changed(self, last, value):
+        if value == last:
+            return False
+        try:
+            delta = abs(float(value) - float(last))
+        except (TypeError, ValueError):
+            return True
+        return delta > self.abs_band and \
+            delta > self.rel_band * abs(float(last))
+
+    def filter(self, series_id, data):
+        """Return values of the point that have to be written."""
+        with self._lock:
+            state = self.series.get(series_id)
+            if state is None or state[0] >= self.keyframe - 1:
+                self.series.put(series_id, [0, dict(data)])
+                self.written += len(data)
+                return data
+
+            state[0] += 1
+            last_values = state[1]
+            changed = {}
+            for metric, value in data.items():
+                if metric not in last_values or \
+                        self._changed(last_values[metric], value):
+                    changed[metric] = last_values[metric] = value
+            self.written += len(changed)
+            self.suppressed += len(data) - len(changed)
+            return changed
+
+    def stats(self):
+        with self._lock:
+            return {"deadband_written": self.written,
+                    "deadband_suppressed": self.suppressed,
+                    "deadband_series": len(self.series),
+                    "deadband_evicted": self.series.evicted}
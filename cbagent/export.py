@@ -0,0 +1,58 @@
+import csv
+import json
+import os
+import sys
+from optparse import OptionParser
+
+from cbagent.columnar import ColumnarSeries, list_series
+
+
+def export(path, series, start, end, fmt, output):
+    if fmt == "csv":
+        writer = csv.writer(output)
+        writer.writerow(("series", "timestamp", "metric", "value"))
+    for name in series:
+        for timestamp, data in ColumnarSeries(os.path.join(path, name)).scan(
+                start, end):
+            if fmt == "csv":
+                for metric, value in sorted(data.items()):
+                    writer.writerow((name, timestamp, metric, repr(value)))
+            else:
+                output.write(json.dumps({"series": name, "ts": timestamp,
+                                         "samples": data}) + "\n")
+
+
+def main():
+    parser = OptionParser(prog="cbagent-export",
+                          usage="%prog [options] path [series ...]")
+
+    parser.add_option("--start", type="float", dest="start",
+                      help="Start of time range (Unix time)")
+    parser.add_option("--end", type="float", dest="end",
+                      help="End of time range (Unix time)")
+    parser.add_option("-f", "--format", dest="format", default="json",
+                      choices=("json", "csv"),
+                      help="Output format: json (one point per line) or csv")
+    parser.add_option("-l", "--list", action="store_true", dest="list",
+                      help="List series and exit")
+
+    options, args = parser.parse_args()
+
+    if not args:
+        sys.exit("No store path provided")
+    path, series = args[0], args[1:]
+
+    available = list_series(path)
+    if options.list:
+        for name in available:
+            print(name)
+        return
+
+    for name in series:
+        if name not in available:
+            sys.exit("Unknown series: {}".format(name))
+    export(path, series or available, options.start, options.end,
+           options.format, sys.stdout)
+
+if __name__ == '__main__':
+    main()
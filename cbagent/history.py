@@ -0,0 +1,207 @@
+from threading import Lock
+from time import time
+
+import numpy as np
+from logger import logger
+
+from cbagent.registry import LRUCache
+from cbagent.stores import Store
+
+
+class SeriesBuffer(object):
+
+    """Fixed-size buffer of the most recent samples of one series: int64
+    timestamps (in ms) and a float64 matrix with a column per metric.
+    Metrics missing from a sample are NaN. A sample is written as a single
+    row, so the per-metric work is done by NumPy.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.empty((capacity, 0), dtype=np.float64)
+        self.columns = {}  # metric -> column
+        self.pos = 0  # next row to write
+        self.count = 0
+        self._keys = None  # metrics of the last sample, in dict order
+        self._index = None  # and their columns
+
+    def __len__(self):
+        return self.count
+
+    def _get_index(self, metrics):
+        new = [metric for metric in metrics if metric not in self.columns]
+        if new:
+            for metric in new:
+                self.columns[metric] = len(self.columns)
+            missing = np.full((self.capacity, len(new)), np.nan)
+            self.values = np.hstack((self.values, missing))
+        return np.array([self.columns[metric] for metric in metrics],
+                        dtype=np.intp)
+
+    def append(self, timestamp, data):
+        metrics, values = data.keys(), data.values()
+        try:
+            row = np.array(values, dtype=np.float64)
+            if row.shape != (len(values), ):
+                raise ValueError("nested values")
+        except (TypeError, ValueError):  # non-numeric values are ignored
+            numeric = []
+            for metric, value in zip(metrics, values):
+                try:
+                    numeric.append((metric, float(value)))
+                except (TypeError, ValueError):
+                    continue
+            metrics = [metric for metric, _ in numeric]
+            row = np.array([value for _, value in numeric], dtype=np.float64)
+            index = self._get_index(metrics)
+        else:
+            if metrics != self._keys:  # same metrics come in the same order
+                self._keys, self._index = metrics, self._get_index(metrics)
+            index = self._index
+
+        self.timestamps[self.pos] = int(timestamp * 1000)  # s -> ms
+        self.values[self.pos].fill(np.nan)
+        self.values[self.pos, index] = row
+        self.pos = (self.pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self, column):
+        """Timestamps (in ms) and values of given column, oldest first."""
+        if self.count < self.capacity:
+            return (self.timestamps[:self.count],
+                    self.values[:self.count, column])
+        return (np.concatenate((self.timestamps[self.pos:],
+                                self.timestamps[:self.pos])),
+                np.concatenate((self.values[self.pos:, column],
+                                self.values[:self.pos, column])))
+
+class RingBuffer(object):
+
+    """Recent (timestamp, value) pairs of one metric, a view of its
+    SeriesBuffer column. Window queries return chronologically ordered
+    arrays and aggregates are computed with vectorized NumPy operations.
+    """
+
+    def __init__(self, series, column):
+        self.series = series
+        self.column = column
+
+    def __len__(self):
+        return len(self.window()[1])
+
+    def window(self, seconds=None, now=None):
+        """Timestamps (in seconds) and values from the last given number of
+        seconds, all of them if seconds is None."""
+        timestamps, values = self.series.ordered(self.column)
+        if seconds is not None:
+            start = int(((now or time()) - seconds) * 1000)
+            i = np.searchsorted(timestamps, start)
+            timestamps, values = timestamps[i:], values[i:]
+        sampled = ~np.isnan(values)
+        return timestamps[sampled] / 1000.0, values[sampled]
+
+    def mean(self, seconds=None, now=None):
+        values = self.window(seconds, now)[1]
+        if len(values):
+            return float(values.mean())
+
+    def min(self, seconds=None, now=None):
+        values = self.window(seconds, now)[1]
+        if len(values):
+            return float(values.min())
+
+    def max(self, seconds=None, now=None):
+        values = self.window(seconds, now)[1]
+        if len(values):
+            return float(values.max())
+
+    def percentile(self, percentile, seconds=None, now=None):
+        values = self.window(seconds, now)[1]
+        if len(values):
+            return float(np.percentile(values, percentile))
+
+    def rate(self, seconds=None, now=None):
+        """Per-second rate of a monotonic counter. Counter resets are
+        handled by counting the value after the reset as the increase."""
+        timestamps, values = self.window(seconds, now)
+        if len(values) < 2 or timestamps[-1] == timestamps[0]:
+            return
+        deltas = np.diff(values)
+        resets = deltas < 0
+        deltas[resets] = values[1:][resets]
+        return float(deltas.sum() / (timestamps[-1] - timestamps[0]))
+
+
+class History(object):
+
+    """Recent samples of all series written to the store, kept in memory for
+    in-agent consumers (derived metrics, alerting, local dashboards).
+
+    Every store series gets a SeriesBuffer of given capacity which holds all
+    of its metrics. At most max_series buffers are kept, so memory never
+    exceeds max_series * capacity * (metrics per series + 1) * 8 bytes;
+    buffers of series which are no longer sampled (e.g., removed buckets or
+    nodes) are evicted in approximate LRU order. Series which show up again
+    after eviction are counted and logged: if it happens all the time,
+    max_series is too small for the deployment and buffers never fill up.
+    Non-numeric values are ignored.
+    """
+
+    def __init__(self, capacity=120, max_series=1000):
+        self.capacity = capacity
+        self.max_series = max_series
+        # db_name -> SeriesBuffer
+        self.buffers = LRUCache(max_series, on_evict=self._evicted)
+        self.evicted = LRUCache(max_series)  # names of evicted series
+        self.thrashed = 0
+        self._lock = Lock()
+
+    def _evicted(self, db_name, buf):
+        self.evicted.put(db_name, True)
+
+    def append(self, db_name, timestamp, data):
+        with self._lock:
+            buf = self.buffers.get(db_name)
+            if buf is None:
+                if self.evicted.get(db_name):
+                    self.thrashed += 1
+                    if self.thrashed == 1 or not self.thrashed % 1000:
+                        logger.warn("{} series came back to history after "
+                                    "eviction, history_max_series may be too "
+                                    "small".format(self.thrashed))
+                buf = SeriesBuffer(self.capacity)
+                self.buffers.put(db_name, buf)
+            buf.append(timestamp, data)
+
+    def _get(self, metric, cluster="", server=None, bucket=None,
+             collector=None):
+        db_name = Store.build_dbname(cluster, server, bucket, collector)
+        buf = self.buffers.get(db_name)
+        if buf is not None and metric in buf.columns:
+            return RingBuffer(buf, buf.columns[metric])
+
+    def get(self, metric, cluster="", server=None, bucket=None,
+            collector=None):
+        """RingBuffer of given metric (None if it was never sampled or has
+        been evicted). Series are addressed the same way as in
+        Store.append()."""
+        with self._lock:
+            return self._get(metric, cluster, server, bucket, collector)
+
+    def query(self, func, metric, seconds=None, **series):
+        """Lock-protected window aggregate, e.g.
+        query("percentile", "ops", 60, percentile=99, bucket="default",
+        cluster="c1", collector="ns_server")."""
+        kwargs = dict((key, series.pop(key)) for key in ("percentile", "now")
+                      if key in series)
+        with self._lock:
+            buf = self._get(metric, **series)
+            if buf is not None:
+                return getattr(buf, func)(seconds=seconds, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {"history_series": len(self.buffers),
+                    "history_evicted": self.buffers.evicted,
+                    "history_thrashed": self.thrashed}
@@ -0,0 +1,122 @@
+import re
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import sleep
+
+from logger import logger
+
+from cbagent.clock import monotonic
+
+
+class NullInstrumentation(object):
+
+    """Instrumentation which records nothing, used until the real one is
+    attached."""
+
+    def timing(self, name, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+    @contextmanager
+    def timer(self, name):
+        yield
+
+
+class Instrumentation(Thread):
+
+    """Timing and health metrics of the agent itself.
+
+    Timers aggregate durations per report interval and are reported in ms as
+    <name> (mean), <name>_max and <name>_count. Counters are reported as the
+    increase since the previous report. Sources are functions returning
+    dictionaries of current values (e.g. queue depth). Everything is written
+    through the regular store as metrics of "agent" collector.
+    """
+
+    COLLECTOR = "agent"
+
+    def __init__(self, cluster, interval=10):
+        super(Instrumentation, self).__init__()
+        self.daemon = True
+
+        self.cluster = cluster
+        self.interval = interval
+        self.store = None
+        self.mc = None
+
+        self.timers = {}  # name -> [count, total, max]
+        self.counters = {}
+        self.sources = []
+        self._lock = Lock()
+
+    @staticmethod
+    def get_name(name):
+        return re.sub(r"[^\w]+", "_", name).strip("_")
+
+    def timing(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        t0 = monotonic()
+        try:
+            yield
+        finally:
+            self.timing(name, monotonic() - t0)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def snapshot(self):
+        with self._lock:
+            timers, self.timers = self.timers, {}
+            counters = dict(self.counters)
+            for name in self.counters:
+                self.counters[name] = 0
+
+        samples = counters
+        for name, (count, total, max_) in timers.items():
+            samples[name] = 1000 * total / count  # s -> ms
+            samples[name + "_max"] = 1000 * max_
+            samples[name + "_count"] = count
+        for source in self.sources:
+            try:
+                samples.update(source())
+            except Exception as e:
+                logger.warn("Failed to read agent stats: {}".format(e))
+        return dict((self.get_name(name), value)
+                    for name, value in samples.items())
+
+    def report(self):
+        samples = self.snapshot()
+        for metric in samples:
+            self.mc.add_metric(metric, collector=self.COLLECTOR)
+        self.store.append(samples, cluster=self.cluster,
+                          collector=self.COLLECTOR)
+
+    def attach(self, store, mc):
+        """Start periodic reports through given store."""
+        self.store = store
+        self.mc = mc
+        self.start()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.report()
+            except Exception as e:
+                logger.warn("Failed to report agent stats: {}".format(e))
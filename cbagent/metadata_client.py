@@ -1,7 +1,17 @@
+import json
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from threading import Lock, Thread
+from time import sleep
+
 import requests
 from decorator import decorator
 from logger import logger
 
+from cbagent.instrumentation import NullInstrumentation
+from cbagent.registry import LRUCache
+from cbagent.rest import HTTPClient
+
 
 class InternalServerError(Exception):
 
@@ -22,31 +32,97 @@ def interrupt(request, *args, **kargs):
 
 class RestClient(object):
 
-    def __init__(self):
-        self.session = requests.Session()
+    POOL_SIZE = 8
 
-    @interrupt
-    def post(self, url, data):
-        r = self.session.post(url=url, data=data)
+    def __init__(self, http=None):
+        self.http = http or HTTPClient(pool_size=self.POOL_SIZE)
+        self.session = self.http.session
+        self.instrumentation = NullInstrumentation()
+
+    def _post(self, url, data):
+        with self.instrumentation.timer("metadata_request"):
+            r = self.http.post(url, data=data)
         if r.status_code == 500:
             raise InternalServerError(url)
+        return r
 
     @interrupt
-    def get(self, url, params):
-        r = self.session.get(url=url, params=params)
+    def post(self, url, data):
+        self._post(url, data)
+
+    def _get(self, url, params):
+        with self.instrumentation.timer("metadata_request"):
+            r = self.http.get(url, params=params)
         if r.status_code == 500:
             raise InternalServerError(url)
         return r.json()
 
+    @interrupt
+    def get(self, url, params):
+        return self._get(url, params)
+
+
+class NullMetadataClient(object):
+
+    """Metadata client which registers nothing, used when data doesn't go
+    to cbmonitor (e.g., FileStore runs)."""
+
+    def __init__(self):
+        self.instrumentation = NullInstrumentation()
+
+    def add_cluster(self):
+        pass
+
+    def add_server(self, address):
+        pass
+
+    def add_bucket(self, name):
+        pass
+
+    def add_metric(self, name, bucket=None, server=None, collector=None):
+        pass
+
+    def add_snapshot(self, name, ts_from, ts_to):
+        pass
+
+    def flush(self):
+        pass
+
 
 class MetadataClient(RestClient):
 
-    def __init__(self, settings):
-        super(MetadataClient, self).__init__()
+    """cbmonitor client with a local registry of known items.
+
+    add_cluster, add_server, add_bucket and add_metric don't talk to cbmonitor
+    at all, so they never block or fail. New items are checked against a
+    bounded local cache (max_items per kind) and queued; a background
+    registrar coalesces the queue and flushes it in bulk - clusters first, then servers and buckets which are
+    not in cbmonitor yet (existing ones are fetched once), then metrics.
+    Metrics go to the batched add_metrics endpoint when cbmonitor provides
+    one and to concurrent keep-alive POSTs otherwise. Failed items are
+    requeued.
+    """
+
+    COALESCE_DELAY = 0.5
+
+    RETRY_DELAY = 5
+
+    ORDER = ("cluster", "server", "bucket", "metric")
+
+    def __init__(self, settings, http=None, max_items=100000):
+        super(MetadataClient, self).__init__(http)
         self.settings = settings
         self.base_url = "http://{}/cbmonitor".format(
             settings.cbmonitor_host_port)
 
+        self.queue = Queue()
+        self.max_items = max_items
+        self.known = {}  # kind -> LRUCache of keys queued by this client
+        self.existing = {}  # kind -> keys found in cbmonitor
+        self.bulk_metrics = None  # unknown until the first request
+        self._lock = Lock()
+        self.registrar = None
+
     def get_clusters(self):
         url = self.base_url + "/get_clusters/"
         return self.get(url, {})
@@ -61,45 +137,148 @@ class MetadataClient(RestClient):
         params = {"cluster": self.settings.cluster}
         return self.get(url, params)
 
-    def add_cluster(self):
-        if self.settings.cluster in self.get_clusters():
-            return
+    def _get_existing(self, kind):
+        """Keys of clusters, servers or buckets which cbmonitor already has,
+        fetched once by the registrar."""
+        if kind not in self.existing:
+            url = self.base_url + "/get_{}s/".format(kind)
+            params = {}
+            if kind != "cluster":
+                params["cluster"] = self.settings.cluster
+            self.existing[kind] = set(self._get(url, params))
+        return self.existing[kind]
 
-        url = self.base_url + "/add_cluster/"
-        data = {"name": self.settings.cluster}
+    def _register(self, kind, key, data):
+        self.instrumentation.incr("metadata_calls")
+        with self._lock:
+            known = self.known.get(kind)
+            if known is None:
+                known = self.known[kind] = LRUCache(self.max_items)
+            if known.get(key):
+                return
+            known.put(key, True)
+        self.instrumentation.incr("metadata_queued")
+        self.queue.put((kind, key, data))
+        self._start_registrar()
 
-        logger.info("Adding cluster: {}".format(self.settings.cluster))
-        self.post(url, data)
+    def _start_registrar(self):
+        if self.registrar is None:
+            with self._lock:
+                if self.registrar is None:
+                    self.registrar = Thread(target=self._run_registrar)
+                    self.registrar.daemon = True
+                    self.registrar.start()
 
-    def add_server(self, address):
-        if address in self.get_servers():
-            return
+    def _drain(self):
+        items = [self.queue.get()]
+        sleep(self.COALESCE_DELAY)  # let the rest of the batch arrive
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except Empty:
+                return items
 
-        url = self.base_url + "/add_server/"
-        data = {"address": address, "cluster": self.settings.cluster}
+    def _run_registrar(self):
+        while True:
+            items = self._drain()
+            try:
+                failed = self._flush(items)
+            except Exception as e:
+                logger.warn("Metadata flush failed: {}".format(e))
+                failed = items
+            if failed:
+                logger.warn("Requeuing {} metadata items".format(len(failed)))
+                sleep(self.RETRY_DELAY)
+                for item in failed:
+                    self.queue.put(item)
+            for _ in items:
+                self.queue.task_done()
 
-        logger.info("Adding server: {}".format(address))
-        self.post(url, data)
+    def _post_item(self, item):
+        kind, _, data = item
+        try:
+            self._post(self.base_url + "/add_{}/".format(kind), data)
+        except (requests.RequestException, InternalServerError) as e:
+            logger.warn("Failed to add {}: {}".format(kind, e))
+            return item
 
-    def add_bucket(self, name):
-        if name in self.get_buckets():
-            return
+    def _post_many(self, items):
+        if not items:
+            return []
+        pool = ThreadPool(min(self.POOL_SIZE, len(items)))
+        try:
+            return [item for item in pool.map(self._post_item, items) if item]
+        finally:
+            pool.close()
+
+    def _post_metrics(self, items):
+        if self.bulk_metrics is not False:
+            url = self.base_url + "/add_metrics/"
+            data = {"metrics": json.dumps([data for _, _, data in items])}
+            try:
+                with self.instrumentation.timer("metadata_request"):
+                    r = self.http.post(url, data=data)
+            except requests.RequestException as e:
+                logger.warn("Bulk metric registration failed: {}".format(e))
+                return items
+            if r.status_code in (200, 201, 202):
+                self.bulk_metrics = True
+                return []
+            if self.bulk_metrics is None and \
+                    (r.status_code == 404 or r.status_code >= 500):
+                logger.info("Bulk metric registration is not supported")
+                self.bulk_metrics = False
+            else:
+                logger.warn("Bulk metric registration failed: {}".format(
+                    r.status_code))
+                return items
+        return self._post_many(items)
 
-        logger.info("Adding bucket: {}".format(name))
+    def _flush(self, items):
+        failed = []
+        for kind in self.ORDER:
+            batch = [item for item in items if item[0] == kind]
+            if not batch:
+                continue
+            if kind == "metric":
+                logger.info("Adding {} metrics".format(len(batch)))
+                failed += self._post_metrics(batch)
+                continue
+            try:
+                existing = self._get_existing(kind)
+            except (requests.RequestException, InternalServerError,
+                    ValueError) as e:
+                logger.warn("Failed to get {}s: {}".format(kind, e))
+                failed += batch
+                continue
+            batch = [item for item in batch if item[1] not in existing]
+            for _, key, _ in batch:
+                logger.info("Adding {}: {}".format(kind, key))
+            failed += self._post_many(batch)
+        return failed
 
-        url = self.base_url + "/add_bucket/"
+    def flush(self):
+        """Block until all queued items are registered."""
+        self.queue.join()
+
+    def add_cluster(self):
+        data = {"name": self.settings.cluster}
+        self._register("cluster", self.settings.cluster, data)
+
+    def add_server(self, address):
+        data = {"address": address, "cluster": self.settings.cluster}
+        self._register("server", address, data)
+
+    def add_bucket(self, name):
         data = {"name": name, "cluster": self.settings.cluster}
-        self.post(url, data)
+        self._register("bucket", name, data)
 
     def add_metric(self, name, bucket=None, server=None, collector=None):
-        logger.debug("Adding metric: {}".format(name))
-
-        url = self.base_url + "/add_metric/"
         data = {"name": name, "cluster": self.settings.cluster}
         for extra_param in ("bucket", "server", "collector"):
             if eval(extra_param) is not None:
                 data[extra_param] = eval(extra_param)
-        self.post(url, data)
+        self._register("metric", (name, bucket, server, collector), data)
 
     def add_snapshot(self, name, ts_from, ts_to):
         logger.info("Adding snapshot: {}".format(name))
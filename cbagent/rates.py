@@ -0,0 +1,62 @@
+from threading import Lock
+
+from cbagent.registry import LRUCache
+
+
+class Rates(object):
+
+    """Per-second rates of monotonic counters.
+
+    Collectors read raw counters once per sample and update() turns them
+    into rates using the previous values and timestamp of the same series
+    (e.g., a node), so nothing has to sleep between two reads. The first
+    update of a series only remembers the counters.
+
+    A counter which went down has either wrapped around or been reset
+    (restart of a process, reboot). Only counters declared as 32 bits wide
+    (e.g., /proc/net/dev on 32-bit kernels) are expected to wrap: a wrap
+    moves such a counter by less than half of its range. Any other decrease
+    is a reset and the counter is skipped until the next update. A timestamp
+    which didn't move forward (e.g., uptime after reboot) resets the whole
+    series.
+    """
+
+    WIDTH = 2 ** 32
+
+    def __init__(self, max_series=10000):
+        self.series = LRUCache(max_series)
+        self._lock = Lock()
+
+    def _get_delta(self, previous, value, wrapping):
+        if value >= previous:
+            return value - previous
+        if wrapping and previous < self.WIDTH:
+            delta = self.WIDTH - previous + value
+            if delta < self.WIDTH // 2:
+                return delta
+
+    def update(self, key, counters, timestamp, wrapping=()):
+        """Return dictionary of counter -> rate since the previous update of
+        the series. Timestamps are in seconds, any clock which is monotonic
+        for the series will do. wrapping is a collection of 32-bit counters
+        which may wrap around."""
+        with self._lock:
+            previous = self.series.get(key)
+            self.series.put(key, (timestamp, counters))
+        if previous is None:
+            return {}
+
+        last_timestamp, last_counters = previous
+        elapsed = float(timestamp - last_timestamp)
+        if elapsed <= 0:
+            return {}
+
+        rates = {}
+        for counter, value in counters.items():
+            if counter not in last_counters:
+                continue
+            delta = self._get_delta(last_counters[counter], value,
+                                    counter in wrapping)
+            if delta is not None:
+                rates[counter] = delta / elapsed
+        return rates
@@ -0,0 +1,140 @@
+from itertools import count
+from threading import Lock
+
+
+def build_dbname(cluster, server, bucket, collector):
+    db_name = (collector or "") + cluster + (bucket or "") + (server or "")
+    for char in "[]/\;.,><&*:%=+@!#^()|?^'\"":
+        db_name = db_name.replace(char, "")
+    return db_name
+
+
+class LRUCache(object):
+
+    """Dictionary of bounded size with approximate LRU eviction.
+
+    Items live in two generations of at most max_size / 2 items each.
+    Lookups hit the current generation, items found in the previous one
+    move to the current one. When the current generation is full, it becomes
+    the previous one and whatever is left in the old previous generation is
+    evicted, on_evict is called with each of the evicted items. A hit costs
+    a single dictionary lookup, unlike an exact LRU list. Not thread-safe.
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.generation_size = max(max_size // 2, 1)
+        self.current = {}
+        self.previous = {}
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def get(self, key, default=None):
+        try:
+            return self.current[key]
+        except KeyError:
+            pass
+        try:
+            value = self.previous.pop(key)
+        except KeyError:
+            return default
+        self._add(key, value)
+        return value
+
+    def items(self):
+        return self.previous.items() + self.current.items()
+
+    def pop(self, key, default=None):
+        value = self.current.pop(key, default)
+        return self.previous.pop(key, value)
+
+    def put(self, key, value):
+        self.previous.pop(key, None)
+        if key in self.current:
+            self.current[key] = value
+        else:
+            self._add(key, value)
+
+    def _add(self, key, value):
+        if len(self.current) >= self.generation_size:
+            self.evicted += len(self.previous)
+            if self.on_evict is not None:
+                for item in self.previous.items():
+                    self.on_evict(*item)
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+
+class Series(object):
+
+    """Interned series: compact integer ID, identity tuple (cluster, server,
+    bucket, collector), database name and metrics already registered in
+    cbmonitor. IDs are never reused, so state keyed by the ID of an evicted
+    series can't be picked up by an unrelated one."""
+
+    __slots__ = ("id", "key", "db_name", "registered")
+
+    def __init__(self, id, key, db_name):
+        self.id = id
+        self.key = key
+        self.db_name = db_name
+        self.registered = set()
+
+
+class Registry(object):
+
+    """Interned series (collector, cluster, bucket, server) and metric names.
+
+    Every series gets an integer ID which keys per-series state of the store
+    stages; its database name and normalized names of metrics are computed
+    once, so per-sample work is reduced to dictionary lookups. Both tables
+    are bounded: series and names which are no longer seen (e.g., removed
+    buckets or nodes) are evicted in approximate LRU order and simply
+    re-created, with a new ID, if they show up again. Metrics of a re-created
+    series are passed to the metadata client again, which answers them from
+    its own cache.
+    """
+
+    def __init__(self, max_series=20000, max_names=10000):
+        self.series = LRUCache(max_series)
+        self.names = LRUCache(max_names)
+        self.ids = count()
+        self._lock = Lock()
+
+    def get_series(self, cluster, server=None, bucket=None, collector=None):
+        key = (cluster, server, bucket, collector)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                db_name = build_dbname(cluster, server, bucket, collector)
+                series = Series(next(self.ids), key, db_name)
+                self.series.put(key, series)
+            return series
+
+    def normalize(self, metrics):
+        """Metric names as they are stored: "/" is replaced with "_"."""
+        names = []
+        with self._lock:
+            current = self.names.current
+            for metric in metrics:
+                name = current.get(metric)
+                if name is None:
+                    name = self.names.get(metric)
+                    if name is None:
+                        name = metric.replace("/", "_")
+                        self.names.put(metric, name)
+                    current = self.names.current  # may have been rotated
+                names.append(name)
+        return names
+
+    def stats(self):
+        return {
+            "registry_series": len(self.series),
+            "registry_series_evicted": self.series.evicted,
+            "registry_names": len(self.names),
+            "registry_names_evicted": self.names.evicted,
+        }
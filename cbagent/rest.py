@@ -0,0 +1,219 @@
+import random
+from threading import Lock
+from time import sleep
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util import Timeout
+from logger import logger
+
+from cbagent.clock import monotonic
+from cbagent.instrumentation import NullInstrumentation
+
+
+class CircuitOpenError(requests.ConnectionError):
+
+    def __init__(self, host):
+        super(CircuitOpenError, self).__init__(host)
+        self.host = host
+
+    def __str__(self):
+        return "Circuit breaker is open: {}".format(self.host)
+
+
+class _TimeoutPool(object):
+
+    """Connection pool proxy which replaces the timeout of every request."""
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+
+    def urlopen(self, *args, **kwargs):
+        kwargs["timeout"] = self.timeout
+        return self.pool.urlopen(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+
+class TimeoutAdapter(HTTPAdapter):
+
+    """HTTPAdapter with separate connect and read timeouts. requests 2.1
+    (pinned by seriesly) applies the same timeout to both."""
+
+    def __init__(self, connect_timeout, read_timeout, **kwargs):
+        self.timeout = Timeout(connect=connect_timeout, read=read_timeout)
+        super(TimeoutAdapter, self).__init__(**kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super(TimeoutAdapter, self).get_connection(url, proxies)
+        return _TimeoutPool(pool, self.timeout)
+
+
+class CircuitBreaker(object):
+
+    """Health of a single host.
+
+    After failure_threshold consecutive failures the circuit opens and
+    requests to the host fail immediately, without touching the network.
+    Once reset_timeout seconds have passed a single trial request is let
+    through (half-open state): success closes the circuit, failure opens it
+    for another reset_timeout.
+    """
+
+    CLOSED = "closed"
+
+    OPEN = "open"
+
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        """Record a failure, return True if the circuit has just opened."""
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is not None:  # failed trial
+                self.opened_at = monotonic()
+            elif self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+                return True
+            return False
+
+
+class HTTPClient(object):
+
+    """HTTP client shared by collectors and metadata client.
+
+    One session keeps a pool of keep-alive connections per host. Every
+    request has connect and read timeouts. Connection errors, timeouts and
+    5xx responses of idempotent requests are retried at most retries times
+    with exponential backoff and full jitter; every host has a circuit
+    breaker, so a dead node costs a failed connect or nothing at all instead
+    of a hang.
+    """
+
+    IDEMPOTENT = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+    def __init__(self, connect_timeout=2, read_timeout=10, retries=2,
+                 backoff=0.05, max_backoff=1, failure_threshold=3,
+                 reset_timeout=10, pool_size=8, max_hosts=256):
+        self.session = requests.Session()
+        adapter = TimeoutAdapter(connect_timeout, read_timeout,
+                                 pool_connections=max_hosts,
+                                 pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.breakers = {}
+        self.instrumentation = NullInstrumentation()
+        self._lock = Lock()
+
+    def get_breaker(self, host):
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.failure_threshold,
+                                                     self.reset_timeout)
+            return self.breakers[host]
+
+    def _get_backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def request(self, method, url, retries=None, **kwargs):
+        """Send request, return the response. Connection errors and
+        timeouts are raised once retries are exhausted, the last response is
+        returned for 5xx statuses. CircuitOpenError is raised without
+        sending anything while the circuit of the host is open.
+
+        Non-idempotent requests (POST) are sent once by default: after a read
+        timeout or 5xx the server may have applied the request already. Pass
+        retries explicitly if the endpoint is safe to repeat."""
+        host = urlparse(url).netloc
+        breaker = self.get_breaker(host)
+        if retries is None:
+            retries = self.retries if method in self.IDEMPOTENT else 0
+
+        if not breaker.allow():
+            self.instrumentation.incr("http_rejected")
+            raise CircuitOpenError(host)
+
+        for attempt in range(retries + 1):
+            if attempt:
+                self.instrumentation.incr("http_retries")
+                sleep(self._get_backoff(attempt - 1))
+
+            error = response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            except Exception:
+                breaker.failure()
+                raise
+            if response is not None and response.status_code < 500:
+                breaker.success()
+                return response
+
+            if response is not None:
+                response.content  # release the connection
+            self.instrumentation.incr("http_failures")
+            if breaker.failure():
+                logger.warn("Circuit breaker opened: {}".format(host))
+            if breaker.state != CircuitBreaker.CLOSED:
+                break  # don't retry against an open circuit
+        if response is not None:
+            return response
+        raise error
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            breakers = self.breakers.values()
+        return {"http_open_circuits": len([
+            breaker for breaker in breakers
+            if breaker.state != CircuitBreaker.CLOSED
+        ])}
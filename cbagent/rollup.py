@@ -0,0 +1,139 @@
+from threading import Lock
+
+from cbagent.metadata_client import NullMetadataClient
+from cbagent.registry import LRUCache, Registry
+
+
+class Rollup(object):
+
+    """Incremental downsampling of raw samples into fixed time windows.
+
+    For every series and window only the running aggregates of the current
+    window are kept: min, max, sum, count and last value of each metric.
+    When a sample belongs to a newer window the previous one is emitted as a
+    single point of the rollup series, timestamped with window start. Rollup
+    series has the same cluster, server and bucket as the raw one and the
+    collector name with window suffix (e.g., "ns_server_60s"), so cbmonitor
+    can address it like any other series. Its metric_min, metric_max,
+    metric_avg, metric_last and metric_count metrics are registered through
+    the metadata client once they appear. Non-numeric values are ignored.
+
+    Series which stop reporting (e.g., removed buckets or nodes) don't get
+    samples that would complete their windows, so open windows are swept
+    once per the shortest window: those which ended more than a window ago
+    are emitted and forgotten. At most max_series series have open windows,
+    the least recently sampled ones are emitted early beyond that.
+    """
+
+    def __init__(self, windows, registry=None, mc=None, max_series=20000):
+        self.windows = sorted(windows)
+        self.registry = registry or Registry()
+        self.mc = mc or NullMetadataClient()
+        # (series ID, window) -> (series, window start, aggregates)
+        self.current = LRUCache(max_series * len(self.windows),
+                                on_evict=self._evicted)
+        self.evicted = []  # windows to emit with the next completed ones
+        self.next_sweep = None
+        self._lock = Lock()
+
+    @staticmethod
+    def get_collector(collector, window):
+        return "{}_{}s".format(collector or "", window)
+
+    def _emit(self, series, window, start, aggregates):
+        """Rollup point of a completed window as (db_name, timestamp, data),
+        new metrics of the rollup series are registered."""
+        cluster, server, bucket, collector = series.key
+        collector = self.get_collector(collector, window)
+        rollup = self.registry.get_series(cluster, server, bucket, collector)
+        data = self._summarize(aggregates)
+        metrics = [metric for metric in data
+                   if metric not in rollup.registered]
+        for metric, name in zip(metrics, self.registry.normalize(metrics)):
+            rollup.registered.add(metric)
+            self.mc.add_metric(name, bucket, server, collector)
+        return rollup.db_name, start, data
+
+    @staticmethod
+    def _summarize(aggregates):
+        data = {}
+        for metric, (min_, max_, total, count, last) in aggregates.items():
+            data[metric + "_min"] = min_
+            data[metric + "_max"] = max_
+            data[metric + "_avg"] = total / count
+            data[metric + "_last"] = last
+            data[metric + "_count"] = count
+        return data
+
+    def _evicted(self, key, current):
+        series, start, aggregates = current
+        if aggregates:
+            self.evicted.append((series, key[1], start, aggregates))
+
+    def _sweep(self, timestamp):
+        """Remove windows which ended more than a window ago."""
+        completed = []
+        for key, (series, start, aggregates) in self.current.items():
+            window = key[1]
+            if start + 2 * window <= timestamp:
+                self.current.pop(key)
+                if aggregates:
+                    completed.append((series, window, start, aggregates))
+        return completed
+
+    def add(self, series, timestamp, data):
+        """Account a raw sample of registry Series, return list of completed
+        rollup points as (db_name, timestamp, data) tuples."""
+        values = []
+        for metric, value in data.items():
+            try:
+                values.append((metric, float(value)))
+            except (TypeError, ValueError):
+                continue
+
+        completed = []
+        with self._lock:
+            for window in self.windows:
+                start = timestamp - timestamp % window
+                key = (series.id, window)
+                current = self.current.get(key)
+                if current is not None and start < current[1]:
+                    start = current[1]  # late sample, add to open window
+                if current is None or current[1] != start:
+                    if current is not None and current[2]:
+                        completed.append((series, window) + current[1:])
+                    current = (series, start, {})
+                    self.current.put(key, current)
+
+                aggregates = current[2]
+                for metric, value in values:
+                    agg = aggregates.get(metric)
+                    if agg is None:
+                        aggregates[metric] = [value, value, value, 1, value]
+                    else:
+                        if value < agg[0]:
+                            agg[0] = value
+                        if value > agg[1]:
+                            agg[1] = value
+                        agg[2] += value
+                        agg[3] += 1
+                        agg[4] = value
+
+            if self.next_sweep is None or timestamp >= self.next_sweep:
+                self.next_sweep = timestamp + self.windows[0]
+                completed += self._sweep(timestamp)
+            completed += self.evicted
+            self.evicted = []
+        return [self._emit(*window) for window in completed]
+
+    def flush(self):
+        """Emit all incomplete windows (e.g. on shutdown)."""
+        with self._lock:
+            current = self.current.items()
+            self.current = LRUCache(self.current.max_size,
+                                    on_evict=self._evicted)
+            completed, self.evicted = self.evicted, []
+        completed += [(series, window, start, aggregates)
+                      for (_, window), (series, start, aggregates) in current
+                      if aggregates]
+        return [self._emit(*window) for window in completed]
@@ -0,0 +1,275 @@
+import random
+import sys
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock, RLock, Thread
+
+from logger import logger
+
+from cbagent.deadband import Deadband
+from cbagent.history import History
+from cbagent.instrumentation import Instrumentation
+from cbagent.registry import Registry
+from cbagent.rest import HTTPClient
+from cbagent.rollup import Rollup
+from cbagent.spool import Spool
+from cbagent.stores import FileStore, SerieslyStore
+from cbagent.metadata_client import MetadataClient, NullMetadataClient
+
+
+class Topology(object):
+
+    """Cached cluster topology: nodes, buckets with their stats URIs and
+    per-node stats URIs. Entries are filled on demand and dropped all at once
+    by invalidate(); collectors check the cluster revision at most once per
+    ttl seconds and invalidate the cache when it changes.
+
+    Requests are made without holding the lock. Every invalidation starts a
+    new generation, and update() only stores results fetched during the
+    current one, so a slow response can't bring back a stale topology.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = RLock()
+        self.signature = None
+        self.checked_at = 0
+        self.generation = 0
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.signature = None
+            self.checked_at = 0
+            self.nodes = None
+            self.buckets = None
+            self.node_stats = {}
+
+    def update(self, generation, nodes=None, buckets=None, node_stats=None):
+        """Store entries fetched during the given generation, return False
+        if the topology has been invalidated in the meantime."""
+        with self.lock:
+            if generation != self.generation:
+                return False
+            if nodes is not None:
+                self.nodes = nodes
+            if buckets is not None:
+                self.buckets = buckets
+            if node_stats is not None:
+                self.node_stats.update(node_stats)
+            return True
+
+    @staticmethod
+    def get_signature(pool):
+        """Cluster revision: changes when nodes join or leave the cluster or
+        when the bucket list changes (buckets URI embeds its version)."""
+        nodes = sorted((node["hostname"], node.get("clusterMembership"))
+                       for node in pool["nodes"])
+        return hash((pool.get("rev"), pool["buckets"]["uri"], tuple(nodes)))
+
+
+class Context(object):
+
+    """Resources which can be shared by several collectors of the same
+    cluster: HTTP client, REST worker pool, store writer, optional in-memory
+    history of recent samples, registry of series, metadata client and
+    discovered topology. Collectors pick up a context from settings.context
+    and create a private one otherwise.
+    """
+
+    POOL_SIZE = 20
+
+    def __init__(self, settings):
+        self.rest_concurrency = getattr(settings, "rest_concurrency", 8)
+        self.http = HTTPClient(
+            connect_timeout=getattr(settings, "rest_connect_timeout", 2),
+            read_timeout=getattr(settings, "rest_read_timeout", 10),
+            retries=getattr(settings, "rest_retries", 2),
+            backoff=getattr(settings, "rest_backoff", 0.05),
+            failure_threshold=getattr(settings, "rest_failure_threshold", 3),
+            reset_timeout=getattr(settings, "rest_reset_timeout", 10),
+            pool_size=max(self.rest_concurrency, self.POOL_SIZE),
+        )
+        self.session = self.http.session
+
+        self.registry = Registry(
+            max_series=getattr(settings, "registry_max_series", 20000),
+            max_names=getattr(settings, "registry_max_names", 10000),
+        )
+        self.history = self._get_history(settings)
+        self.mc = self._get_metadata_client(settings)
+        self.store = self._get_store(settings)
+
+        self.instrumentation = Instrumentation(
+            settings.cluster,
+            interval=getattr(settings, "agent_report_interval", 10),
+        )
+        self.store.instrumentation = self.instrumentation
+        self.mc.instrumentation = self.instrumentation
+        self.http.instrumentation = self.instrumentation
+        self.instrumentation.add_source(self.http.stats)
+        self.instrumentation.add_source(self._get_store_stats)
+        if self.history is not None:
+            self.instrumentation.add_source(self.history.stats)
+        self.instrumentation.add_source(self.registry.stats)
+        if self.store.deadband is not None:
+            self.instrumentation.add_source(self.store.deadband.stats)
+        self.instrumentation.attach(self.store, self.mc)
+
+        self.topology = Topology(ttl=getattr(settings, "topology_ttl", 5))
+
+        # collectors fire on wall-clock aligned ticks shifted by the same
+        # random per-agent offset
+        self.splay = random.uniform(0, getattr(settings, "scheduler_splay", 0))
+        self.overrun = getattr(settings, "scheduler_overrun", "skip")
+
+        self._semaphores = {}
+        self._pool = None
+        self._lock = Lock()
+
+    def _get_store_stats(self):
+        stats = {}
+        for key, value in self.store.stats().items():
+            if not key.startswith("spool_"):
+                key = "store_" + key
+            stats[key] = value
+        return stats
+
+    def _get_store(self, settings):
+        if getattr(settings, "store", "seriesly") == "file":
+            return FileStore(
+                settings.store_path,
+                queue_size=getattr(settings, "seriesly_queue_size", 10000),
+                block_size=getattr(settings, "store_block_size", 600),
+                flush_interval=getattr(settings, "store_flush_interval", 10),
+                max_buffered=getattr(settings, "store_max_buffered", 10000),
+                cluster=settings.cluster,
+                history=self.history,
+                rollup=self._get_rollup(settings),
+                rollup_raw=getattr(settings, "rollup_raw", True),
+                deadband=self._get_deadband(settings),
+                registry=self.registry,
+                max_open_files=getattr(settings, "store_max_open_files", 1000),
+            )
+        return SerieslyStore(
+            settings.seriesly_host,
+            port=getattr(settings, "seriesly_port", 3133),
+            queue_size=getattr(settings, "seriesly_queue_size", 10000),
+            batch_size=getattr(settings, "seriesly_batch_size", 500),
+            flush_interval=getattr(settings, "seriesly_flush_interval", 1),
+            compress=getattr(settings, "seriesly_gzip", False),
+            spool=self._get_spool(settings),
+            replay_rate=getattr(settings, "spool_replay_rate", 1000),
+            cluster=settings.cluster,
+            history=self.history,
+            rollup=self._get_rollup(settings),
+            rollup_raw=getattr(settings, "rollup_raw", True),
+            deadband=self._get_deadband(settings),
+            registry=self.registry,
+        )
+
+    def _get_metadata_client(self, settings):
+        """cbmonitor can't read local files, so FileStore runs don't need
+        metadata unless it's explicitly requested."""
+        file_store = getattr(settings, "store", "seriesly") == "file"
+        if getattr(settings, "metadata", not file_store):
+            return MetadataClient(
+                settings, http=self.http,
+                max_items=getattr(settings, "metadata_max_items", 100000))
+        return NullMetadataClient()
+
+    @staticmethod
+    def _get_history(settings):
+        if getattr(settings, "history", False):
+            return History(
+                capacity=getattr(settings, "history_capacity", 120),
+                max_series=getattr(settings, "history_max_series", 1000),
+            )
+
+    @staticmethod
+    def _get_deadband(settings):
+        if getattr(settings, "deadband", False):
+            return Deadband(
+                abs_band=getattr(settings, "deadband_abs", 0),
+                rel_band=getattr(settings, "deadband_rel", 0),
+                keyframe=getattr(settings, "deadband_keyframe", 30),
+                max_series=getattr(settings, "deadband_max_series", 20000),
+            )
+
+    def _get_rollup(self, settings):
+        windows = getattr(settings, "rollup_windows", None)
+        if windows:
+            return Rollup(
+                windows, registry=self.registry, mc=self.mc,
+                max_series=getattr(settings, "rollup_max_series", 20000),
+            )
+
+    @staticmethod
+    def _get_spool(settings):
+        path = getattr(settings, "spool_path", None)
+        if path:
+            return Spool(path, max_size=getattr(settings, "spool_max_size",
+                                                2 ** 30))
+
+    @property
+    def pool(self):
+        """Worker pool for concurrent REST requests, created on first use."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.POOL_SIZE)
+            return self._pool
+
+    def semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = \
+                    BoundedSemaphore(self.rest_concurrency)
+            return self._semaphores[host]
+
+
+class Runtime(object):
+
+    """Runs any number of collectors in a single process. All of them share
+    one Context, every collector samples in its own thread with its own
+    polling interval.
+    """
+
+    def __init__(self, settings, collectors):
+        """collectors is a sequence of (collector class, interval) pairs,
+        interval may be None to use settings.interval."""
+        self.context = Context(settings)
+        settings.context = self.context
+
+        self.collectors = []
+        for collector, interval in collectors:
+            logger.info("Initializing collector: {}".format(
+                collector.__name__))
+            collector = collector(settings)
+            if interval:
+                collector.interval = interval
+            self.collectors.append(collector)
+
+    def update_metadata(self):
+        for collector in self.collectors:
+            collector.update_metadata()
+
+    def start(self):
+        threads = []
+        for collector in self.collectors:
+            thread = Thread(target=collector.collect,
+                            name=collector.__class__.__name__)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def run(self):
+        self.update_metadata()
+        threads = self.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)  # short timeout keeps Ctrl-C working
+        except KeyboardInterrupt:
+            self.context.store.flush(timeout=10)
+            sys.exit()
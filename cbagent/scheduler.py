@@ -0,0 +1,61 @@
+import math
+from time import sleep, time
+
+
+class Scheduler(object):
+
+    """Fixed-rate schedule of sampling ticks.
+
+    Ticks are aligned to wall clock: tick k happens at k * interval seconds
+    since the epoch, so period doesn't depend on sample duration and
+    collectors with the same interval sample at the same moments, even in
+    different agents. Every tick fires splay seconds late; splay is a per
+    agent offset which spreads requests of many agents over the interval.
+
+    When a sample takes longer than the interval, ticks which are already
+    due are not replayed one after another. With overrun="skip" all of them
+    are dropped and the scheduler waits for the next tick in the future; with
+    overrun="coalesce" they collapse into a single tick (the most recent one)
+    which fires immediately.
+    """
+
+    def __init__(self, interval, splay=0, overrun="skip"):
+        if overrun not in ("skip", "coalesce"):
+            raise ValueError("Unknown overrun policy: {}".format(overrun))
+        self.interval = interval
+        self.splay = splay
+        self.overrun = overrun
+        self.index = None  # number of the last tick
+
+    def _due(self, now):
+        """Number of the most recent tick which is due."""
+        return int(math.floor((now - self.splay) / self.interval))
+
+    def next_tick(self, now):
+        """Return (tick number, number of skipped ticks)."""
+        if self.index is None:
+            return self._due(now) + 1, 0
+        index = self.index + 1
+        due = self._due(now)
+        if due <= index:
+            return index, 0  # on time or late by less than interval
+        if self.overrun == "coalesce":
+            return due, due - index
+        return due + 1, due - index + 1
+
+    def wait(self):
+        """Sleep until the next tick. Return (tick timestamp, lateness,
+        number of skipped ticks). Timestamp doesn't include splay, lateness
+        is the delay between planned and actual wake up time."""
+        index, skipped = self.next_tick(time())
+        fire_at = index * self.interval + self.splay
+        while True:
+            delay = fire_at - time()
+            if delay <= 0:
+                break
+            # wake up at least every interval in case wall clock is stepped
+            sleep(min(delay, self.interval))
+        lateness = time() - fire_at
+
+        self.index = index
+        return index * self.interval, lateness, skipped
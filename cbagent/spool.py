@@ -0,0 +1,174 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from threading import Lock
+
+from logger import logger
+
+
+class Spool(object):
+
+    """Disk-backed append-only queue of samples.
+
+    Records are zlib-compressed JSON documents prefixed with their length and
+    appended to fixed size segment files. Segments are read through mmap and
+    removed once fully replayed. Read position is persisted, so the backlog
+    survives agent restarts. When total size exceeds max_size the oldest
+    segments are discarded and counted as dropped.
+    """
+
+    HEADER = struct.Struct(">I")
+
+    SUFFIX = ".spool"
+
+    def __init__(self, path, segment_size=16 * 2 ** 20, max_size=2 ** 30):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self._lock = Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.segments = sorted(
+            int(fname[:-len(self.SUFFIX)]) for fname in os.listdir(path)
+            if fname.endswith(self.SUFFIX)
+        )
+        self.read_segment, self.read_offset = self._load_position()
+        self.records = sum(self._count(segment) for segment in self.segments)
+        self.dropped = 0
+        self._writer = None
+
+        if self.records:
+            logger.info("Found {} spooled samples in {}".format(self.records,
+                                                                path))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "{:012d}{}".format(segment,
+                                                          self.SUFFIX))
+
+    def _position_path(self):
+        return os.path.join(self.path, "position")
+
+    def _load_position(self):
+        try:
+            with open(self._position_path()) as fh:
+                segment, offset = map(int, fh.read().split())
+        except (IOError, ValueError):
+            return self.segments and self.segments[0] or 0, 0
+        return segment, offset
+
+    def _save_position(self):
+        tmp = self._position_path() + ".tmp"
+        with open(tmp, "w") as fh:
+            fh.write("{} {}".format(self.read_segment, self.read_offset))
+        os.rename(tmp, self._position_path())
+
+    def _records(self, segment, offset=0):
+        """Yield (next offset, record) pairs starting from given offset."""
+        fname = self._segment_path(segment)
+        if not os.path.getsize(fname):
+            return
+        with open(fname, "rb") as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                while offset + self.HEADER.size <= len(mm):
+                    size, = self.HEADER.unpack_from(mm, offset)
+                    start = offset + self.HEADER.size
+                    if start + size > len(mm):
+                        break  # incomplete record, e.g. after a crash
+                    offset = start + size
+                    yield offset, mm[start:offset]
+            finally:
+                mm.close()
+
+    def _count(self, segment):
+        offset = self.read_offset if segment == self.read_segment else 0
+        return sum(1 for _ in self._records(segment, offset))
+
+    def _size(self):
+        return sum(os.path.getsize(self._segment_path(segment))
+                   for segment in self.segments)
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        segment = self.segments and self.segments[-1] + 1 or 1
+        self.segments.append(segment)
+        self._writer = open(self._segment_path(segment), "ab")
+        self._trim()
+
+    def _trim(self):
+        while len(self.segments) > 1 and self._size() > self.max_size:
+            segment = self.segments.pop(0)
+            dropped = self._count(segment)
+            os.remove(self._segment_path(segment))
+            self.records -= dropped
+            self.dropped += dropped
+            logger.warn("Spool is full, dropped {} samples".format(dropped))
+            if segment == self.read_segment:
+                self.read_segment, self.read_offset = self.segments[0], 0
+                self._save_position()
+
+    def put(self, db_name, timestamp, data):
+        record = zlib.compress(
+            json.dumps([db_name, timestamp, data], separators=(",", ":"))
+        )
+        with self._lock:
+            if self._writer is None or \
+                    self._writer.tell() >= self.segment_size:
+                self._roll()
+            self._writer.write(self.HEADER.pack(len(record)) + record)
+            self._writer.flush()
+            self.records += 1
+
+    def peek(self, limit):
+        """Return up to limit oldest records as (cursor, (db_name, timestamp,
+        data)) pairs. Records stay in the spool until the cursor of the last
+        stored one is passed to commit()."""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+            records = []
+            for segment in self.segments:
+                if segment < self.read_segment:
+                    continue
+                offset = self.read_offset if segment == self.read_segment \
+                    else 0
+                for offset, record in self._records(segment, offset):
+                    records.append(((segment, offset),
+                                    json.loads(zlib.decompress(record))))
+                    if len(records) == limit:
+                        return records
+            return records
+
+    def commit(self, cursor, count):
+        """Remove count records up to and including the one at cursor."""
+        with self._lock:
+            self.read_segment, self.read_offset = cursor
+            self.records -= count
+            # replayed segments are not needed anymore
+            while self.segments and self.segments[0] < self.read_segment:
+                os.remove(self._segment_path(self.segments.pop(0)))
+            if not self.records:  # start from scratch
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                for segment in self.segments:
+                    os.remove(self._segment_path(segment))
+                self.segments = []
+                self.read_segment, self.read_offset = 0, 0
+            self._save_position()
+
+    def __len__(self):
+        return self.records
+
+    def stats(self):
+        with self._lock:
+            return {
+                "spool_backlog": self.records,
+                "spool_bytes": self._size(),
+                "spool_dropped": self.dropped,
+            }
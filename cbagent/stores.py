@@ -1,46 +1,484 @@
-from decorator import decorator
+import json
+import os
+import zlib
+from collections import OrderedDict
+from itertools import groupby
+from Queue import Queue, Empty, Full
+from threading import Lock, Thread
+from time import sleep, time
+
+import requests
 from logger import logger
 from seriesly import Seriesly
 from seriesly.exceptions import ConnectionError
 
+from cbagent.columnar import ColumnarSeries
+from cbagent.instrumentation import NullInstrumentation
+from cbagent.registry import LRUCache, Registry, build_dbname
+
+
+class SerieslyWriter(Thread):
+
+    """Background stage which drains the store queue, groups points per
+    database and writes them to seriesly over a keep-alive session. Flushes
+    happen when either batch_size points are pending or flush_interval
+    seconds have passed since the first pending point. seriesly has no bulk
+    endpoint, so every point is still a separate POST; batching saves queue
+    handling and database lookups, not requests.
 
-def _memoize(method, self, db):
-    if db not in method.cache:
-        method.cache[db] = method(self, db)
-    return method.cache[db]
+    Progress is tracked per point. When seriesly fails, the points which
+    were not written go to the local spool instead and seriesly is probed
+    every HEALTH_CHECK_INTERVAL seconds. Once it's back the spool is
+    replayed in order, at most replay_rate points per second, and its read
+    position is committed after every written group. As long as the spool
+    has a backlog new points are appended to it as well, so they never
+    overtake spooled ones.
+    """
 
+    HEALTH_CHECK_INTERVAL = 10
 
-def memoize(method):
-    method.cache = {}
-    return decorator(_memoize, method)
+    def __init__(self, store, batch_size, flush_interval, compress, spool,
+                 replay_rate):
+        super(SerieslyWriter, self).__init__()
+        self.daemon = True
 
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.spool = spool
+        self.replay_rate = replay_rate
 
-class SerieslyStore(object):
+        self.session = requests.Session()
+        self.base_url = "http://{}:{}/".format(store.host, store.port)
 
-    def __init__(self, host):
-        self.seriesly = Seriesly(host)
+        self.healthy = True
+        self.last_check = 0
+        self.last_replay = time()
+
+        self.written = 0
+        self.failed = 0
+        self.spooled = 0
+        self.batches = 0
+        self.pending = 0
+
+    def _next_batch(self):
+        try:
+            batch = [self.store.queue.get(timeout=self.flush_interval)]
+        except Empty:
+            return []
+        deadline = time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.store.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
 
     @staticmethod
-    def build_dbname(cluster, server, bucket, collector):
-        db_name = (collector or "") + cluster + (bucket or "") + (server or "")
-        for char in "[]/\;.,><&*:%=+@!#^()|?^'\"":
-            db_name = db_name.replace(char, "")
-        return db_name
+    def _group(batch):
+        groups = OrderedDict()
+        for db_name, timestamp, data in batch:
+            groups.setdefault(db_name, []).append((timestamp, data))
+        return groups
 
-    @memoize
-    def _get_db(self, db_name):
+    def _encode(self, data):
+        body = json.dumps(data, separators=(",", ":"))
+        if self.compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)  # gzip
+            body = compressor.compress(body) + compressor.flush()
+        return body
+
+    def _post(self, db_name, timestamp, data):
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+        params = {"ts": int(timestamp * 1000)}  # s -> ms
+        r = self.session.post(url=self.base_url + db_name, params=params,
+                              headers=headers, data=self._encode(data))
+        if r.status_code not in (200, 201, 202):
+            raise requests.HTTPError("Bad response: {}".format(r.url))
+
+    def _write_group(self, db_name, points):
+        """Write points of one database in order, return the number of points
+        written before a failure. seriesly has no bulk endpoint, so every
+        point is a separate POST over the keep-alive session."""
+        written = 0
+        try:
+            self.store._get_db(db_name)
+            with self.store.instrumentation.timer("store_write"):
+                for timestamp, data in points:
+                    self._post(db_name, timestamp, data)
+                    written += 1
+        except (requests.RequestException, ConnectionError) as e:
+            logger.warn("Failed to write {} points to {}: {}".format(
+                len(points) - written, db_name, e))
+        self.written += written
+        return written
+
+    def _check_health(self):
+        if time() - self.last_check < self.HEALTH_CHECK_INTERVAL:
+            return
+        self.last_check = time()
+        try:
+            self.store.seriesly.list_dbs()
+        except (requests.RequestException, ConnectionError):
+            return
+        logger.info("seriesly is available again, {} spooled points to "
+                    "replay".format(len(self.spool)))
+        self.healthy = True
+
+    def _to_spool(self, db_name, points):
+        for timestamp, data in points:
+            self.spool.put(db_name, timestamp, data)
+            self.spooled += 1
+            self.pending -= 1
+
+    def _flush(self, batch):
+        # while the spool has a backlog live points queue up behind it, so
+        # every series reaches seriesly in order
+        backlog = self.spool is not None and len(self.spool) > 0
+        for db_name, points in self._group(batch).items():
+            written = 0
+            if self.healthy and not backlog:
+                written = self._write_group(db_name, points)
+                self.pending -= written
+                if written == len(points):
+                    continue
+                logger.warn("seriesly is unavailable, spooling samples")
+                self.healthy = False
+                self.last_check = time()
+            points = points[written:]
+            if self.spool is not None:
+                self._to_spool(db_name, points)
+                backlog = True
+            else:
+                self.failed += len(points)
+                self.pending -= len(points)
+        self.batches += 1
+
+    def _replay(self):
+        elapsed = time() - self.last_replay
+        limit = int(min(elapsed, self.flush_interval) * self.replay_rate)
+        if not limit:
+            return
+        self.last_replay = time()
+
+        records = self.spool.peek(limit)
+        # runs of consecutive points of the same database, each run is
+        # committed as soon as it's written
+        for db_name, group in groupby(records, key=lambda r: r[1][0]):
+            group = list(group)
+            written = self._write_group(
+                db_name, [(ts, data) for _, (_, ts, data) in group]
+            )
+            if written:
+                self.spool.commit(group[written - 1][0], written)
+            if written < len(group):
+                self.healthy = False
+                self.last_check = time()
+                return
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            self.pending = len(batch)  # neither written, spooled nor failed
+            try:
+                if not self.healthy:
+                    self._check_health()
+                if batch:
+                    self._flush(batch)
+                if self.spool is not None:
+                    if self.healthy and len(self.spool):
+                        self._replay()
+                    else:
+                        self.last_replay = time()
+            except Exception as e:
+                self.failed += self.pending
+                logger.warn("Unexpected writer error: {}".format(e))
+            finally:
+                for _ in batch:
+                    self.store.queue.task_done()
+
+
+class Store(object):
+
+    """Base class of asynchronous stores. append() only captures the
+    timestamp and enqueues the point, all I/O happens in a background writer.
+    The queue is bounded: when it's full append() waits at most
+    block_timeout seconds and then drops the sample, so a slow backend never
+    stalls the sampling loop. Admission is checked before the sample reaches
+    history, deadband or rollups, so these views never count points the
+    store dropped. Dropped points are counted and reported in stats(). Optional History keeps recent values in memory, optional Rollup
+    adds downsampled series and may replace raw points (rollup_raw=False),
+    optional Deadband drops raw values which didn't change. Database names
+    are cached in Registry (shared with collectors if given).
+    """
+
+    def __init__(self, queue_size=10000, block_timeout=0, cluster=None,
+                 history=None, rollup=None, rollup_raw=True, deadband=None,
+                 registry=None):
+        self.cluster = cluster  # used for the store's own metrics
+        self.registry = registry or Registry()
+        self.history = history
+        self.instrumentation = NullInstrumentation()
+        self.rollup = rollup
+        self.rollup_raw = rollup_raw
+        self.deadband = deadband
+        self.queue = Queue(maxsize=queue_size)
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._lock = Lock()
+
+    build_dbname = staticmethod(build_dbname)
+
+    def append(self, data, cluster=None, server=None, bucket=None,
+               collector=None, timestamp=None):
+        timestamp = timestamp or time()  # captured at sample time
+        if not self._admit():
+            self._drop()
+            return
+        series = self.registry.get_series(cluster, server, bucket, collector)
+        if self.history is not None:
+            self.history.append(series.db_name, timestamp, data)
+        if self.rollup is None or self.rollup_raw:
+            raw = data
+            if self.deadband is not None:
+                raw = self.deadband.filter(series.id, data)
+            if raw:
+                self._put((series.db_name, timestamp, raw))
+        if self.rollup is not None:
+            for point in self.rollup.add(series, timestamp, data):
+                self._put(point)
+
+    def _admit(self):
+        """Wait at most block_timeout seconds for a free slot in the queue."""
+        queue = self.queue
+        if queue.maxsize <= 0:
+            return True
+        with queue.not_full:  # holds queue.mutex, hence _qsize() not full()
+            if not self.block_timeout:
+                return queue._qsize() < queue.maxsize
+            deadline = time() + self.block_timeout
+            while queue._qsize() >= queue.maxsize:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                queue.not_full.wait(remaining)
+            return True
+
+    def _put(self, point):
         try:
+            if self.block_timeout:
+                self.queue.put(point, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(point)
+        except Full:
+            self._drop()
+
+    def _drop(self):
+        with self._lock:
+            self.dropped += 1
+            dropped = self.dropped
+        if dropped == 1 or not dropped % 1000:
+            logger.warn("Store queue is full, dropped {} points so far"
+                        .format(dropped))
+
+    def flush(self, timeout=None):
+        """Wait until all queued points are written or timeout expires."""
+        if self.rollup is not None:
+            for point in self.rollup.flush():
+                self._put(point)
+        deadline = timeout is not None and time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline and time() > deadline:
+                return False
+            sleep(0.05)
+        return True
+
+
+class SerieslyStore(Store):
+
+    """Asynchronous seriesly store. Optional Spool keeps samples on disk
+    while seriesly is unavailable.
+    """
+
+    DB_CACHE_SIZE = 10000
+
+    def __init__(self, host, port=3133, queue_size=10000, batch_size=500,
+                 flush_interval=1, block_timeout=0, compress=False,
+                 spool=None, replay_rate=1000, cluster=None, history=None,
+                 rollup=None, rollup_raw=True, deadband=None,
+                 registry=None):
+        super(SerieslyStore, self).__init__(queue_size, block_timeout,
+                                            cluster, history, rollup,
+                                            rollup_raw, deadband, registry)
+        self.host = host
+        self.port = port
+        self.seriesly = Seriesly(host, port)
+
+        self.spool = spool
+        self.dbs = LRUCache(self.DB_CACHE_SIZE)
+        self.writer = SerieslyWriter(self, batch_size, flush_interval,
+                                     compress, spool, replay_rate)
+        self.writer.start()
+
+    def _get_db(self, db_name):
+        db = self.dbs.get(db_name)
+        if db is None:
             existing_dbs = self.seriesly.list_dbs()
-        except ConnectionError as e:
-            logger.interrupt("seriesly not available: {}".format(e))
-        else:
             if db_name not in existing_dbs:
                 logger.info("Creating new database: {}".format(db_name))
                 self.seriesly.create_db(db_name)
-            return self.seriesly[db_name]
+            db = self.seriesly[db_name]
+            self.dbs.put(db_name, db)
+        return db
 
-    def append(self, data, cluster=None, server=None, bucket=None,
-               collector=None):
-        db_name = self.build_dbname(cluster, server, bucket, collector)
-        db = self._get_db(db_name)
-        db.append(data)
+    def stats(self):
+        stats = {
+            "queue_depth": self.queue.qsize(),
+            "written": self.writer.written,
+            "failed": self.writer.failed,
+            "spooled": self.writer.spooled,
+            "dropped": self.dropped,
+            "batches": self.writer.batches,
+        }
+        if self.spool is not None:
+            stats.update(self.spool.stats())
+        return stats
+
+
+class FileWriter(Thread):
+
+    """Background stage which buffers points per series and appends them to
+    columnar files in blocks of block_size points. Incomplete blocks are
+    written every flush_interval seconds, when more than max_buffered points
+    are buffered in total and on flush(). flush_interval bounds the data
+    lost on a crash; larger blocks compress better. At most max_open_files
+    series keep their current segment open, the least recently written ones
+    are closed and reopened when they get more points.
+    """
+
+    def __init__(self, store, block_size, flush_interval, segment_size,
+                 max_buffered, max_open_files=1000):
+        super(FileWriter, self).__init__()
+        self.daemon = True
+
+        self.store = store
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.max_buffered = max_buffered
+
+        self.lock = Lock()
+        self.buffers = {}
+        self.buffered = 0
+        self.series = LRUCache(max_open_files,
+                               on_evict=lambda _, series: series.close())
+        self.last_flush = time()
+
+        self.written = 0
+        self.failed = 0
+        self.blocks = 0
+        self.bytes = 0
+
+    def _get_series(self, db_name):
+        series = self.series.get(db_name)
+        if series is None:
+            series = ColumnarSeries(os.path.join(self.store.path, db_name),
+                                    self.segment_size)
+            self.series.put(db_name, series)
+        return series
+
+    def _write(self, db_name):
+        points = self.buffers.pop(db_name, None)
+        if not points:
+            return
+        self.buffered -= len(points)
+        try:
+            with self.store.instrumentation.timer("store_write"):
+                series = self._get_series(db_name)
+                self.bytes += series.append(points)
+        except (IOError, OSError) as e:
+            logger.warn("Failed to write {} points to {}: {}".format(
+                len(points), db_name, e))
+            self.failed += len(points)
+            return
+        self.written += len(points)
+        self.blocks += 1
+
+    def write_all(self):
+        with self.lock:
+            for db_name in list(self.buffers):
+                self._write(db_name)
+            self.last_flush = time()
+
+    def run(self):
+        while True:
+            try:
+                db_name, timestamp, data = \
+                    self.store.queue.get(timeout=self.flush_interval)
+            except Empty:
+                db_name = None
+            try:
+                if db_name is not None:
+                    with self.lock:
+                        points = self.buffers.setdefault(db_name, [])
+                        points.append((timestamp, data))
+                        self.buffered += 1
+                        if len(points) >= self.block_size:
+                            self._write(db_name)
+                if self.buffered >= self.max_buffered or \
+                        time() - self.last_flush >= self.flush_interval:
+                    self.write_all()
+            except Exception as e:
+                logger.warn("Unexpected writer error: {}".format(e))
+            finally:
+                if db_name is not None:
+                    self.store.queue.task_done()
+
+
+class FileStore(Store):
+
+    """Asynchronous store which keeps data in local columnar files, one
+    directory per series (named like seriesly databases). Timestamps are
+    delta-of-delta encoded and values are XOR-compressed, see
+    cbagent.columnar. Use ``cbagent-export`` to read the data back.
+    """
+
+    def __init__(self, path, queue_size=10000, block_size=600,
+                 flush_interval=10, max_buffered=10000,
+                 segment_size=64 * 2 ** 20, block_timeout=0, cluster=None,
+                 history=None, rollup=None, rollup_raw=True, deadband=None,
+                 registry=None, max_open_files=1000):
+        super(FileStore, self).__init__(queue_size, block_timeout, cluster,
+                                        history, rollup, rollup_raw, deadband,
+                                        registry)
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.writer = FileWriter(self, block_size, flush_interval,
+                                 segment_size, max_buffered, max_open_files)
+        self.writer.start()
+
+    def flush(self, timeout=None):
+        """Wait until all queued points are written and write incomplete
+        blocks to disk."""
+        done = super(FileStore, self).flush(timeout)
+        self.writer.write_all()
+        return done
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "written": self.writer.written,
+            "failed": self.writer.failed,
+            "dropped": self.dropped,
+            "blocks": self.writer.blocks,
+            "bytes": self.writer.bytes,
+            "open_files": len(self.writer.series),
+        }
@@ -16,14 +16,16 @@ setup(
     entry_points={
         'console_scripts': [
             'cbagent = cbagent.__main__:main',
+            'cbagent-export = cbagent.export:main',
         ]
     },
     include_package_data=True,
     install_requires=[
         'couchbase==1.2.1',
         'decorator',
-        'fabric==1.8.0',
         'logger',
+        'numpy',
+        'paramiko',
         'requests==2.1.0',
         'seriesly',
         'spring'
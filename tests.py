@@ -1,25 +1,926 @@
 import json
+import random
+import shutil
+import socket
+import tempfile
 import unittest
+import urllib
+from optparse import Values
 
-from mock import patch
+import paramiko
+import requests
+from mock import MagicMock, patch
 
-from cbagent.settings import DefaultSettings
-from cbagent.collectors import NSServer
+from cbagent.__main__ import COLLECTORS, get_collectors
+from cbagent.settings import Settings
+from cbagent.collectors import Latency, NSServer, SyncGateway
+from cbagent.collectors.libstats import jsontails
+from cbagent.clock import monotonic
+from cbagent.columnar import (ColumnarSeries, decode_timestamps,
+                              decode_values, encode_timestamps,
+                              encode_values)
+from cbagent.deadband import Deadband
+from cbagent.collectors.libstats.histogram import Histogram
+from cbagent.collectors.libstats.pool import (ClientUnavailableError,
+                                              ConnectionWrapper, Pool)
+from cbagent.collectors.libstats.poll import poll_keys
+from cbagent.collectors.libstats.probe import OpenLoopProbe
+from cbagent.collectors.libstats.psstats import PSStats
+from cbagent.collectors.libstats.transport import SSHTransport
+from cbagent.history import History
+from cbagent.instrumentation import Instrumentation
+from cbagent.metadata_client import MetadataClient, NullMetadataClient
+from cbagent.rates import Rates
+from cbagent.registry import LRUCache, Registry
+from cbagent.rollup import Rollup
+from cbagent.rest import CircuitBreaker, HTTPClient
+from cbagent.runtime import Context, Topology
+from cbagent.scheduler import Scheduler
+from cbagent.spool import Spool
+from cbagent.stores import FileStore, SerieslyWriter, Store
 
 
 class CollectorMock(NSServer):
 
-    def _get(self, path, *args, **kwargs):
+    def get_http(self, path, *args, **kwargs):
+        path = urllib.unquote(path.split("?")[0]).replace(":8091", "")
         fname = 'fixtures/{}.json'.format(path.replace('/', '_'))
         with open(fname) as fh:
             return json.loads(fh.read())
 
 
 @patch('tests.NSServer', new=CollectorMock)
+@patch('cbagent.runtime.SerieslyStore')
+@patch('cbagent.runtime.MetadataClient', autospec=True)
 class CollectorTest(unittest.TestCase):
 
-    @patch('cbagent.collectors.collector.MetadataClient', autospec=True)
-    def test_ns_collector_update_metadata(self, md_mock):
-        settings = DefaultSettings()
+    def test_ns_collector_update_metadata(self, md_mock, store_mock):
+        settings = Settings()
         ns_collector = NSServer(settings)
         ns_collector.update_metadata()
+
+        mc = md_mock.return_value
+        mc.add_bucket.assert_called_with("default")
+        mc.add_server.assert_called_with("127.0.0.1")
+
+    def test_ns_collector_sample(self, md_mock, store_mock):
+        settings = Settings()
+        ns_collector = NSServer(settings)
+        ns_collector.sample()
+
+        store = store_mock.return_value
+        self.assertEqual(store.append.call_count, 2)  # cluster + 1 node
+        stats = store.append.call_args_list[0][0][0]  # cluster-wide
+        self.assertEqual(len(stats), 166)
+
+    def test_ns_collector_incremental_sample(self, md_mock, store_mock):
+        collector = NSServer(Settings({"ns_server_incremental": True}))
+        requested = []
+        get_http = collector.get_http
+        collector.get_http = lambda path, *args: \
+            requested.append(path) or get_http(path, *args)
+        store = store_mock.return_value
+
+        collector.sample()
+        self.assertEqual(store.append.call_count, 54 + 50)  # all samples
+        data, = store.append.call_args_list[53][0][:1]
+        self.assertEqual(len(data), 165)  # without timestamp
+        self.assertEqual(store.append.call_args_list[53][1]["timestamp"],
+                         1360611698.954)
+
+        store.append.reset_mock()
+        collector.sample()  # the same samples, nothing is newer
+        self.assertFalse(store.append.called)
+        self.assertIn("haveTStamp=1360611698954", requested[-2])
+        self.assertIn("haveTStamp=1360613360954", requested[-1])
+
+    def test_failover_probes_outside_lock(self, md_mock, store_mock):
+        collector = NSServer(Settings())
+        collector.nodes = ["127.0.0.1", "127.0.0.2"]
+        locked = []
+
+        def probe(node):
+            acquired = collector.topology.lock.acquire(False)
+            if acquired:
+                collector.topology.lock.release()
+            locked.append(not acquired)
+            return None if node == "127.0.0.1" else 0.01
+
+        collector._probe = probe
+        self.assertTrue(collector._failover("127.0.0.1"))
+        self.assertEqual(collector.master_node, "127.0.0.2")
+        self.assertEqual(locked, [False, False])
+
+    def test_sync_gateway_shares_context(self, md_mock, store_mock):
+        settings = Settings({"nodes": ["127.0.0.1"]})
+        settings.context = Context(settings)
+        collector = SyncGateway(settings)
+        for resource in ("http", "store", "mc", "registry", "topology",
+                         "history"):
+            self.assertIs(getattr(collector, resource),
+                          getattr(settings.context, resource))
+
+
+class GetCollectorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.known = dict(COLLECTORS)
+        self.options = Values(dict((name, None) for name, _ in COLLECTORS))
+
+    def test_config_list(self):
+        settings = Settings({"collectors": [
+            "ns_server", {"name": "ps", "interval": 5}, {"name": "net"}]})
+        self.assertEqual(get_collectors(self.options, settings), [
+            (self.known["ns_server"], None), (self.known["ps"], 5),
+            (self.known["net"], None)])
+
+    def test_flags_take_precedence(self):
+        self.options.iostat = True
+        settings = Settings({"collectors": ["ns_server"]})
+        self.assertEqual(get_collectors(self.options, settings),
+                         [(self.known["iostat"], None)])
+
+    def test_unknown_collector(self):
+        settings = Settings({"collectors": [{"name": "nsserver"}]})
+        self.assertRaises(SystemExit, get_collectors, self.options, settings)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_ticks_are_aligned(self):
+        scheduler = Scheduler(interval=10, splay=2)
+        self.assertEqual(scheduler.next_tick(now=105), (11, 0))
+        self.assertEqual(scheduler.next_tick(now=111), (11, 0))
+
+    def test_overrun_skip(self):
+        scheduler = Scheduler(interval=10)
+        scheduler.index = 10
+        self.assertEqual(scheduler.next_tick(now=115), (11, 0))  # late
+        self.assertEqual(scheduler.next_tick(now=135), (14, 3))
+
+    def test_overrun_coalesce(self):
+        scheduler = Scheduler(interval=10, overrun="coalesce")
+        scheduler.index = 10
+        self.assertEqual(scheduler.next_tick(now=135), (13, 2))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_circuit_opens_and_resets(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.failure())
+        self.assertTrue(breaker.allow())  # trial request
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_circuit_rejects_requests(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.http = HTTPClient(retries=2, backoff=0, failure_threshold=10)
+        self.http.session = MagicMock()
+        self.http.session.request.side_effect = requests.Timeout("read")
+
+    def test_get_is_retried(self):
+        self.assertRaises(requests.Timeout, self.http.get, "http://h:8091/")
+        self.assertEqual(self.http.session.request.call_count, 3)
+
+    def test_post_is_sent_once(self):
+        self.assertRaises(requests.Timeout, self.http.post, "http://h:8000/")
+        self.assertEqual(self.http.session.request.call_count, 1)
+
+
+class JSONTailsTest(unittest.TestCase):
+
+    def setUp(self):
+        with open('fixtures/_pools_default_buckets_default_stats.json') as fh:
+            self.body = fh.read()
+        self.stats = json.loads(self.body)["op"]
+
+    def test_decode_samples(self):
+        tails = dict((metric, series[-1]) for metric, series
+                     in self.stats["samples"].items())
+        compact = json.dumps({"op": self.stats}, separators=(",", ":"))
+        for body in self.body, compact:
+            self.assertEqual(jsontails.decode_samples(body),
+                             (self.stats["lastTStamp"], tails))
+
+    def test_unexpected_structure(self):
+        for samples in ({"ops": [[1, 2], [3]]}, {"ops": [1, None]},
+                        {"ops": [1], "names": ["a]b"]}, {"ops": {"a": 1}}):
+            self.stats["samples"] = samples
+            self.assertIsNone(jsontails.decode_samples(json.dumps(self.stats)))
+        self.assertIsNone(jsontails.decode_samples('{"op": {}}'))
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_report(self):
+        instrumentation = Instrumentation("c1")
+        instrumentation.store, instrumentation.mc = MagicMock(), MagicMock()
+        instrumentation.timing("GET /pools/default", 0.01)
+        instrumentation.timing("GET /pools/default", 0.03)
+        instrumentation.incr("http_failures", 2)
+        instrumentation.add_source(lambda: {"queue_depth": 5})
+        instrumentation.add_source(lambda: 1 / 0)  # broken source
+
+        instrumentation.report()
+        samples = {"GET_pools_default": 20.0, "GET_pools_default_max": 30.0,
+                   "GET_pools_default_count": 2, "http_failures": 2,
+                   "queue_depth": 5}
+        instrumentation.store.append.assert_called_once_with(
+            samples, cluster="c1", collector="agent")
+        self.assertEqual(
+            sorted(call[0][0] for call
+                   in instrumentation.mc.add_metric.call_args_list),
+            sorted(samples))
+
+        self.assertEqual(instrumentation.snapshot(),
+                         {"http_failures": 0, "queue_depth": 5})
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_series_are_interned(self):
+        registry = Registry()
+        series = registry.get_series("c1", "127.0.0.1", "default", "ns")
+        self.assertIs(registry.get_series("c1", "127.0.0.1", "default", "ns"),
+                      series)
+        self.assertEqual(series.db_name, "nsc1default127001")
+        self.assertEqual(series.key, ("c1", "127.0.0.1", "default", "ns"))
+        self.assertNotEqual(registry.get_series("c1", None, None, "ns").id,
+                            series.id)
+        self.assertEqual(registry.normalize(["a/b", "c"]), ["a_b", "c"])
+
+    def test_unused_items_are_evicted(self):
+        cache = LRUCache(max_size=4)
+        for key in range(3):
+            cache.put(key, key)
+        cache.get(0)  # recently used
+        cache.put(3, 3)
+        self.assertEqual(cache.get(0), 0)
+        self.assertIsNone(cache.get(1))
+        self.assertLessEqual(len(cache), 4)
+
+
+class RatesTest(unittest.TestCase):
+
+    def test_rates(self):
+        rates = Rates()
+        self.assertEqual(rates.update("n1", {"a": 100, "b": 5}, 10.0), {})
+        self.assertEqual(rates.update("n1", {"a": 300, "b": 5}, 12.0),
+                         {"a": 100.0, "b": 0.0})
+        self.assertEqual(rates.update("n2", {"a": 0}, 12.0), {})
+
+    def test_wraps_and_resets(self):
+        rates = Rates()
+        wrapping = ("wrap", )
+        rates.update("n1", {"wrap": 2 ** 32 - 10, "reset": 10 ** 6}, 1.0,
+                     wrapping)
+        self.assertEqual(rates.update("n1", {"wrap": 10, "reset": 7}, 2.0,
+                                      wrapping),
+                         {"wrap": 20.0})
+        self.assertEqual(rates.update("n1", {"wrap": 30, "reset": 17}, 1.0,
+                                      wrapping),
+                         {})  # reboot
+        self.assertEqual(rates.update("n1", {"wrap": 40, "reset": 27}, 3.0,
+                                      wrapping),
+                         {"wrap": 5.0, "reset": 5.0})
+
+    def test_undeclared_counters_dont_wrap(self):
+        rates = Rates()
+        rates.update("sg1", {"PauseTotalNs": 3 * 10 ** 9}, 1.0)
+        self.assertEqual(rates.update("sg1", {"PauseTotalNs": 10 ** 6}, 2.0),
+                         {})  # restart, not a wrap
+
+    def test_process_metrics(self):
+        rates = {("memcached", "100", "cpu_ticks"): 50.0,
+                 ("memcached", "100", "read_bytes"): 4096.0,
+                 ("memcached", "100", "write_bytes"): 8192.0,
+                 ("memcached", "100", "voluntary_ctxt_switches"): 300.0,
+                 ("memcached", "100", "nonvoluntary_ctxt_switches"): 20.0,
+                 ("beam.smp", "200", "voluntary_ctxt_switches"): 1.0}
+        self.assertEqual(PSStats.get_metrics(rates, clk_tck=100.0), {
+            "memcached_cpu": 50.0,
+            "memcached_read_bytes_per_sec": 4096.0,
+            "memcached_write_bytes_per_sec": 8192.0,
+            "memcached_ctxt_switches_per_sec": 320.0,
+        })
+
+
+class PSStatsTest(unittest.TestCase):
+
+    OUTPUT = "\n".join([
+        "12345.67 23456.78",
+        "100",
+        "bash: warning: setlocale: LC_ALL: cannot change locale",
+        "#memcached 100",
+        "100 (memcached) S 1 100 100 0 -1 4194560 1000 0 0 0 150 50 0 0 20",
+        "Name:\tmemcached",
+        "VmRSS:\t  2048 kB",
+        "Threads:\t8",
+        "read_bytes: 4096",
+        "#beam.smp ",
+    ])
+
+    def test_parse(self):
+        uptime, clk_tck, sections = PSStats._parse(self.OUTPUT)
+        self.assertEqual((uptime, clk_tck), (12345.67, 100))
+        self.assertEqual(sections, {
+            "memcached": {"pid": "100", "cpu_ticks": 200, "VmRSS": 2048,
+                          "Threads": 8, "read_bytes": 4096},
+            "beam.smp": {"pid": ""},
+        })
+
+
+class OpenLoopProbeTest(unittest.TestCase):
+
+    class Stop(BaseException):
+        pass
+
+    def setUp(self):
+        self.now = 0.0
+        self.executed = []
+        patcher = patch.multiple("cbagent.collectors.libstats.probe",
+                                 monotonic=lambda: self.now,
+                                 sleep=self.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sleep(self, delay):
+        self.now += delay
+
+    def execute(self, op, size, n):
+        if n == 8:
+            raise self.Stop()
+        self.executed.append((self.now, op, size))
+        self.now += 0.5 if n == 2 else 0.001  # a stall
+        if op == "set" and size == 2:
+            raise RuntimeError("timeout")
+
+    def test_schedule_and_snapshot(self):
+        probe = OpenLoopProbe(self.execute, rate=10, mix={"get": 2, "set": 1},
+                              sizes=[1, 2])
+        self.assertRaises(self.Stop, probe.run)
+
+        # operations start on schedule unless a stall delays them
+        self.assertEqual([(op, size) for _, op, size in self.executed],
+                         probe.schedule + probe.schedule[:2])
+        self.assertAlmostEqual(self.executed[1][0], 0.1)
+        self.assertAlmostEqual(self.executed[3][0], 0.7)  # behind stall
+
+        histograms, errors = probe.snapshot()
+        self.assertEqual(errors, 1)
+        self.assertEqual(histograms[("get", 1)].count, 4)
+        self.assertEqual(histograms[("set", 2)].count, 0)
+        self.assertGreaterEqual(histograms[("get", 2)].max, 200000)  # us
+
+        histograms, errors = probe.snapshot()
+        self.assertEqual(errors, 0)
+        self.assertEqual(histograms[("get", 1)].count, 0)
+
+    def test_unsupported_operations(self):
+        latency = Latency.__new__(Latency)
+        settings = Settings({"latency_rate": 10,
+                             "latency_mix": {"get": 1, "scan": 1}})
+        self.assertRaises(ValueError, latency.init_probes, settings)
+
+
+class PollKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+        patcher = patch.multiple("cbagent.collectors.libstats.poll",
+                                 monotonic=lambda: self.now,
+                                 sleep=self.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+    def test_arrivals_and_timeout(self):
+        ready_at = {"a": 0, "b": 1}  # "c" never arrives
+        checked = []
+
+        def check(keys):
+            checked.append(list(keys))
+            return [key for key in keys if ready_at.get(key, 99) <= self.now]
+
+        arrivals = poll_keys(check, ["a", "b", "c"], t0=0, timeout=5,
+                             max_interval=0.1)
+        self.assertEqual(sorted(arrivals), ["a", "b"])
+        self.assertEqual(arrivals["a"], 0)
+        self.assertLess(arrivals["b"] - 1, 0.06)  # sampling error
+        self.assertEqual(checked[0], ["a", "b", "c"])
+        self.assertEqual(checked[-1], ["c"])  # all outstanding keys at once
+        self.assertGreater(self.now, 5)
+        self.assertLess(self.now, 5.1)
+        self.assertEqual(self.sleeps, sorted(self.sleeps))  # backoff
+        self.assertEqual(max(self.sleeps), 0.1)
+
+    def test_all_ready(self):
+        self.assertEqual(poll_keys(lambda keys: keys, ["a"], 0, 5), {"a": 0})
+        self.assertEqual(self.sleeps, [])
+
+
+class SerieslyWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool = MagicMock()
+        self.spool.__len__.return_value = 0
+        self.writer = SerieslyWriter(MagicMock(), batch_size=10,
+                                     flush_interval=1, compress=False,
+                                     spool=self.spool, replay_rate=100)
+        self.posted = []
+        self.writer._post = self._post
+
+    def _post(self, db_name, timestamp, data):
+        if timestamp == 3:
+            raise requests.ConnectionError()
+        self.posted.append(timestamp)
+
+    def test_backlog_is_replayed_in_order(self):
+        spool = self.writer.spool = Spool(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, spool.path)
+        for ts in range(5):
+            spool.put("db{}".format(ts // 2), ts, {"m": ts})
+
+        self.writer.last_replay = 0
+        self.writer._replay()  # fails at the 4th point
+
+        self.assertEqual(self.posted, [0, 1, 2])
+        self.assertEqual(len(spool), 2)
+        self.assertFalse(self.writer.healthy)
+
+        self.writer.pending = 1
+        self.writer.healthy = True
+        self.writer._flush([("db0", 10, {"m": 10})])  # behind the backlog
+        self.assertEqual([point[1] for _, point in spool.peek(10)],
+                         [3, 4, 10])
+
+    def test_only_unwritten_points_are_spooled(self):
+        self.writer.pending = 5
+        self.writer._flush([("db", ts, {"m": ts}) for ts in range(5)])
+
+        self.assertEqual(self.posted, [0, 1, 2])
+        self.assertEqual([c[0][1] for c in self.spool.put.call_args_list],
+                         [3, 4])
+        self.assertEqual((self.writer.written, self.writer.spooled,
+                          self.writer.pending), (3, 2, 0))
+
+
+class MetadataClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.http = MagicMock()
+        self.mc = MetadataClient(Settings(), http=self.http)
+
+    def test_fallback_to_single_metrics(self):
+        self.http.post.side_effect = lambda url, data: MagicMock(
+            status_code=500 if url.endswith("/add_metrics/") else 200)
+        items = [("metric", ("m{}".format(i), None, None, None), {})
+                 for i in range(3)]
+
+        self.assertEqual(self.mc._flush(items), [])
+        self.assertIs(self.mc.bulk_metrics, False)
+        self.assertEqual(self.http.post.call_count, 4)
+
+    def test_known_items_are_bounded(self):
+        mc = MetadataClient(Settings({"cluster": "c1"}), http=self.http,
+                            max_items=4)
+        mc._start_registrar = lambda: None
+        for metric in ("a", "a", "b", "a"):
+            mc.add_metric(metric, bucket="default")
+        self.assertEqual(mc.queue.qsize(), 2)
+
+        for i in range(10):
+            mc.add_metric("m{}".format(i))
+        self.assertLessEqual(len(mc.known["metric"]), 4)
+
+    def test_unavailable_cbmonitor(self):
+        self.http.get.side_effect = requests.ConnectionError()
+        items = [("cluster", "c1", {"name": "c1"})]
+
+        self.assertEqual(self.mc._flush(items), items)  # requeued
+        self.assertFalse(self.http.post.called)
+
+
+class SSHTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = SSHTransport("10.1.1.1", "root", "couchbase")
+        self.transport.close = MagicMock()
+        self.transport.is_active = MagicMock(return_value=True)
+
+    @staticmethod
+    def channel(output="", error=None):
+        channel = MagicMock()
+        channel.makefile.return_value.read.return_value = output
+        channel.makefile.return_value.read.side_effect = error
+        channel.recv_exit_status.return_value = 0
+        return channel
+
+    def test_reconnect_on_channel_open_failure(self):
+        opened = self.channel("a")
+        self.transport._open = MagicMock(side_effect=[
+            opened, paramiko.SSHException("channel"),
+            self.channel("a"), self.channel("b")])
+
+        self.assertEqual(self.transport.run_many(["a", "b"]), ["a", "b"])
+        self.assertTrue(opened.close.called)
+        self.assertEqual(self.transport.close.call_count, 1)
+
+    def test_command_timeout_fails_alone(self):
+        slow = self.channel(error=socket.timeout())
+        self.transport._open = MagicMock(
+            side_effect=[slow, self.channel("b")])
+
+        results = self.transport.run_many(["a", "b"])
+        self.assertTrue(results[0].failed)
+        self.assertEqual(results[1], "b")
+        self.assertFalse(self.transport.close.called)
+
+    def test_reconnect_on_broken_connection(self):
+        broken = self.channel("b")
+        self.transport._open = MagicMock(side_effect=[
+            self.channel(error=socket.error("reset")), broken,
+            self.channel("a"), self.channel("b")])
+        self.transport.is_active.return_value = False
+
+        self.assertEqual(self.transport.run_many(["a", "b"]), ["a", "b"])
+        self.assertTrue(broken.close.called)
+        self.assertEqual(self.transport.close.call_count, 1)
+
+    def test_errors_on_live_connection_are_raised(self):
+        self.transport._open = MagicMock(
+            side_effect=[self.channel(error=socket.error("reset"))])
+        self.assertRaises(socket.error, self.transport.run_many, ["a"])
+        self.assertFalse(self.transport.close.called)
+
+
+class TopologyTest(unittest.TestCase):
+
+    def test_stale_results_are_dropped(self):
+        topology = Topology(ttl=5)
+        generation = topology.generation
+        self.assertTrue(topology.update(generation, nodes=["127.0.0.1"]))
+
+        topology.invalidate()  # e.g., rebalance while a request was running
+        self.assertFalse(topology.update(generation, buckets=[]))
+        self.assertIsNone(topology.nodes)
+        self.assertIsNone(topology.buckets)
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_backlog_survives_reopen(self):
+        spool = Spool(self.path, segment_size=64)
+        for ts in range(10):
+            spool.put("db", ts, {"m": ts})
+        records = spool.peek(4)
+        spool.commit(records[-1][0], len(records))
+
+        spool = Spool(self.path, segment_size=64)
+        self.assertEqual(len(spool), 6)
+        self.assertEqual([point for _, point in spool.peek(10)],
+                         [["db", ts, {"m": ts}] for ts in range(4, 10)])
+
+    def test_size_is_bounded(self):
+        spool = Spool(self.path, segment_size=64, max_size=256)
+        for ts in range(100):
+            spool.put("db", ts, {"m": ts})
+
+        self.assertLessEqual(spool.stats()["spool_bytes"], 256 + 64)
+        self.assertEqual(len(spool) + spool.dropped, 100)
+        self.assertEqual(spool.peek(1)[0][1][1], spool.dropped)  # oldest
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        rng = random.Random(42)
+        values = sorted(int(rng.lognormvariate(8, 1.5)) for _ in range(10000))
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+
+        for percentile in (50, 90, 99, 99.9):
+            exact = values[int(round(percentile / 100.0 * len(values))) - 1]
+            self.assertLessEqual(
+                abs(histogram.percentile(percentile) - exact),
+                exact * 2 ** (1 - histogram.precision) + 1)
+        self.assertEqual((histogram.min, histogram.max),
+                         (values[0], values[-1]))
+
+    def test_merge(self):
+        h1, h2 = Histogram(), Histogram()
+        for value in range(100):
+            (h1 if value % 2 else h2).record(value)
+        h1.merge(h2)
+
+        self.assertEqual(h1.count, 100)
+        self.assertEqual(h1.percentile(50), 49)  # exact below 2 ** precision
+        self.assertEqual(h1.summary("lat", scale=0.5)["lat_max"], 49.5)
+
+
+class FakeConnection(object):
+
+    start_using = ConnectionWrapper.__dict__["start_using"]
+
+    stop_using = ConnectionWrapper.__dict__["stop_using"]
+
+    def __init__(self, **kwargs):
+        self.use_count = self.use_time = self.last_use_time = 0
+        self.idle_since = monotonic()
+        self.closed = False
+
+    def is_healthy(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+@patch('cbagent.collectors.libstats.pool.ConnectionWrapper',
+       new=FakeConnection)
+class PoolTest(unittest.TestCase):
+
+    def test_lifo_checkout(self):
+        pool = Pool(initial=0, max_clients=3)
+        c1, c2 = pool.get_client(), pool.get_client(initial_timeout=0)
+        pool.release_client(c1)
+        pool.release_client(c2)
+
+        self.assertIs(pool.get_client(), c2)
+        self.assertIs(pool.get_client(), c1)
+
+    def test_idle_connections_are_closed(self):
+        pool = Pool(initial=0, max_clients=2, max_idle=0)
+        c1 = pool.get_client()
+        pool.release_client(c1)
+        c2 = pool.get_client()
+
+        self.assertIsNot(c1, c2)
+        self.assertTrue(c1.closed)
+        self.assertEqual(pool.stats()["pool_evicted"], 1)
+
+        pool.release_client(c2, healthy=False)
+        self.assertTrue(c2.closed)
+
+    def test_timeout(self):
+        pool = Pool(initial=0, max_clients=1)
+        pool.get_client()
+        t0 = monotonic()
+        self.assertRaises(ClientUnavailableError, pool.get_client,
+                          next_timeout=0.05)
+        self.assertGreaterEqual(monotonic() - t0, 0.05)
+        self.assertEqual(pool.stats()["pool_waits"], 1)
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def test_timestamps(self):
+        timestamps = [1400000000000, 1400000001000, 1400000002000,
+                      1400000002999, 1400000010000, 1400000000000,
+                      1400000000000 + 2 ** 40]
+        encoded = encode_timestamps(timestamps)
+        self.assertEqual(decode_timestamps(encoded, len(timestamps)),
+                         timestamps)
+
+        regular = range(0, 600000, 1000)
+        # the first timestamp and delta, then one bit per timestamp
+        self.assertLessEqual(len(encode_timestamps(regular)), 8 + 2 + 600 // 8)
+
+    def test_values(self):
+        values = [0.0, 0.0, 1.5, -1.5, 1e300, 3, 2 ** 53, 0.1, 0.1]
+        encoded = encode_values(values)
+        self.assertEqual(decode_values(encoded, len(values)), values)
+
+        values = decode_values(encode_values([1.0, "n/a", None]), 3)
+        self.assertEqual(values[0], 1.0)
+        self.assertTrue(all(v != v for v in values[1:]))  # NaN
+
+    def test_segment_scan(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        series = ColumnarSeries(path, segment_size=256)
+        for block in range(5):
+            series.append([(block * 10 + i, {"a": i, "b": block})
+                           for i in range(10)])
+        series.close()
+        self.assertGreater(len(series.segments()), 1)
+
+        with open(series.segments()[-1], "ab") as fh:
+            fh.write(b"CBTB\x00\x00")  # interrupted write
+
+        points = list(ColumnarSeries(path).scan(start=15, end=24))
+        self.assertEqual(points, [(float(ts), {"a": ts % 10, "b": ts // 10})
+                                  for ts in range(15, 25)])
+        self.assertEqual(len(list(ColumnarSeries(path).scan())), 50)
+
+
+class FileStoreTest(unittest.TestCase):
+
+    def test_no_metadata(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        context = Context(Settings({"store": "file", "store_path": path}))
+        self.assertIsInstance(context.mc, NullMetadataClient)
+
+        context.store.append({"m": 1}, cluster="c1", collector="ns",
+                             timestamp=1400000000)
+        context.store.flush(timeout=5)
+        self.assertEqual(list(ColumnarSeries(path + "/nsc1").scan()),
+                         [(1400000000.0, {"m": 1.0})])
+
+    def test_evicted_series_are_closed(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = FileStore(path, block_size=1, max_open_files=4)
+        series, evicted = store.writer.series, []
+        series.on_evict = lambda _, s: evicted.append(s) or s.close()
+        for node in range(12):  # node churn
+            store.append({"m": node}, cluster="c1", server=str(node),
+                         collector="ns", timestamp=1400000000)
+        store.flush(timeout=5)
+
+        self.assertLessEqual(len(series), 4)
+        self.assertEqual(len(series) + len(evicted), 12)
+        self.assertTrue(all(s._fh is None for s in evicted))
+        self.assertEqual(list(ColumnarSeries(path + "/nsc10").scan()),
+                         [(1400000000.0, {"m": 0.0})])
+
+
+class StoreTest(unittest.TestCase):
+
+    def test_full_queue_drops_sample_before_views(self):
+        store = Store(queue_size=1, history=History(capacity=10),
+                      deadband=Deadband())
+        store.append({"ops": 1}, cluster="c1", collector="ns", timestamp=1)
+        store.append({"ops": 2}, cluster="c1", collector="ns", timestamp=2)
+        self.assertEqual(store.dropped, 1)
+        ops = store.history.get("ops", cluster="c1", collector="ns")
+        self.assertEqual(list(ops.window()[1]), [1])
+
+        store.queue.get_nowait()  # writer caught up
+        store.append({"ops": 2}, cluster="c1", collector="ns", timestamp=3)
+        self.assertEqual(store.queue.get_nowait(), ("nsc1", 3, {"ops": 2}))
+
+    def test_block_timeout_waits_for_free_slot(self):
+        store = Store(queue_size=1, block_timeout=0.05)
+        store.append({"ops": 1}, cluster="c1", collector="ns", timestamp=1)
+        store.append({"ops": 2}, cluster="c1", collector="ns", timestamp=2)
+        self.assertEqual(store.dropped, 1)
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_window_aggregates(self):
+        history = History(capacity=10)
+        for ts in range(20):
+            history.append("nsc1", ts, {"ops": ts, "state": "healthy"})
+
+        ops = history.get("ops", cluster="c1", collector="ns")
+        self.assertEqual(len(ops), 10)
+        self.assertEqual(ops.mean(4.5, now=19), 17)
+        self.assertEqual(history.query("rate", "ops", cluster="c1",
+                                       collector="ns"), 1)
+        self.assertIsNone(history.get("state", cluster="c1", collector="ns"))
+
+    def test_new_series_evict_old_ones(self):
+        history = History(capacity=10, max_series=4)
+        for ts in range(3):
+            for node in range(ts * 4, ts * 4 + 4):  # node churn
+                history.append("ns{}".format(node), ts, {"ops": ts})
+
+        self.assertIsNotNone(history.get("ops", cluster="11",
+                                         collector="ns"))
+        self.assertIsNone(history.get("ops", cluster="0", collector="ns"))
+        self.assertLessEqual(history.stats()["history_series"], 4)
+        self.assertEqual(history.stats()["history_thrashed"], 0)
+
+    def test_metrics_are_kept_together(self):
+        history = History(capacity=4)
+        history.append("ns", 1, {"a": 1})
+        history.append("ns", 2, {"a": 2, "b": 5})
+        history.append("ns", 3, {"b": 6, "c": [1, 2]})
+
+        a, b = history.get("a", collector="ns"), history.get("b",
+                                                              collector="ns")
+        self.assertEqual(a.window()[1].tolist(), [1, 2])
+        self.assertEqual(b.window()[0].tolist(), [2, 3])
+        self.assertEqual(history.stats()["history_series"], 1)
+        self.assertIsNone(history.get("c", collector="ns"))
+
+    def test_active_series_eviction_is_counted(self):
+        history = History(capacity=10, max_series=4)
+        for ts in range(3):
+            for node in range(6):
+                history.append("ns{}".format(node), ts, {"ops": ts})
+        self.assertGreater(history.stats()["history_thrashed"], 0)
+
+
+class RollupTest(unittest.TestCase):
+
+    SERIES = Registry().get_series("c1", "10.1.1.1:8091", "default",
+                                   "ns_server")
+
+    def test_window_aggregates(self):
+        rollup = Rollup(windows=[10])
+        self.assertEqual(rollup.add(self.SERIES, 100, {"ops": 1}), [])
+        rollup.add(self.SERIES, 105, {"ops": 3, "state": "healthy"})
+        rollup.add(self.SERIES, 99, {"ops": 2})  # late sample
+
+        (db_name, ts, data), = rollup.add(self.SERIES, 110, {"ops": 5})
+        self.assertEqual(db_name, "ns_server_10sc1default101118091")
+        self.assertEqual(ts, 100)
+        self.assertEqual(data, {"ops_min": 1, "ops_max": 3, "ops_avg": 2,
+                                "ops_last": 2, "ops_count": 3})
+
+        (_, ts, data), = rollup.flush()
+        self.assertEqual((ts, data["ops_last"]), (110, 5))
+        self.assertEqual(rollup.flush(), [])
+
+    def test_metrics_are_registered(self):
+        mc = MagicMock()
+        rollup = Rollup(windows=[10, 60], mc=mc)
+        for ts in (0, 5, 60, 65, 120):
+            rollup.add(self.SERIES, ts, {"ops": ts})
+
+        added = set(call[0] for call in mc.add_metric.call_args_list)
+        self.assertEqual(len(added), mc.add_metric.call_count)
+        self.assertEqual(added, set(
+            ("ops_" + aggregate, "default", "10.1.1.1:8091", collector)
+            for aggregate in ("min", "max", "avg", "last", "count")
+            for collector in ("ns_server_10s", "ns_server_60s")
+        ))
+
+
+    def test_stale_windows_are_emitted(self):
+        registry = Registry()
+        live, stale = [registry.get_series("c1", server, "default",
+                                           "ns_server")
+                       for server in ("10.1.1.1:8091", "10.1.1.2:8091")]
+        rollup = Rollup(windows=[10], registry=registry)
+        rollup.add(stale, 0, {"ops": 1})
+        emitted = []
+        for ts in range(0, 40, 5):
+            emitted += rollup.add(live, ts, {"ops": ts})
+
+        stale_db = "ns_server_10sc1default101128091"
+        self.assertEqual([ts for db_name, ts, _ in emitted
+                          if db_name == stale_db], [0])
+        self.assertEqual(len(rollup.current), 1)
+
+    def test_open_windows_are_bounded(self):
+        registry = Registry()
+        rollup = Rollup(windows=[10], registry=registry, max_series=4)
+        emitted = []
+        for node in range(10):  # node churn within one window
+            series = registry.get_series("c1", str(node), None, "ns")
+            emitted += rollup.add(series, 1, {"ops": node})
+
+        self.assertLessEqual(len(rollup.current), 4)
+        emitted += rollup.flush()
+        self.assertEqual(sorted(data["ops_last"] for _, _, data in emitted),
+                         range(10))
+
+
+class DeadbandTest(unittest.TestCase):
+
+    def test_changes_and_keyframes(self):
+        deadband = Deadband(abs_band=1, keyframe=3)
+        self.assertEqual(deadband.filter("nsc1", {"a": 10, "b": "x"}),
+                         {"a": 10, "b": "x"})
+        self.assertEqual(deadband.filter("nsc1", {"a": 11, "b": "x"}), {})
+        self.assertEqual(deadband.filter("nsc1", {"a": 12, "b": "y"}),
+                         {"a": 12, "b": "y"})
+        self.assertEqual(deadband.filter("nsc1", {"a": 12, "b": "y"}),
+                         {"a": 12, "b": "y"})  # keyframe
+        self.assertEqual(deadband.stats()["deadband_suppressed"], 2)
+
+    def test_series_are_bounded(self):
+        deadband = Deadband(max_series=4)
+        for node in range(100):  # node churn
+            deadband.filter("ns{}".format(node), {"ops": 0})
+
+        stats = deadband.stats()
+        self.assertLessEqual(stats["deadband_series"], 4)
+        self.assertEqual(stats["deadband_evicted"], 96)
+        self.assertEqual(deadband.filter("ns0", {"ops": 0}), {"ops": 0})
+        self.assertEqual(deadband.filter("ns0", {"ops": 0}), {})